@@ -33,6 +33,7 @@ Contributors:
 
 """
 
+import argparse
 import json
 import psutil
 import requests
@@ -40,17 +41,26 @@ import os
 import signal
 import sys
 import threading
+import time
 import urllib
 
 from bson import json_util, ObjectId
-from flask import Flask, request, Response
+from flask import Flask, g, request, Response
 from threading import Thread
 
 from modules.helpers import helpers
+from modules.asgi import asgi
+from modules.batch import batch
 from modules.broker import broker
 from modules.entities import entities
+from modules.ingest import ingest
+from modules.metrics import metrics
+from modules.monitor import monitor
 from modules.mongodb import mongodb
 from modules.mqtt import mqtt
+from modules.notifications import notifications
+from modules.prefork import prefork
+from modules.profiler import profiler
 from modules.types import types
 from modules.subscriptions import subscriptions
 
@@ -77,13 +87,41 @@ class hiascdi():
 
         self.err406 = self.confs["errorMessages"]["406"]
 
+        self.metrics = None
+        if self.confs["metrics"]["enabled"]:
+            self.metrics = metrics(self.helpers)
+
+        self.monitor = monitor(self.helpers, self.metrics)
+
+        self.profiler = None
+        if self.credentials["profiling"]["token"] != "":
+            self.profiler = profiler(self.helpers)
+
         self.helpers.logger.info(
             self.component + " " + self.version + " initialization complete.")
 
+    def get_workers(self):
+        """ Gets the number of worker processes.
+
+        The --workers argument overrides the server workers
+        credential. 0 starts a worker for each CPU core.
+        """
+
+        parser = argparse.ArgumentParser(add_help=False)
+        parser.add_argument("--workers", type=int,
+                            default=self.credentials["server"].get("workers", 1))
+        workers = parser.parse_known_args()[0].workers
+
+        return workers if workers > 0 else os.cpu_count()
+
     def mongodb_connection(self):
         """ Initiates the mongodb connection class. """
 
-        self.mongodb = mongodb(self.helpers)
+        listeners = []
+        if self.metrics is not None or self.confs["monitor"]["enabled"]:
+            listeners.append(self.monitor)
+
+        self.mongodb = mongodb(self.helpers, listeners)
         self.mongodb.start()
 
     def hiascdi_connections(self):
@@ -107,10 +145,18 @@ class hiascdi():
         self.mqtt.configure()
         self.mqtt.start()
 
+    def configure_notifications(self):
+        """ Configures the HIASCDI subscription notifications. """
+
+        self.notifications = notifications(self.helpers, self.mongodb,
+                                           self.broker)
+        self.notifications.start()
+
     def configure_entities(self):
         """ Configures the HIASCDI entities. """
 
-        self.entities = entities(self.helpers, self.mongodb, self.broker)
+        self.entities = entities(self.helpers, self.mongodb, self.broker,
+                                 self.notifications)
 
     def configure_types(self):
         """ Configures the HIASCDI entity types. """
@@ -120,7 +166,22 @@ class hiascdi():
     def configure_subscriptions(self):
         """ Configures the HIASCDI subscriptions. """
 
-        self.subscriptions = subscriptions(self.helpers, self.mongodb, self.broker)
+        self.subscriptions = subscriptions(self.helpers, self.mongodb, self.broker,
+                                           self.notifications)
+
+    def configure_batch(self):
+        """ Configures the HIASCDI batch operations. """
+
+        self.batch = batch(self.helpers, self.mongodb, self.broker,
+                           self.entities)
+
+    def configure_ingest(self):
+        """ Configures the iotJumpWay telemetry ingestion. """
+
+        self.ingest = ingest(self.helpers, self.mongodb, self.mqtt,
+                             getattr(self, "entities", None),
+                             getattr(self, "notifications", None))
+        self.ingest.start()
 
     def get_broker(self):
 
@@ -135,6 +196,104 @@ class hiascdi():
             "Temperature": psutil.sensors_temperatures()['coretemp'][0].current
         }
 
+    def get_metrics(self):
+        """ Gets the metrics of the process.
+
+        The request and MongoDB command metrics are recorded by the
+        metrics module, the module statistics are read when the
+        metrics are requested.
+        """
+
+        return self.metrics.render(self.get_families())
+
+    def get_families(self):
+        """ Gets the metrics of the module statistics.
+
+        Modules that are not started in the process are left out.
+        """
+
+        families = []
+
+        caches = []
+        if getattr(self, "entities", None) is not None \
+                and self.entities.cache is not None:
+            caches.append(("entities", self.entities.cache.stats))
+        if getattr(self, "mongodb", None) is not None \
+                and self.mongodb.counts is not None:
+            caches.append(("counts", self.mongodb.counts.stats))
+        if getattr(self, "broker", None) is not None:
+            caches.append(("query", self.broker.query.compiled.stats))
+
+        if len(caches):
+            for key in ["hits", "misses", "evictions", "invalidations"]:
+                families.append(("hiascdi_cache_" + key + "_total", "counter",
+                                 "Cache " + key + ".", [({"cache": name}, stats[key])
+                                                        for name, stats in caches]))
+            families.append(("hiascdi_cache_hit_ratio", "gauge",
+                             "Cache hits of all cache reads.",
+                             [({"cache": name}, stats["hits"] / max(
+                                 stats["hits"] + stats["misses"], 1))
+                              for name, stats in caches]))
+
+        if getattr(self, "mqtt", None) is not None:
+            stats = self.mqtt.stats
+            families += [
+                ("hiascdi_mqtt_messages_total", "counter",
+                 "iotJumpWay messages by state.",
+                 [({"state": key}, stats[key]) for key in [
+                     "received", "handled", "dropped", "unhandled", "errors"]]),
+                ("hiascdi_mqtt_handling_seconds_total", "counter",
+                 "Time from receiving to handling the iotJumpWay messages.",
+                 [({}, stats["totalLatency"])]),
+                ("hiascdi_mqtt_handling_seconds_max", "gauge",
+                 "Longest time from receiving to handling a message.",
+                 [({}, stats["maxLatency"])]),
+                ("hiascdi_mqtt_queue_depth", "gauge",
+                 "iotJumpWay messages waiting for a worker.",
+                 [({}, self.mqtt.get_depth())])]
+
+        if getattr(self, "notifications", None) is not None:
+            families += [
+                ("hiascdi_notifications_total", "counter",
+                 "Subscription notifications by state.",
+                 [({"state": key}, value)
+                  for key, value in self.notifications.stats.items()]),
+                ("hiascdi_notifications_queue_depth", "gauge",
+                 "Notifications waiting for a worker.",
+                 [({}, self.notifications.queue.qsize())])]
+
+        buffers = []
+        if getattr(self, "entities", None) is not None:
+            buffers.append(("entities", self.entities.writebehind.stats))
+        if getattr(self, "ingest", None) is not None:
+            buffers.append(("ingest", self.ingest.writebehind.stats))
+            families.append(("hiascdi_ingest_messages_total", "counter",
+                             "Ingested telemetry by state.",
+                             [({"state": key}, value)
+                              for key, value in self.ingest.stats.items()]))
+
+        if len(buffers):
+            families += [
+                ("hiascdi_writebehind_total", "counter",
+                 "Write-behind buffer updates and writes by state.",
+                 [({"buffer": name, "state": key}, value)
+                  for name, stats in buffers for key, value in stats.items()
+                  if key not in ["lag", "maxLag"]]),
+                ("hiascdi_writebehind_lag_seconds_max", "gauge",
+                 "Longest time from buffering to writing an update.",
+                 [({"buffer": name}, stats["maxLag"]) for name, stats in buffers])]
+
+        if getattr(self, "mongodb", None) is not None:
+            shapes = self.mongodb.indexes.report()
+            families.append(("hiascdi_query_shapes", "gauge",
+                             "Query shapes by index support.",
+                             [({"indexed": str(indexed).lower()}, len(
+                                 [shape for shape in shapes
+                                  if shape["indexed"] is indexed]))
+                              for indexed in [True, False]]))
+
+        return families
+
     def process_headers(self, request):
         """ Processes the request headers """
 
@@ -151,18 +310,8 @@ class hiascdi():
     def respond(self, responseCode, response, accepted):
         """ Builds the request response """
 
-        headers = {}
-        if "application/json" in accepted:
-            response =  Response(response=response, status=responseCode,
-                    mimetype="application/json")
-            headers['Content-Type'] = 'application/json'
-        elif "text/plain" in accepted:
-            response = self.broker.prepareResponse(response)
-            response = Response(response=response, status=responseCode,
-                    mimetype="text/plain")
-            headers['Content-Type'] = 'text/plain; charset=utf-8'
-        response.headers = headers
-        return response
+        return self.broker.respond(responseCode, response, {},
+                                   False, accepted)
 
     def life(self):
         """ Sends vital statistics to HIAS """
@@ -193,14 +342,126 @@ class hiascdi():
         self.helpers.logger.info("HIASCDI life statistics published.")
         threading.Timer(300.0, self.life).start()
 
+    def stop(self):
+        """ Writes the buffered entity updates and telemetry. """
+
+        if getattr(self, "ingest", None) is not None:
+            self.ingest.stop()
+
+        if hasattr(self, "entities"):
+            self.entities.writebehind.stop()
+
     def signal_handler(self, signal, frame):
         self.helpers.logger.info("Disconnecting")
+        self.stop()
         sys.exit(1)
 
 
 hiascdi = hiascdi()
 app = Flask(hiascdi.component)
 
+@app.before_request
+def started():
+    """ Records the start of a request and traces its MongoDB
+    commands. """
+
+    g.started = time.perf_counter()
+    g.trace = hiascdi.monitor.begin(
+        request.method, request.full_path,
+        request.url_rule.rule if request.url_rule is not None else "")
+
+    g.profile = None
+    if hiascdi.profiler is not None \
+            and hiascdi.profiler.authorized(request.headers):
+        g.profile = hiascdi.profiler.start()
+
+@app.after_request
+def finished(response):
+    """ Records a request once its response has been sent. """
+
+    trace = g.trace
+
+    if g.profile is not None:
+        # Profiled responses are sent once complete, so the profile
+        # and the Server-Timing header cover the whole request
+        response.get_data()
+        response.headers["Server-Timing"] = hiascdi.profiler.finish(
+            g.pop("profile"), request.method, request.full_path,
+            time.perf_counter() - g.started,
+            trace["time"] if trace is not None else None)
+
+    hiascdi.monitor.resume(None)
+
+    if hiascdi.metrics is None and trace is None:
+        return response
+
+    started = g.started
+    method = request.method
+    route = request.url_rule.rule if request.url_rule is not None else ""
+    status = response.status_code
+    size = response.calculate_content_length()
+    sent = [0]
+
+    if size is None and response.is_streamed:
+        # Streamed responses are measured as they are sent, and the
+        # commands fetching them are traced on the sending thread
+        iterable = response.response
+        chunks = iter(iterable)
+
+        def count():
+            try:
+                while True:
+                    previous = hiascdi.monitor.resume(trace)
+                    try:
+                        chunk = next(chunks, None)
+                    finally:
+                        hiascdi.monitor.resume(previous)
+                    if chunk is None:
+                        return
+                    sent[0] += len(chunk)
+                    yield chunk
+            finally:
+                if hasattr(iterable, "close"):
+                    previous = hiascdi.monitor.resume(trace)
+                    try:
+                        iterable.close()
+                    finally:
+                        hiascdi.monitor.resume(previous)
+
+        response.response = count()
+
+    def record():
+        duration = time.perf_counter() - started
+        if hiascdi.metrics is not None:
+            hiascdi.metrics.request(method, route, status, duration,
+                                    sent[0] if size is None else size)
+        hiascdi.monitor.end(trace, duration)
+
+    response.call_on_close(record)
+
+    return response
+
+@app.teardown_request
+def failed(error=None):
+    """ Stops profiling a request that failed before its profile was
+    written. """
+
+    profile = g.pop("profile", None)
+    if profile is not None:
+        hiascdi.profiler.stop(profile)
+
+@app.route('/metrics', methods=['GET'])
+def metricsGet():
+    """ Responds to GET requests sent to the /metrics endpoint. """
+
+    if hiascdi.metrics is None:
+        return hiascdi.respond(
+            404, hiascdi.confs["errorMessages"][str(404)],
+            "application/json")
+
+    return Response(hiascdi.get_metrics(), status=200,
+                    mimetype="text/plain; version=0.0.4")
+
 @app.route('/', methods=['GET'])
 def about():
     """ Responds to GET requests sent to the /v1/ API endpoint. """
@@ -215,9 +476,7 @@ def about():
             415, hiascdi.confs["errorMessages"][str(415)],
             "application/json")
 
-    return hiascdi.respond(
-        200, json.dumps(json.loads(json_util.dumps(
-            hiascdi.get_broker())), indent=4), accepted)
+    return hiascdi.respond(200, hiascdi.get_broker(), accepted)
 
 @app.route('/entities', methods=['POST'])
 def entitiesPost():
@@ -398,7 +657,6 @@ def entityPatch(_id):
             accepted)
 
     query = hiascdi.check_body(request)
-    print(query)
     if query is False:
         return hiascdi.respond(
             400, hiascdi.confs["errorMessages"]["400p"],
@@ -561,7 +819,7 @@ def entityAttrPut(_id, _attr):
         typeof = request.args.get('type')
 
     return hiascdi.entities.update_entity_attributes_put(_id, _attr, typeof,
-                                                query, accepted)
+                                                query, False, accepted)
 
 @app.route('/entities/<_id>/attrs/<_attr>', methods=['DELETE'])
 def entityAttrDelete(_id,_attr):
@@ -660,6 +918,33 @@ def entityAttrsPutAttrValue(_id, _attr):
     return hiascdi.entities.update_entity_attributes_put(_id, _attr, typeof, query,
                                                 True, accepted, content_type)
 
+@app.route('/op/update', methods=['POST'])
+def batchUpdatePost():
+    """ Responds to POST requests sent to the /v1/op/update API endpoint. """
+
+    accepted, content_type = hiascdi.process_headers(request)
+    if accepted is False:
+        return hiascdi.respond(
+            406, hiascdi.confs["errorMessages"][str(406)],
+            "application/json")
+    if content_type is False:
+        return hiascdi.respond(
+            415, hiascdi.confs["errorMessages"][str(415)],
+            "application/json")
+
+    query = hiascdi.check_body(request)
+    if query is False:
+        return hiascdi.respond(
+            400, hiascdi.confs["errorMessages"]["400p"],
+            accepted)
+
+    if request.args.get('options') is None:
+        options = None
+    else:
+        options = request.args.get('options')
+
+    return hiascdi.batch.update(query, options, accepted)
+
 @app.route('/types', methods=['GET'])
 def typesGet():
     """ Responds to GET /v1/types """
@@ -854,23 +1139,92 @@ def subscriptionDelete(_subscription):
     return hiascdi.subscriptions.delete_subscription(
         _subscription, accepted)
 
-def main():
-    signal.signal(signal.SIGINT,
-                  hiascdi.signal_handler)
-    signal.signal(signal.SIGTERM,
-                  hiascdi.signal_handler)
+def life():
+    """ Starts the iotJumpWay connection and life statistics. """
 
     hiascdi.mqtt_connection()
+
+    Thread(target=hiascdi.life, args=(),
+           daemon=True).start()
+
+def configure():
+    """ Configures the HIASCDI modules. """
+
     hiascdi.mongodb_connection()
     hiascdi.hiascdi_connections()
+    hiascdi.configure_notifications()
     hiascdi.configure_entities()
     hiascdi.configure_types()
     hiascdi.configure_subscriptions()
+    hiascdi.configure_batch()
 
-    Thread(target=hiascdi.life, args=(),
-           daemon=True).start()
+def main():
+    workers = hiascdi.get_workers()
+
+    if workers > 1:
+        if hiascdi.confs["writeBehind"]["enabled"]:
+            # A worker only knows the attributes it wrote and only
+            # flushes its own buffer before reads
+            hiascdi.helpers.logger.warning(
+                "Write-behind is disabled with more than one worker process.")
+            hiascdi.confs["writeBehind"]["enabled"] = False
+
+        if hiascdi.confs["cache"]["enabled"]:
+            # Writes only invalidate the caches of their own worker
+            hiascdi.helpers.logger.warning(
+                "The response and count caches are disabled with more than one worker process.")
+            hiascdi.confs["cache"]["enabled"] = False
+
+        master = prefork(hiascdi.helpers, workers)
+
+        def worker(sock, number):
+            # Workers forked after the master started ingesting must
+            # not write its buffered telemetry
+            hiascdi.ingest = None
+            # MongoDB clients are not fork safe, so each worker
+            # connects after the fork
+            configure()
+            if hiascdi.metrics is not None:
+                hiascdi.metrics.share(number, hiascdi.get_families)
+            if hiascdi.confs["asgi"]["enabled"]:
+                asgi(hiascdi.helpers, app).serve(
+                    hiascdi.ip, hiascdi.port, fd=sock.fileno(),
+                    requests=master.get_limit())
+            else:
+                master.serve(app, sock)
+            hiascdi.stop()
+
+        def telemetry():
+            # Only the master connects to the iotJumpWay, so the
+            # client id is used once, and it ingests the telemetry,
+            # notifying the subscriptions of the ingested attributes
+            life()
+            if hiascdi.confs["ingest"]["enabled"]:
+                hiascdi.mongodb_connection()
+                hiascdi.hiascdi_connections()
+                hiascdi.configure_notifications()
+                hiascdi.configure_ingest()
+
+        if hiascdi.metrics is not None:
+            hiascdi.metrics.clear()
+
+        master.run(hiascdi.ip, hiascdi.port, worker, telemetry,
+                   hiascdi.stop)
+        return
 
-    app.run(host=hiascdi.ip, port=hiascdi.port)
+    signal.signal(signal.SIGINT,
+                  hiascdi.signal_handler)
+    signal.signal(signal.SIGTERM,
+                  hiascdi.signal_handler)
+
+    life()
+    configure()
+    hiascdi.configure_ingest()
+
+    if hiascdi.confs["asgi"]["enabled"]:
+        asgi(hiascdi.helpers, app).serve(hiascdi.ip, hiascdi.port)
+    else:
+        app.run(host=hiascdi.ip, port=hiascdi.port)
 
 if __name__ == "__main__":
     main()
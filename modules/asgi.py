@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+""" HIASCDI ASGI Module.
+
+This module serves the HIASCDI API on an ASGI server, keeping
+client connections on an event loop.
+
+MIT License
+
+Copyright (c) 2021 Asociación de Investigacion en Inteligencia Artificial
+Para la Leucemia Peter Moss
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files(the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and / or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+Contributors:
+- Adam Milton-Barker
+
+"""
+
+import sys
+
+try:
+    import uvicorn
+except ImportError:
+    uvicorn = None
+
+try:
+    from a2wsgi import WSGIMiddleware
+except ImportError:
+    WSGIMiddleware = None
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+class asgi():
+    """ HIASCDI ASGI Module.
+
+    This module serves the HIASCDI API on an ASGI server, keeping
+    client connections on an event loop.
+
+    Connections, keep-alive and request bodies are handled on the
+    event loop, and the Flask application is bridged to it by the
+    a2wsgi WSGI middleware. The Flask routes and the synchronous
+    MongoDB calls they make run on a bounded pool of threads, so a
+    slow query holds one thread and never the event loop.
+    """
+
+    def __init__(self, helpers, app):
+        """ Initializes the class. """
+
+        self.helpers = helpers
+        self.logger = self.helpers.get_logger("asgi")
+        self.program = "HIASCDI ASGI Module"
+
+        self.app = app
+        self.confs = self.helpers.confs["asgi"]
+
+        self.wsgi = None
+        if WSGIMiddleware is not None:
+            self.wsgi = WSGIMiddleware(self.app, workers=self.confs["workers"])
+
+        self.logger.info(
+            self.program + " initialization complete.")
+
+    def serve(self, host, port, fd=None, requests=0):
+        """ Serves the API with uvicorn.
+
+        In a pre-fork worker the API is served on the listening
+        socket fd, and the worker exits after serving requests
+        requests when requests is not 0.
+        """
+
+        if uvicorn is None or self.wsgi is None:
+            self.logger.error(self.program \
+                + " requires uvicorn and a2wsgi, install them or disable asgi.")
+            sys.exit(1)
+
+        loop = "asyncio"
+        if self.confs["uvloop"] and uvloop is not None:
+            loop = "uvloop"
+
+        self.logger.info(
+            self.program + " serving on " + str(host) + ":" + str(port) \
+                + " with the " + loop + " event loop.")
+
+        uvicorn.run(self, host=host, port=port, fd=fd, loop=loop,
+                    backlog=self.confs["backlog"],
+                    timeout_keep_alive=self.confs["keepAlive"],
+                    limit_concurrency=self.confs["concurrency"] or None,
+                    limit_max_requests=requests or None,
+                    lifespan="on", log_config=None)
+
+    async def __call__(self, scope, receive, send):
+        """ Handles an ASGI connection. """
+
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self.wsgi(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        """ Handles the ASGI lifespan messages. """
+
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await send({"type": "lifespan.shutdown.complete"})
+                return
@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+""" HIASCDI Batch Operations Module.
+
+This module provides the functionality to create, update, replace
+and delete multiple HIASCDI entities in a single request.
+
+MIT License
+
+Copyright (c) 2021 Asociación de Investigacion en Inteligencia Artificial
+Para la Leucemia Peter Moss
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files(the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and / or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+Contributors:
+- Adam Milton-Barker
+
+"""
+
+from pymongo import DeleteOne, InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError
+
+class batch():
+    """ HIASCDI Batch Operations Module.
+
+    This module provides the functionality to create, update, replace
+    and delete multiple HIASCDI entities in a single request.
+    """
+
+    def __init__(self, helpers, mongodb, broker, entities):
+        """ Initializes the class. """
+
+        self.helpers = helpers
+        self.logger = self.helpers.get_logger("batch")
+        self.program = "HIASCDI Batch Operations Module"
+
+        self.mongodb = mongodb
+        self.broker = broker
+        self.entities = entities
+
+        self.actions = [
+            "append",
+            "appendStrict",
+            "update",
+            "replace",
+            "delete"
+        ]
+
+        self.builtins = [
+            "id",
+            "type"
+        ]
+
+        self.logger.info(
+            self.program + " initialization complete.")
+
+    def update(self, data, options, accepted=[]):
+        """ Updates multiple HIASCDI Entities.
+
+        All of the entity operations in the request are sent to
+        MongoDB as a single unordered bulk write. Entities that
+        cannot be processed are reported in the response payload.
+
+        References:
+            FIWARE-NGSI v2 Specification
+            https://fiware.github.io/specifications/ngsiv2/stable/
+
+            Reference
+                - Batch Operations
+                    - Update
+        """
+
+        _keyValues = False
+
+        if options is not None:
+            options = options.split(",")
+            for option in options:
+                _keyValues = True if option == "keyValues" else _keyValues
+
+        if not isinstance(data, dict) \
+                or data.get("actionType") not in self.actions \
+                or not isinstance(data.get("entities"), list) \
+                or not len(data["entities"]):
+            return self.broker.respond(
+                400, self.helpers.confs["errorMessages"]["400p"],
+                {}, False, accepted)
+
+        action = data["actionType"]
+
+        for entity in data["entities"]:
+            if not isinstance(entity, dict) or "id" not in entity:
+                return self.broker.respond(
+                    400, self.helpers.confs["errorMessages"]["400p"],
+                    {}, False, accepted)
+
+        existing = self.get_existing(data["entities"])
+
+        operations = []
+        operated = []
+        # Stored type and changed attributes of each operated entity
+        changes = []
+        errors = []
+
+        for entity in data["entities"]:
+            attrs = self.get_attributes(entity, _keyValues)
+            found = [e for e in existing.get(entity["id"], [])
+                     if "type" not in entity or e.get("type") == entity["type"]]
+
+            if len(found) > 1:
+                errors.append(self.error(entity, "409"))
+                continue
+
+            current = found[0] if len(found) else None
+
+            if current is None:
+                if action in ["append", "appendStrict"]:
+                    new = self.get_new_entity(entity, attrs)
+                    operations.append(InsertOne(new))
+                    operated.append(entity)
+                    changes.append((new["type"], list(attrs)))
+                else:
+                    errors.append(self.error(entity, "404"))
+                continue
+
+            query = {"id": current["id"], "type": current["type"]}
+
+            if action == "append":
+                if not len(attrs):
+                    continue
+                operations.append(UpdateOne(query, {"$set": attrs}))
+            elif action == "appendStrict":
+                existing_attrs = [a for a in attrs if a in current["attrs"]]
+                if len(existing_attrs):
+                    errors.append(self.error(entity, "400p", existing_attrs))
+                    continue
+                if not len(attrs):
+                    continue
+                query.update({a: {"$exists": False} for a in attrs})
+                operations.append(UpdateOne(query, {"$set": attrs}))
+            elif action == "update":
+                missing_attrs = [a for a in attrs if a not in current["attrs"]]
+                if len(missing_attrs):
+                    errors.append(self.error(entity, "404", missing_attrs))
+                    continue
+                if not len(attrs):
+                    continue
+                query.update({a: {"$exists": True} for a in attrs})
+                operations.append(UpdateOne(query, {"$set": attrs}))
+            elif action == "replace":
+                operations.append(UpdateOne(
+                    query, self.entities.get_replacement(attrs)))
+            elif action == "delete":
+                if not len(attrs):
+                    operations.append(DeleteOne(query))
+                else:
+                    missing_attrs = [a for a in attrs if a not in current["attrs"]]
+                    if len(missing_attrs):
+                        errors.append(self.error(entity, "404", missing_attrs))
+                        continue
+                    operations.append(UpdateOne(
+                        query, {"$unset": {a: "" for a in attrs}}))
+            operated.append(entity)
+
+            if action == "delete" and not len(attrs):
+                changed = None
+            elif action == "replace":
+                # Removed attributes changed too
+                changed = list(attrs) + [a for a in current["attrs"]
+                                         if a not in attrs]
+            else:
+                changed = list(attrs)
+            changes.append((current["type"], changed))
+
+        if len(operations):
+            # Repeated entities must be applied in request order
+            ids = [entity["id"] for entity in operated]
+            ordered = len(ids) != len(set(ids))
+
+            failed = []
+            # Buffered attribute updates must not overwrite the batch
+            self.entities.writebehind.flush()
+            if action in ["replace", "delete"]:
+                # Removed attributes are no longer known to exist
+                for _id in set(ids):
+                    self.entities.writebehind.forget(_id)
+
+            # Batch deletes are as durable as single deletes
+            collection = self.mongodb.writer(
+                "Entities", "delete" if action == "delete" else "batch",
+                tier=self.broker.get_write_concern())
+            try:
+                with self.mongodb.session() as session:
+                    collection.bulk_write(
+                        operations, ordered=ordered, session=session)
+            except BulkWriteError as e:
+                for werror in e.details.get("writeErrors", []):
+                    failed.append(werror["index"])
+                    self.logger.info(
+                        "%s bulk write error: %s", self.program, werror["errmsg"])
+                if ordered and len(failed):
+                    # Ordered writes stop at the first error
+                    failed = list(range(min(failed), len(operated)))
+                for i in failed:
+                    errors.append(self.error(operated[i], "400b"))
+
+            for i, entity in enumerate(operated):
+                if i in failed:
+                    continue
+                typeof, attrs = changes[i]
+                self.entities.changed(entity["id"], typeof, attrs)
+
+        if len(errors):
+            self.logger.info(
+                "%s 422: %d of %d entities failed", self.program,
+                len(errors), len(data["entities"]))
+
+            response = dict(self.helpers.confs["errorMessages"][str(422)])
+            response["Entities"] = errors
+
+            return self.broker.respond(422, response, {}, False, accepted)
+
+        self.logger.info(
+            "%s 204: %s", self.program,
+            self.helpers.confs["successMessage"][str(204)]["Description"])
+
+        return self.broker.respond(
+            204, self.helpers.confs["successMessage"][str(204)],
+            {}, False, accepted)
+
+    def get_existing(self, entities):
+        """ Gets the stored state of the requested entities.
+
+        Only the ids, types and the names of the attributes are
+        fetched, not their values, all in a single query.
+        """
+
+        ids = list(set([entity["id"] for entity in entities]))
+
+        existing = {}
+        for entity in self.mongodb.collections["Entities"].aggregate([
+                {"$match": {"id": {"$in": ids}}},
+                {"$project": {
+                    "_id": False,
+                    "id": True,
+                    "type": True,
+                    "attrs": {"$map": {
+                        "input": {"$objectToArray": "$$ROOT"},
+                        "as": "field",
+                        "in": "$$field.k"
+                    }}
+                }}]):
+            entity["attrs"] = [attr for attr in entity["attrs"]
+                               if attr not in self.entities.builtins]
+            existing.setdefault(entity["id"], []).append(entity)
+
+        return existing
+
+    def get_attributes(self, entity, keyValues=False):
+        """ Gets the attributes of a request entity. """
+
+        attrs = {}
+        for attr in entity:
+            if attr in self.builtins:
+                continue
+            if keyValues:
+                attrs.update({attr: {"value": entity[attr]}})
+            else:
+                attrs.update({attr: entity[attr]})
+
+        return attrs
+
+    def get_new_entity(self, entity, attrs):
+        """ Builds a new entity document. """
+
+        typeof = entity.get("type")
+        if typeof not in self.mongodb.collextions:
+            typeof = "Thing"
+
+        data = {"id": entity["id"], "type": typeof}
+        data.update(attrs)
+
+        return data
+
+    def error(self, entity, code, attrs=None):
+        """ Builds the error details for an entity. """
+
+        error = {
+            "id": entity["id"],
+            "Error": self.helpers.confs["errorMessages"][code]["Error"],
+            "Description": self.helpers.confs["errorMessages"][code]["Description"]
+        }
+
+        if "type" in entity:
+            error["type"] = entity["type"]
+
+        if attrs is not None:
+            error["attrs"] = attrs
+
+        return error
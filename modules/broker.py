@@ -37,7 +37,15 @@ import requests
 import pandas as pd
 
 from bson import json_util, ObjectId
-from flask import Response
+from flask import Response, has_request_context, request
+
+from modules.planner import planner
+from modules.query import query
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 class broker():
     """ HIASCDI Context Broker Module.
@@ -49,15 +57,26 @@ class broker():
         """ Initializes the class. """
 
         self.helpers = helpers
+        self.logger = self.helpers.get_logger("broker")
         self.program = "HIASCDI Helper Module"
 
         self.mongodb = mongodb
+        self.query = query(self.helpers)
+        self.planner = planner(self.helpers)
 
         self.headers = {
             "content-type": self.helpers.confs["contentType"]
         }
 
-        self.helpers.logger.info("HIASCDI initialization complete.")
+        # Serializes the configured messages once. The message
+        # objects live as long as the configuration, so their
+        # ids are stable keys.
+        self.encoded = {}
+        for messages in ["errorMessages", "successMessage"]:
+            for message in self.helpers.confs[messages].values():
+                self.encoded[id(message)] = self.encode(message)
+
+        self.logger.info("HIASCDI initialization complete.")
 
     def check_accepts_type(self, headers):
         """ Checks the request Accept types. """
@@ -108,7 +127,7 @@ class broker():
             else:
                 response = payload.data
 
-        self.helpers.logger.info("Request data " + message)
+        self.logger.debug("Request data %s", message)
 
         return response
 
@@ -146,21 +165,81 @@ class broker():
 
         return val
 
+    def default(self, value):
+        """ Converts values the JSON encoders do not support.
+
+        Cursors and other iterables become lists, BSON types use
+        their MongoDB Extended JSON form.
+        """
+
+        if hasattr(value, "__iter__") and not isinstance(
+                value, (str, bytes, dict)):
+            return list(value)
+
+        return json_util.default(value)
+
+    def encode(self, response, pretty=False):
+        """ Serializes a response to JSON bytes in a single pass.
+
+        Uses orjson when installed. Output is compact unless
+        pretty printing is requested.
+        """
+
+        if pretty:
+            return json.dumps(response, default=self.default,
+                              indent=4).encode("utf-8")
+
+        if orjson is not None:
+            return orjson.dumps(response, default=self.default,
+                                option=orjson.OPT_PASSTHROUGH_DATETIME)
+
+        return json.dumps(response, default=self.default,
+                          separators=(",", ":")).encode("utf-8")
+
+    def is_pretty(self):
+        """ Checks if the request asked for pretty printed JSON. """
+
+        if not has_request_context():
+            return False
+
+        options = request.args.get("options")
+
+        return options is not None and "pretty" in options.split(",")
+
+    def get_write_concern(self):
+        """ Gets the write concern tier requested by the request. """
+
+        if not has_request_context():
+            return None
+
+        return request.headers.get(
+            self.helpers.confs["writeConcern"]["header"])
+
+    def encode_response(self, response):
+        """ Serializes a response, reusing the encoded messages. """
+
+        pretty = self.is_pretty()
+
+        if not pretty and id(response) in self.encoded:
+            return self.encoded[id(response)]
+
+        return self.encode(response, pretty)
+
     def prepare_response(self, response):
         """ Converts response to bytes. """
 
         if isinstance(response, dict):
-            response = json.dumps(response)
+            response = self.encode_response(response)
         elif isinstance(response, list):
-            response = json.dumps(response)
+            response = self.encode_response(response)
+        elif isinstance(response, bool):
+            response = str(response).lower().encode(encoding='UTF-8')
         elif isinstance(response, int):
             response = str(response).encode(encoding='UTF-8')
         elif isinstance(response, float):
             response = str(response).encode(encoding='UTF-8')
         elif isinstance(response, str):
             response = response.encode(encoding='UTF-8')
-        elif isinstance(response, bool):
-            response = response.encode(encoding='UTF-8')
 
         return response
 
@@ -168,6 +247,8 @@ class broker():
                 override = False, accepted = []):
         """ Builds the request repsonse """
 
+        headers = dict(headers)
+
         return_as = "json"
         if override != False:
             if override == "application/json":
@@ -182,18 +263,18 @@ class broker():
 
         if return_as == "json":
             response =  Response(
-                response=json.dumps(json.loads(
-                    json_util.dumps(response)), indent=4),
+                response=self.encode_response(response),
                 status=responseCode, mimetype="application/json")
             headers['Content-Type'] = 'application/json'
         elif return_as == "text":
             if "text/plain" not in accepted:
                 response = Response(
-                    response=self.helpers.confs["errorMessages"]["400b"],
+                    response=self.encoded[id(
+                        self.helpers.confs["errorMessages"]["400b"])],
                     status=400, mimetype="application/json")
                 headers['Content-Type'] = 'application/json'
             else:
-                response = self.broker.prepare_response(response)
+                response = self.prepare_response(response)
                 response = Response(response=response,
                                     status=responseCode,
                                     mimetype="text/plain")
@@ -202,3 +283,34 @@ class broker():
 
         return response
 
+    def stream(self, responseCode, response, headers={}):
+        """ Builds a chunked JSON array response from an iterable.
+
+        Items are serialized as they are consumed and sent in
+        chunks of roughly the configured size.
+        """
+
+        pretty = self.is_pretty()
+        size = self.helpers.confs["streaming"]["chunkSize"]
+
+        def generate():
+            chunk = [b"["]
+            length = 1
+            for i, item in enumerate(response):
+                if i:
+                    chunk.append(b",")
+                encoded = self.encode(item, pretty)
+                chunk.append(encoded)
+                length += len(encoded) + 1
+                if length >= size:
+                    yield b"".join(chunk)
+                    chunk = []
+                    length = 0
+            chunk.append(b"]")
+            yield b"".join(chunk)
+
+        headers = dict(headers)
+        headers['Content-Type'] = 'application/json'
+
+        return Response(response=generate(), status=responseCode,
+                        headers=headers)
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+""" HIASCDI Cache Module.
+
+This module provides a bounded, in-process LRU cache with
+expiring entries and tag based invalidation.
+
+MIT License
+
+Copyright (c) 2021 Asociación de Investigacion en Inteligencia Artificial
+Para la Leucemia Peter Moss
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files(the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and / or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+Contributors:
+- Adam Milton-Barker
+
+"""
+
+import threading
+import time
+
+from collections import OrderedDict
+
+class cache():
+    """ HIASCDI Cache Module.
+
+    This module provides a bounded, in-process LRU cache with
+    expiring entries and tag based invalidation.
+
+    Each invalidation advances the generation of its tag. A value
+    read before an invalidation is not cached after it, as the
+    generation it was read at is no longer current. Generations are
+    kept in a fixed number of slots shared by tags, so a tag may be
+    seen as invalidated when another tag was.
+    """
+
+    def __init__(self, size, ttl):
+        """ Initializes the class. """
+
+        self.size = size
+        self.ttl = ttl
+
+        self.entries = OrderedDict()
+        self.tags = {}
+        self.generations = [0] * max(size, 1)
+        self.lock = threading.Lock()
+
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "invalidations": 0
+        }
+
+    def get(self, key):
+        """ Gets a cached value, or None if missing or expired. """
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+
+            expires, tag, value = entry
+            if expires < time.monotonic():
+                self.remove(key)
+                self.stats["misses"] += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.stats["hits"] += 1
+
+            return value
+
+    def generation(self, tag):
+        """ Gets the generation of a tag, to cache a value read now. """
+
+        with self.lock:
+            return self.generations[hash(tag) % len(self.generations)]
+
+    def set(self, key, value, tag=None, generation=None):
+        """ Caches a value, evicting the least recently used.
+
+        The value is not cached when the tag was invalidated since
+        generation.
+        """
+
+        with self.lock:
+            if generation is not None and generation \
+                    != self.generations[hash(tag) % len(self.generations)]:
+                return
+
+            if key in self.entries:
+                self.remove(key)
+
+            self.entries[key] = (time.monotonic() + self.ttl, tag, value)
+            if tag is not None:
+                self.tags.setdefault(tag, set()).add(key)
+
+            while len(self.entries) > self.size:
+                self.remove(next(iter(self.entries)))
+                self.stats["evictions"] += 1
+
+    def invalidate(self, tag):
+        """ Removes all of the values cached with a tag. """
+
+        with self.lock:
+            self.generations[hash(tag) % len(self.generations)] += 1
+            for key in self.tags.pop(tag, ()):
+                self.entries.pop(key, None)
+                self.stats["invalidations"] += 1
+
+    def clear(self):
+        """ Removes all of the cached values. """
+
+        with self.lock:
+            self.entries.clear()
+            self.tags.clear()
+
+    def remove(self, key):
+        """ Removes a cached value. Must hold the lock. """
+
+        expires, tag, value = self.entries.pop(key)
+        if tag is not None and tag in self.tags:
+            self.tags[tag].discard(key)
+            if not len(self.tags[tag]):
+                del self.tags[tag]
@@ -32,14 +32,20 @@ Contributors:
 
 """
 
+import itertools
 import json
 import jsonpickle
 import os
 import sys
 
+from flask import Response
 from mgoquery import Parser
+from pymongo.errors import DuplicateKeyError, ExecutionTimeout, WriteError
 
-from modules.subscriptions import subscriptions
+from modules.cache import cache
+from modules.pagination import pagination
+from modules.representations import representations
+from modules.writebehind import writebehind
 
 class entities():
     """ HIASCDI Entities Module.
@@ -48,19 +54,45 @@ class entities():
     and update HIASCDI entities.
     """
 
-    def __init__(self, helpers, mongodb, broker):
+    # MongoDB errors of values an index cannot hold, i.e. a location
+    # that is not GeoJSON
+    unindexable = [16755]
+
+    def __init__(self, helpers, mongodb, broker, notifications=None):
         """ Initializes the class. """
 
         self.helpers = helpers
+        self.logger = self.helpers.get_logger("entities")
         self.program = "HIASCDI Entities Module"
 
         self.mongodb = mongodb
         self.broker = broker
-
-        self.subscriptions = subscriptions(
-            self.helpers, self.mongodb, self.broker)
-
-        self.helpers.logger.info(
+        self.notifications = notifications
+
+        self.builtins = [
+            "_id",
+            "id",
+            "type",
+            "dateCreated",
+            "dateModified",
+            "dateExpired"
+        ]
+
+        self.pagination = pagination(self.helpers)
+        self.representations = representations(self.helpers, self.broker)
+
+        # Caches serialized single entity responses
+        self.cache = None
+        if self.helpers.confs["cache"]["enabled"]:
+            self.cache = cache(self.helpers.confs["cache"]["size"],
+                               self.helpers.confs["cache"]["ttl"])
+
+        # Buffers attribute updates when write-behind is enabled
+        self.writebehind = writebehind(self.helpers, self.mongodb,
+                                       self.changed)
+        self.writebehind.start()
+
+        self.logger.info(
             self.program + " initialization complete.")
 
     def get_entities(self, arguments, accepted=[]):
@@ -111,18 +143,10 @@ class entities():
 
         if arguments.get('type') is not None:
             # Sets a type query
-            eor = []
             types = arguments.get('type').split(",")
-            if len(types) == 1:
-                query.update({"type":
-                    {'$in': [types[0]]}
-                })
-            else:
-                for eid in types:
-                    eor.append({"type":
-                        {'$in': [eid]}
-                    })
-                params.append({"$or": eor})
+            query.update({"type":
+                {'$in': types}
+            })
         elif arguments.get('typePattern') is not None:
             query.update({"type":
                 {'$regex': arguments.get('typePattern')}
@@ -130,18 +154,10 @@ class entities():
 
         if arguments.get('id') is not None:
             # Sets a id query
-            eor = []
             ids = arguments.get('id').split(",")
-            if len(ids) == 1:
-                query.update({"id":
-                    {'$in': [ids[0]]}
-                })
-            else:
-                for eid in ids:
-                    eor.append({"id":
-                        {'$in': [eid]}
-                    })
-                params.append({"$or": eor})
+            query.update({"id":
+                {'$in': ids}
+            })
         elif arguments.get('idPattern') is not None:
             query.update({"id":
                 {'$regex': arguments.get('idPattern')}
@@ -149,18 +165,10 @@ class entities():
 
         if arguments.get('category') is not None:
             # Sets a category query
-            eor = []
             categories = arguments.get('category').split(",")
-            if len(categories) == 1:
-                query.update({"category.value":
-                    {'$in': [categories[0]]}
-                })
-            else:
-                for category in categories:
-                    eor.append({"category.value":
-                        {'$in': [category]}
-                    })
-                params.append({"$or": eor})
+            query.update({"category.value":
+                {'$in': categories}
+            })
 
         attribs = []
         if arguments.get('attrs') is not None:
@@ -194,132 +202,24 @@ class entities():
                 for attr in mattribs:
                     fields.update({attr: True})
 
-        if arguments.get('q') is not None:
-            # Sets a q query
-            qs = arguments.get('q').split(";")
-            for q in qs:
-                if "||" in q:
-                    qor = q.split("||")
-                    ors = {}
-                    for qori in qor:
-                        if "==" in qori:
-                            qp = qori.split("==")
-                            ors.update({qp[0]:
-                                {'$in': [self.broker.cast(qp[1])]}
-                            })
-                        elif  ":" in qori:
-                            qp = qori.split(":")
-                            ors.update({qp[0]:
-                                {'$in': [self.broker.cast(qp[1])]}
-                            })
-                        elif "!=" in qori:
-                            qp = qori.split("!=")
-                            ors.update({qp[0]:
-                                {'$ne': self.broker.cast(qp[1])}
-                            })
-                        elif ">=" in qori:
-                            qp = qori.split(">=")
-                            ors.update({qp[0]:
-                                {'$gte': self.broker.cast(qp[1])}
-                            })
-                        elif "<=" in qori:
-                            qp = qori.split("<=")
-                            ors.update({qp[0]:
-                                {'$lte': self.broker.cast(qp[1])}
-                            })
-                        elif "<" in qori:
-                            qp = qori.split("<")
-                            ors.update({qp[0]:
-                                {'$lt': self.broker.cast(qp[1])}
-                            })
-                        elif ">" in qori:
-                            qp = qori.split(">")
-                            ors.update({qp[0]:
-                                {'$gt': self.broker.cast(qp[1])}
-                            })
-
-                        query.update({'$or': ors })
-
-                elif "==" in q:
-                    qp = q.split("==")
-                    query.update({qp[0]:
-                        {'$in': [self.broker.cast(qp[1])]}
-                    })
-                elif  ":" in q:
-                    qp = q.split(":")
-                    query.update({qp[0]:
-                        {'$in': [self.broker.cast(qp[1])]}
-                    })
-                elif "!=" in q:
-                    qp = q.split("!=")
-                    query.update({qp[0]:
-                        {'$ne': self.broker.cast(qp[1])}
-                    })
-                elif ">=" in q:
-                    qp = q.split(">=")
-                    query.update({qp[0]:
-                        {'$gte': self.broker.cast(qp[1])}
-                    })
-                elif "<=" in q:
-                    qp = q.split("<=")
-                    query.update({qp[0]:
-                        {'$lte': self.broker.cast(qp[1])}
-                    })
-                elif "<" in q:
-                    qp = q.split("<")
-                    query.update({qp[0]:
-                        {'$lt': self.broker.cast(qp[1])}
-                    })
-                elif ">" in q:
-                    qp = q.split(">")
-                    query.update({qp[0]:
-                        {'$gt': self.broker.cast(qp[1])}
-                    })
-
-        elif arguments.get('mq') is not None:
-            # Sets an mq query
-            qs = arguments.get('mq').split(";")
-            for q in qs:
-                if "==" in q:
-                    qp = q.split("==")
-                    query.update({qp[0]:
-                        {'$in': [self.broker.cast(qp[1])]}
-                    })
-                elif  ":" in q:
-                    qp = q.split(":")
-                    query.update({qp[0]:
-                        {'$in': [self.broker.cast(qp[1])]}
-                    })
-                elif "!=" in q:
-                    qp = q.split("!=")
-                    query.update({qp[0]:
-                        {'$ne': self.broker.cast(qp[1])}
-                    })
-                elif ">=" in q:
-                    qp = q.split(">=")
-                    query.update({qp[0]:
-                        {'$gte': self.broker.cast(qp[1])}
-                    })
-                elif "<=" in q:
-                    qp = q.split("<=")
-                    query.update({qp[0]:
-                        {'$lte': self.broker.cast(qp[1])}
-                    })
-                elif "<" in q:
-                    qp = q.split("<")
-                    query.update({qp[0]:
-                        {'$lt': self.broker.cast(qp[1])}
-                    })
-                elif ">" in q:
-                    qp = q.split(">")
-                    query.update({qp[0]:
-                        {'$gt': self.broker.cast(qp[1])}
-                    })
+        for param in ["q", "mq"]:
+            if arguments.get(param) is not None:
+                # Sets a q or mq query
+                try:
+                    qfilter, predicate = self.broker.query.compile(
+                        arguments.get(param))
+                except ValueError as e:
+                    self.logger.info(
+                        "%s invalid %s: %s", self.program, param, e)
+                    return self.broker.respond(
+                        400, self.helpers.confs["errorMessages"]["400p"],
+                        {}, False, accepted)
+                params.append(qfilter)
 
         # Sets a geospatial query
         if arguments.get('georel') is not None and \
-                + arguments.get('geometry') is not None and \
-                + arguments.get('coords') is not None:
+                arguments.get('geometry') is not None and \
+                arguments.get('coords') is not None:
             georels = arguments.get('georel').split(";")
             georelslen = len(georels)
             coords = arguments.get('coords').split(";")
@@ -442,6 +342,15 @@ class entities():
         if len(params):
             query.update({"$and": params})
 
+        try:
+            query = self.broker.planner.plan(query)
+        except ValueError as e:
+            self.logger.info(
+                "%s query rejected: %s", self.program, e)
+            return self.broker.respond(
+                400, self.helpers.confs["errorMessages"]["400p"],
+                {}, False, accepted)
+
         # Sets the query ordering
         if arguments.get('orderBy') is not None:
             orders = arguments.get('orderBy').split(",")
@@ -453,108 +362,121 @@ class entities():
                     orderBy = 1
                 sort.append((order, orderBy))
 
-        # Prepares the offset
-        if arguments.get('offset') is None:
-            offset = False
-        else:
-            offset = int(arguments.get('offset'))
+        # Simplified representations are built by MongoDB
+        pipeline = self.representations.get_pipeline(
+            keyValues_opt, values_opt, unique_opt)
 
-        # Prepares the query limit
-        if arguments.get('limit') is None:
-            limit = 0
-        else:
-            limit = int(arguments.get('limit'))
+        # Streamed pages end the session once they are sent
+        session = self.mongodb.start_session()
 
         try:
             # Creates the full query
-            if len(sort) and offset:
-                entities = self.mongodb.mongoConn.Entities.find(
-                    query, fields).skip(offset).sort(sort).limit(limit)
-            elif offset:
-                entities = self.mongodb.mongoConn.Entities.find(
-                    query, fields).skip(offset).limit(limit)
-            elif len(sort):
-                entities = self.mongodb.mongoConn.Entities.find(
-                    query, fields).sort(sort).limit(limit)
+            if len(pipeline):
+                entities, page = self.pagination.find(
+                    self.mongodb.readers["Entities"], query, fields, sort,
+                    arguments, pipeline, session,
+                    **self.broker.planner.get_options(query))
             else:
-                entities= self.mongodb.mongoConn.Entities.find(
-                    query, fields).limit(limit)
+                entities, page = self.pagination.find(
+                    self.mongodb.readers["Entities"], query, fields, sort,
+                    arguments, session=session)
+                if entities is not None:
+                    entities = self.broker.planner.prepare(entities, query)
+
+            if entities is None:
+                return self.broker.respond(
+                    400, self.helpers.confs["errorMessages"]["400p"],
+                    {}, False, accepted)
+
+            self.mongodb.indexes.record("Entities", query, page["sort"])
 
             if count_opt:
                 # Sets count header
-                headers["Count"] = entities.count()
+                headers["Count"] = self.mongodb.count(
+                    self.mongodb.readers["Entities"], query, session)
+
+            if self.is_streamed(page["limit"], accepted):
+                entities = entities.batch_size(
+                    self.helpers.confs["streaming"]["batchSize"])
+
+                # The first entity decides between 200 and 404
+                first = next(entities, None)
+                if first is None:
+                    self.logger.info(
+                        "%s 404: %s", self.program,
+                        self.helpers.confs["errorMessages"][str(404)]["Description"])
+
+                    return self.broker.respond(
+                        404, self.helpers.confs["errorMessages"][str(404)],
+                        {}, False, accepted)
+
+                self.logger.info(
+                    "%s 200: %s", self.program,
+                    self.helpers.confs["successMessage"][str(200)]["Description"])
+
+                entities = self.pagination.finish_stream(
+                    self.mongodb.readers["Entities"], page,
+                    itertools.chain([first], entities), headers, arguments,
+                    session)
+
+                entities = self.mongodb.closing(self.representations.convert(
+                    entities, keyValues_opt, values_opt, unique_opt), session)
+                session = None
+
+                return self.broker.stream(200, entities, headers)
 
             entities = list(entities)
 
             if not len(entities):
-                self.helpers.logger.info(
-                    self.program + " 404: " \
-                        + self.helpers.confs["errorMessages"][str(404)]["Description"])
+                self.logger.info(
+                    "%s 404: %s", self.program,
+                    self.helpers.confs["errorMessages"][str(404)]["Description"])
 
                 return self.broker.respond(
                     404, self.helpers.confs["errorMessages"][str(404)],
                     {}, False, accepted)
             else:
+                entities = self.pagination.finish(
+                    page, entities, headers, arguments)
+                entities = list(self.representations.convert(
+                    entities, keyValues_opt, values_opt, unique_opt))
 
-                # Converts data to key -> value
-                if keyValues_opt:
-                    newData = []
-                    for i, entity in enumerate(entities):
-                        dataHolder = {}
-                        for attr in entity:
-                            if isinstance(entity[attr], str):
-                                dataHolder.update({attr: entity[attr]})
-                            if isinstance(entity[attr], dict):
-                                dataHolder.update({attr: entity[attr]["value"]})
-                            if isinstance(entity[attr], list):
-                                dataHolder.update({attr: entity[attr]})
-                        newData.append(dataHolder)
-                    entities = newData
-
-                # Converts data to values
-                elif values_opt:
-                    newData = []
-                    for i, entity in enumerate(entities):
-                        dataHolder = []
-                        for attr in entity:
-                            if isinstance(entity[attr], str):
-                                dataHolder.append(entity[attr])
-                            if isinstance(entity[attr], dict):
-                                dataHolder.append(entity[attr]["value"])
-                            if isinstance(entity[attr], list):
-                                dataHolder.append(entity[attr])
-                        newData.append(dataHolder)
-                    entities = newData
-
-                # Converts data to unique values
-                elif unique_opt:
-                    newData = []
-                    for i, entity in enumerate(entities):
-                        dataHolder = []
-                        for attr in entity:
-                            if isinstance(entity[attr], str):
-                                dataHolder.append(entity[attr])
-                            if isinstance(entity[attr], dict):
-                                dataHolder.append(entity[attr]["value"])
-                            if isinstance(entity[attr], list):
-                                dataHolder.append(entity[attr])
-                        [newData.append(x) for x in dataHolder if x not in newData]
-                    entities = newData
-
-                self.helpers.logger.info(
-                    self.program + " 200: " \
-                        + self.helpers.confs["successMessage"][str(200)]["Description"])
+                self.logger.info(
+                    "%s 200: %s", self.program,
+                    self.helpers.confs["successMessage"][str(200)]["Description"])
 
                 return self.broker.respond(200, entities, headers,
                                            False, accepted)
+        except ExecutionTimeout as e:
+            self.logger.info(
+                "%s 503: %s", self.program,
+                self.helpers.confs["errorMessages"][str(503)]["Description"])
+            self.logger.info(str(e))
+
+            return self.broker.respond(503, self.helpers.confs["errorMessages"][str(503)],
+                                {}, False, accepted)
         except Exception as e:
-            self.helpers.logger.info(
-                self.program + " 404: " \
-                    + self.helpers.confs["errorMessages"][str(404)]["Description"])
-            self.helpers.logger.info(str(e))
+            self.logger.info(
+                "%s 404: %s", self.program,
+                self.helpers.confs["errorMessages"][str(404)]["Description"])
+            self.logger.info(str(e))
 
             return self.broker.respond(404, self.helpers.confs["errorMessages"][str(404)],
                                 {}, False, accepted)
+        finally:
+            self.mongodb.end_session(session)
+
+    def is_streamed(self, limit, accepted=[]):
+        """ Checks if an entity listing should be streamed.
+
+        Unbounded and large JSON listings are streamed from the
+        cursor instead of being loaded into memory.
+        """
+
+        streaming = self.helpers.confs["streaming"]
+
+        return streaming["enabled"] and "application/json" in accepted \
+            and (limit == 0 or limit >= streaming["threshold"])
 
     def create_entity(self, data, accepted=[]):
         """ Creates a new HIASCDI Entity.
@@ -571,8 +493,15 @@ class entities():
         if data["type"] not in self.mongodb.collextions:
             data["type"] = "Thing"
 
-        _id = self.mongodb.mongoConn.Entities.insert(data)
-        if str(_id) is not False:
+        try:
+            with self.mongodb.session() as session:
+                result = self.get_writer(
+                    "create", data["type"]).insert_one(data, session=session)
+        except WriteError as e:
+            return self.rejected_response(e, accepted)
+        if result.inserted_id is not None:
+            self.changed(data["id"], data["type"],
+                         [attr for attr in data if attr not in self.builtins])
             return self.broker.respond(
                 201, {}, {"Location": "v1/entities/" \
                           + data["id"] + "?type=" + data["type"]},
@@ -596,18 +525,15 @@ class entities():
                         - Retrieve Entity / Retrieve Entity Attributes
         """
 
-        keyValues_opt = False
-        count_opt = False
-        values_opt = False
-        unique_opt = False
+        key = ("entity", _id, typeof, attrs, options, metadata,
+               attributes, tuple(accepted))
+        response = self.get_cached_response(key)
+        if response is not None:
+            return response
 
         # Processes the options parameter
-        if options is not None:
-            options = options.split(",")
-            for option in options:
-                keyValues_opt = True if option == "keyValues" else keyValues_opt
-                values_opt = True if option == "values" else values_opt
-                unique_opt = True if option == "unique" else unique_opt
+        keyValues_opt, values_opt, unique_opt = \
+            self.representations.get_options(options)
 
         query = {'id': _id}
 
@@ -651,20 +577,42 @@ class entities():
         if typeof is not None:
             query.update({"type": typeof})
 
-        entity = list(self.mongodb.mongoConn.Entities.find(query, fields))
+        # Builtins that were not requested
+        exclude = []
+        if clear_builtin:
+            exclude += [attr for attr in ["dateCreated", "dateModified",
+                "dateExpired"] if attr not in attribs]
+        if attributes:
+            exclude += [attr for attr in ["id", "type"] if attr not in attribs]
+
+        pipeline = self.representations.get_pipeline(
+            keyValues_opt, values_opt, unique_opt, exclude)
+
+        # Buffered updates of the entity are written first
+        self.writebehind.flush(_id)
+        generation = self.get_generation(_id)
+
+        with self.mongodb.session() as session:
+            if len(pipeline):
+                entity = list(self.mongodb.readers["Entities"].aggregate([
+                    {"$match": query}, {"$limit": 2}, {"$project": fields}
+                ] + pipeline, session=session))
+            else:
+                entity = list(self.mongodb.readers["Entities"].find(
+                    query, fields, session=session).limit(2))
 
         if not entity:
-            self.helpers.logger.info(
-                self.program + " 404: " \
-                    + self.helpers.confs["errorMessages"][str(404)]["Description"])
+            self.logger.info(
+                "%s 404: %s", self.program,
+                self.helpers.confs["errorMessages"][str(404)]["Description"])
 
             return self.broker.respond(
                 404, self.helpers.confs["errorMessages"][str(404)],
                 {}, False, accepted)
         elif len(entity) > 1:
-            self.helpers.logger.info(
-                self.program + " 409: " \
-                    + self.helpers.confs["errorMessages"][str(409)]["Description"])
+            self.logger.info(
+                "%s 409: %s", self.program,
+                self.helpers.confs["errorMessages"][str(409)]["Description"])
 
             return self.broker.respond(
                 409, self.helpers.confs["errorMessages"][str(409)],
@@ -672,64 +620,22 @@ class entities():
         else:
             data = entity[0]
 
-            if keyValues_opt:
-                newData = {}
-                # Converts data to key -> value
-                for attr in list(data):
-                    if isinstance(data[attr], str):
-                        newData.update({attr: data[attr]})
-                    if isinstance(data[attr], dict):
-                        newData.update({attr: data[attr]["value"]})
-                    if isinstance(data[attr], list):
-                        newData.update({attr: data[attr]})
-                data = newData
-
-            elif values_opt:
-                newData = []
-                # Converts data to values
-                for attr in list(data):
-                    if isinstance(data[attr], str):
-                        newData.append(data[attr])
-                    if isinstance(data[attr], dict):
-                        newData.append(data[attr]["value"])
-                    if isinstance(data[attr], list):
-                        newData.append(data[attr])
-                data = newData
-
-            elif unique_opt:
-                newData = []
-                # Converts data to unique values
-                for attr in list(data):
-                    if isinstance(data[attr], str):
-                        newData.append(data[attr])
-                    if isinstance(data[attr], dict):
-                        newData.append(data[attr]["value"])
-                    if isinstance(data[attr], list):
-                        newData.append(data[attr])
-                data = []
-                [data.append(x) for x in newData if x not in data]
-
-            if clear_builtin:
+            if len(pipeline):
+                data = list(self.representations.convert(
+                    entity, keyValues_opt, values_opt, unique_opt))
+                if not unique_opt:
+                    data = data[0]
+            else:
                 # Clear builtin data
-                if "dateCreated" in data and 'dateCreated' not in attribs:
-                    del data["dateCreated"]
-                if "dateModified" in data and 'dateModified' not in attribs:
-                    del data["dateModified"]
-                if "dateExpired" in data and 'dateExpired' not in attribs:
-                    del data["dateExpired"]
-
-            if attributes:
-                if "id" in data and 'id' not in attribs:
-                    del data["id"]
-                if "type" in data and 'type' not in attribs:
-                    del data["type"]
-
-            self.helpers.logger.info(
-                self.program + " 200: " \
-                    + self.helpers.confs["successMessage"][str(200)]["Description"])
-
-            return self.broker.respond(200, data, {},
-                                       False, accepted)
+                for attr in exclude:
+                    data.pop(attr, None)
+
+            self.logger.info(
+                "%s 200: %s", self.program,
+                self.helpers.confs["successMessage"][str(200)]["Description"])
+
+            return self.cache_response(key, _id, generation, self.broker.respond(
+                200, data, {}, False, accepted))
 
     def update_entity_post(self, _id, typeof, data, options, accepted=[]):
         """ Updates an HIASCDI Entity.
@@ -744,10 +650,6 @@ class entities():
                         - Update or Append Entity Attributes
         """
 
-        #self.subscriptions.checkForSubscription(_id)
-
-        updated = False
-        error = False
         _append = False
         _keyValues = False
 
@@ -763,33 +665,31 @@ class entities():
                 _append = True if option == "append" else _append
                 _keyValues = True if option == "keyValues" else _keyValues
 
-        entity = list(self.mongodb.mongoConn.Entities.find(
-            {'id': _id}))
-        if _append:
-            for update in data:
-                if update in entity[0]:
-                    error = True
-                else:
-                    self.mongodb.mongoConn.Entities.update_one(
-                        {"id" : _id},
-                        {"$set": {update: data[update]}}, upsert=True)
-                    updated = True
-        else:
-            for update in data:
-                self.mongodb.mongoConn.Entities.update_one(
-                    {"id" : _id},
-                    {"$set": {update: data[update]}}, upsert=True)
-                updated = True
-
-        if updated and error is False:
-            return self.broker.respond(
-                204, self.helpers.confs["successMessage"][str(204)],
-                {}, False, accepted)
-        else:
+        if not len(data):
             return self.broker.respond(
                 400, self.helpers.confs["errorMessages"]["400b"],
                 {}, False, accepted)
 
+        self.writebehind.flush(_id)
+
+        query = self.get_entity_query(_id, typeof)
+
+        if _append:
+            # Appended attributes must not already exist
+            query.update({attr: {"$exists": False} for attr in data})
+
+        try:
+            with self.mongodb.session() as session:
+                result = self.get_writer("update", typeof).update_one(
+                    query, {"$set": data}, session=session)
+        except WriteError as e:
+            return self.rejected_response(e, accepted)
+
+        if result.matched_count:
+            self.changed(_id, typeof, list(data))
+
+        return self.update_response(result, _id, typeof, accepted)
+
     def update_entity_patch(self, _id, typeof, data, options, accepted=[]):
         """ Updates an HIASCDI Entity.
 
@@ -803,9 +703,6 @@ class entities():
                         - Update Existing Entity Attributes
         """
 
-        updated = False
-        error = False
-
         if "id" in data:
             del data['id']
 
@@ -819,26 +716,131 @@ class entities():
             for option in options:
                 _keyValues = True if option == "keyValues" else _keyValues
 
-        entity = list(self.mongodb.mongoConn.Entities.find(
-            {'id': _id}))
-        for update in data:
-            if update not in entity[0]:
-                error = True
-            else:
-                self.mongodb.mongoConn.Entities.update_one(
-                    {"id" : _id},
-                    {"$set": {update: data[update]}})
-                updated = True
+        if not len(data):
+            return self.broker.respond(
+                400, self.helpers.confs["errorMessages"]["400b"],
+                {}, False, accepted)
+
+        self.writebehind.flush(_id)
+
+        query = self.get_entity_query(_id, typeof)
+
+        # Updated attributes must already exist
+        query.update({attr: {"$exists": True} for attr in data})
+
+        try:
+            with self.mongodb.session() as session:
+                result = self.get_writer("update", typeof).update_one(
+                    query, {"$set": data}, session=session)
+        except WriteError as e:
+            return self.rejected_response(e, accepted)
+
+        if result.matched_count:
+            self.changed(_id, typeof, list(data))
+
+        return self.update_response(result, _id, typeof, accepted)
+
+    def get_writer(self, operation, typeof=None, name="Entities"):
+        """ Gets the collection handle of an entity write.
+
+        The write concern tier can be requested with the configured
+        request header, otherwise it is configured by operation and
+        entity type.
+        """
+
+        return self.mongodb.writer(name, operation, typeof,
+                                   self.broker.get_write_concern())
+
+    def changed(self, _id, typeof, attrs):
+        """ Handles a change to an entity.
+
+        Called after every successful write. The attrs are the
+        names of the changed attributes, or None when the entity
+        was deleted.
+        """
+
+        self.mongodb.changed("Entities")
+
+        if self.cache is not None:
+            self.cache.invalidate(_id)
+
+        if self.notifications is not None:
+            self.notifications.notify(_id, typeof, attrs)
+
+    def get_cached_response(self, key):
+        """ Gets a cached response. """
+
+        if self.cache is None:
+            return None
+
+        cached = self.cache.get(key)
+        if cached is None:
+            return None
+
+        status, body, headers = cached
+
+        return Response(response=body, status=status, headers=headers)
+
+    def get_generation(self, _id):
+        """ Gets the cache generation of an entity before it is read. """
+
+        if self.cache is None:
+            return None
+
+        return self.cache.generation(_id)
+
+    def cache_response(self, key, _id, generation, response):
+        """ Caches the serialized body of a successful response.
+
+        The response is not cached when the entity changed since
+        generation, as it may have been read before the change.
+        """
+
+        if self.cache is not None and response.status_code == 200:
+            self.cache.set(key, (response.status_code, response.get_data(),
+                                 dict(response.headers)), _id, generation)
+
+        return response
+
+    def get_entity_query(self, _id, typeof=None):
+        """ Builds the query that identifies an entity. """
+
+        query = {"id": _id}
+
+        if typeof is not None:
+            query.update({"type": typeof})
+
+        return query
+
+    def update_response(self, result, _id, typeof, accepted=[]):
+        """ Builds the response for a single entity update.
 
-        if updated and error is False:
+        The attribute conditions are part of the update query,
+        so when nothing matched the entity is looked up to tell
+        a missing entity (404) from a rejected update (400).
+        """
+
+        if result.matched_count:
             return self.broker.respond(
                 204, self.helpers.confs["successMessage"][str(204)],
                 {}, False, accepted)
-        else:
+
+        entity = self.mongodb.collections["Entities"].find_one(
+            self.get_entity_query(_id, typeof), {"_id": True})
+
+        if entity is None:
+            self.logger.info("%s 404: %s", self.program,
+                self.helpers.confs["errorMessages"][str(404)]["Description"])
             return self.broker.respond(
-                400, self.helpers.confs["errorMessages"]["400b"],
+                404, self.helpers.confs["errorMessages"][str(404)],
                 {}, False, accepted)
 
+        self.logger.info("%s 400: %s", self.program,
+            self.helpers.confs["errorMessages"]["400b"]["Description"])
+        return self.broker.respond(
+            400, self.helpers.confs["errorMessages"]["400b"],
+            {}, False, accepted)
+
     def update_entity_put(self, _id, typeof, data, options, accepted=[]):
         """ Updates an HIASCDI Entity.
 
@@ -858,16 +860,6 @@ class entities():
         if "type" in data:
             del data['type']
 
-        fields = {
-            '_id': False,
-            'id': False,
-            'type': False,
-            'dateCreated': False,
-            'dateModified': False,
-            'dateExpired': False
-        }
-
-        updated = False
         _keyValues = False
 
         if options is not None:
@@ -875,28 +867,63 @@ class entities():
             for option in options:
                 _keyValues = True if option == "keyValues" else _keyValues
 
-        entity = list(self.mongodb.mongoConn.Entities.find(
-            {"id": _id}, fields))
+        if not len(data):
+            return self.broker.respond(
+                400, self.helpers.confs["errorMessages"]["400b"],
+                {}, False, accepted)
 
-        for e in entity:
-            self.mongodb.mongoConn.Entities.update(
-                {"id": _id}, {'$unset': {e: ""}})
+        # Only returns the attribute names held before the update
+        fields = {
+            '_id': False,
+            'attrs': {"$map": {
+                "input": {"$objectToArray": "$$ROOT"},
+                "as": "attr",
+                "in": "$$attr.k"
+            }}
+        }
 
-        for update in data:
-            self.mongodb.mongoConn.Entities.update_one(
-                {"id" : _id},
-                {"$set": {update: data[update]}}, upsert=True)
-            updated = True
+        self.writebehind.flush(_id)
+        self.writebehind.forget(_id)
 
-        if updated:
-            return self.broker.respond(
-                204, self.helpers.confs["successMessage"][str(204)],
-                {}, False, accepted)
-        else:
+        try:
+            with self.mongodb.session() as session:
+                entity = self.get_writer("update", typeof).find_one_and_update(
+                    self.get_entity_query(_id, typeof),
+                    self.get_replacement(data), projection=fields,
+                    session=session)
+        except WriteError as e:
+            return self.rejected_response(e, accepted)
+
+        if entity is None:
+            self.logger.info("%s 404: %s", self.program,
+                self.helpers.confs["errorMessages"][str(404)]["Description"])
             return self.broker.respond(
-                400, self.helpers.confs["errorMessages"]["400b"],
+                404, self.helpers.confs["errorMessages"][str(404)],
                 {}, False, accepted)
 
+        removed = [attr for attr in entity["attrs"]
+                   if attr not in self.builtins and attr not in data]
+
+        self.changed(_id, typeof, removed + list(data))
+
+        return self.broker.respond(
+            204, self.helpers.confs["successMessage"][str(204)],
+            {"Modified-Attributes": str(len(removed) + len(data))},
+            False, accepted)
+
+    def get_replacement(self, data):
+        """ Builds an update pipeline that replaces all attributes.
+
+        The replacement is applied by MongoDB in a single operation,
+        keeping the id, type and builtin date attributes of the
+        stored entity.
+        """
+
+        keep = {attr: "$" + attr for attr in self.builtins}
+
+        return [{"$replaceWith": {
+            "$mergeObjects": [keep, {"$literal": data}]}}]
+
     def delete_entity(self, typeof, _id, accepted=[]):
         """ Deletes an HIASCDI Entity.
 
@@ -918,14 +945,20 @@ class entities():
                 {}, False, accepted)
 
         deleted = False
-        result = collection.delete_one({"id": _id})
+        self.writebehind.flush(_id)
+        self.writebehind.forget(_id)
+
+        collection = self.get_writer("delete", typeof, collection.name)
+        with self.mongodb.session() as session:
+            result = collection.delete_one({"id": _id}, session=session)
 
         if result.deleted_count == 1:
-            self.helpers.logger.info("Mongo data delete OK")
+            self.changed(_id, typeof, None)
+            self.logger.info("Mongo data delete OK")
             return self.broker.respond(204, {}, {},
                                        False, accepted)
         else:
-            self.helpers.logger.info("Mongo data delete FAILED")
+            self.logger.info("Mongo data delete FAILED")
             return self.broker.respond(
                 400, self.helpers.confs["errorMessages"]["400b"],
                 {}, False, accepted)
@@ -943,7 +976,13 @@ class entities():
                         - Get Attribute Data
         """
 
-        query = {'id': _id}
+        key = ("attribute", _id, typeof, _attr, metadata, is_value,
+               tuple(accepted), self.broker.is_pretty())
+        response = self.get_cached_response(key)
+        if response is not None:
+            return response
+
+        query = self.get_entity_query(_id, typeof)
 
         # Removes the MongoDB ID
         fields = {
@@ -956,20 +995,28 @@ class entities():
             mattribs = metadata.split(",")
             for attr in mattribs:
                 fields.update({_attr + "." + attr: True})
+        elif is_value:
+            fields.update({_attr + ".value": True})
+        else:
+            fields.update({_attr: True})
 
-        if typeof is not None:
-            query.update({"type": typeof})
+        # Buffered updates of the entity are written first
+        self.writebehind.flush(_id)
+        generation = self.get_generation(_id)
 
-        entity = list(self.mongodb.mongoConn.Entities.find(query, fields))
+        # Two results are enough to detect ambiguous requests
+        with self.mongodb.session() as session:
+            entity = list(self.mongodb.readers["Entities"].find(
+                query, fields, session=session).limit(2))
 
         if not entity:
-            self.helpers.logger.info(self.program + " 404: " + \
+            self.logger.info("%s 404: %s", self.program,
                 self.helpers.confs["errorMessages"][str(404)]["Description"])
             return self.broker.respond(
                 404, self.helpers.confs["errorMessages"][str(404)],
                 {}, False, accepted)
         elif len(entity) > 1:
-            self.helpers.logger.info(self.program + " 409: " + \
+            self.logger.info("%s 409: %s", self.program,
                 self.helpers.confs["errorMessages"][str(409)]["Description"])
             return self.broker.respond(
                 409, self.helpers.confs["errorMessages"][str(409)],
@@ -978,7 +1025,7 @@ class entities():
             data = entity[0]
 
             if _attr not in data:
-                self.helpers.logger.info(self.program + " 400: " + \
+                self.logger.info("%s 400: %s", self.program,
                     self.helpers.confs["errorMessages"]["400b"]["Description"])
                 return self.broker.respond(
                     400, self.helpers.confs["errorMessages"]["400b"],
@@ -988,7 +1035,7 @@ class entities():
             data = data[_attr]
             if is_value:
                 if "value" not in data:
-                    self.helpers.logger.info(self.program + " 400: " + \
+                    self.logger.info("%s 400: %s", self.program,
                         self.helpers.confs["errorMessages"]["400b"]["Description"])
                     return self.broker.respond(
                         400, self.helpers.confs["errorMessages"]["400b"],
@@ -997,12 +1044,12 @@ class entities():
                 data = data["value"]
                 override = "text/plain"
 
-            self.helpers.logger.info(
-                self.program + " 200: " \
-                    + self.helpers.confs["successMessage"][str(200)]["Description"])
+            self.logger.info(
+                "%s 200: %s", self.program,
+                self.helpers.confs["successMessage"][str(200)]["Description"])
 
-            return self.broker.respond(200, data, None, {},
-                                       override, accepted)
+            return self.cache_response(key, _id, generation, self.broker.respond(
+                200, data, {}, override, accepted))
 
     def update_entity_attributes_put(self, _id, _attr, typeof, data, is_value,
                                      accepted = None, content_type = None):
@@ -1018,68 +1065,76 @@ class entities():
                         - Update Attribute Data
         """
 
-        query = {"id": _id}
-
-        if typeof is not None:
-            query.update({"type": typeof})
-
-        entity = list(self.mongodb.mongoConn.Entities.find(query))
-
-        if not entity:
-            self.helpers.logger.info(self.program + " 404: " + \
-                self.helpers.confs["errorMessages"][str(404)]["Description"])
-            return self.broker.respond(
-                404, self.helpers.confs["errorMessages"][str(404)],
-                {}, False, accepted)
-        elif len(entity) > 1:
-            self.helpers.logger.info(self.program + " 409: " + \
-                self.helpers.confs["errorMessages"][str(409)]["Description"])
-            return self.broker.respond(
-                409, self.helpers.confs["errorMessages"][str(409)],
-                {}, False, accepted)
-        elif _attr not in entity[0]:
-            self.helpers.logger.info(self.program + " 404: " + \
-                self.helpers.confs["errorMessages"][str(404)]["Description"])
-            return self.broker.respond(
-                404, self.helpers.confs["errorMessages"][str(404)],
-                {}, False, accepted)
-        else:
-            if is_value:
-                data = data.decode()
-                path = _attr + '.value'
-                if content_type == "text/plain":
-                    if '"' in data:
-                        data = str(data.replace('"', ""))
-                    elif data == "true":
-                        data = True
-                    elif data == "false":
-                        data = False
-                    elif data == "null":
-                        data = None
+        if is_value:
+            data = data.decode()
+            path = _attr + '.value'
+            if content_type == "text/plain":
+                if '"' in data:
+                    data = str(data.replace('"', ""))
+                elif data == "true":
+                    data = True
+                elif data == "false":
+                    data = False
+                elif data == "null":
+                    data = None
+                else:
+                    if "." in data:
+                        try:
+                            data = float(data)
+                        except:
+                            return self.broker.respond(
+                                400, self.helpers.confs["errorMessages"]["400p"],
+                                {}, False, accepted)
                     else:
-                        if "." in data:
-                            try:
-                                data = float(data)
-                            except:
-                                return self.broker.respond(
-                                    400, self.helpers.confs["errorMessages"]["400p"],
-                                    {}, False, accepted)
-                        else:
-                            try:
-                                data = int(float(data))
-                            except:
-                                return self.broker.respond(
-                                    400, self.helpers.confs["errorMessages"]["400p"],
-                                    {}, False, accepted)
-            else:
-                path = _attr
+                        try:
+                            data = int(float(data))
+                        except:
+                            return self.broker.respond(
+                                400, self.helpers.confs["errorMessages"]["400p"],
+                                {}, False, accepted)
+        else:
+            path = _attr
 
-            self.mongodb.mongoConn.Entities.update_one({"id": _id},
-                {"$set": {path: data}}, upsert=True)
+        ambiguous = self.ambiguous_response(_id, typeof, accepted)
+        if ambiguous is not None:
+            return ambiguous
+
+        if self.writebehind.put(_id, typeof, _attr, path, data):
+            # Written with the next flush, cached responses must not
+            # hide the new value until then
+            if self.cache is not None:
+                self.cache.invalidate(_id)
             return self.broker.respond(
                 204, self.helpers.confs["successMessage"][str(204)],
                 {}, False, accepted)
 
+        # Buffered updates of the entity are older than this one
+        self.writebehind.flush(_id)
+
+        query = self.get_entity_query(_id, typeof)
+
+        # The attribute must already exist
+        query.update({_attr: {"$exists": True}})
+
+        try:
+            with self.mongodb.session() as session:
+                entity = self.get_writer(
+                    "value" if is_value else "attribute", typeof).find_one_and_update(
+                    query, {"$set": {path: data}}, projection={"_id": True},
+                    session=session)
+        except WriteError as e:
+            return self.rejected_response(e, accepted)
+
+        if entity is None:
+            return self.attribute_missing_response(_id, typeof, accepted)
+
+        self.writebehind.known(_id, typeof, _attr)
+        self.changed(_id, typeof, [_attr])
+
+        return self.broker.respond(
+            204, self.helpers.confs["successMessage"][str(204)],
+            {}, False, accepted)
+
     def delete_entityAttribute(self, _id, _attr, typeof, accepted=[]):
         """ Updates an HIASCDI Entity Attribute.
 
@@ -1093,34 +1148,97 @@ class entities():
                         - Update Attribute Data
         """
 
-        query = {"id": _id}
+        ambiguous = self.ambiguous_response(_id, typeof, accepted)
+        if ambiguous is not None:
+            return ambiguous
 
-        if typeof is not None:
-            query.update({"type": typeof})
+        self.writebehind.flush(_id)
+        self.writebehind.forget(_id)
 
-        entity = list(self.mongodb.mongoConn.Entities.find(query))
+        query = self.get_entity_query(_id, typeof)
 
-        if not entity:
-            self.helpers.logger.info(self.program + " 404: " +
-                self.helpers.confs["errorMessages"][str(404)]["Description"])
-            return self.broker.respond(
-                404, self.helpers.confs["errorMessages"][str(404)],
-                {}, False, accepted)
-        elif len(entity) > 1:
-            self.helpers.logger.info(self.program + " 409: " +
-                self.helpers.confs["errorMessages"][str(409)]["Description"])
+        # The attribute must already exist
+        query.update({_attr: {"$exists": True}})
+
+        with self.mongodb.session() as session:
+            entity = self.get_writer("attribute", typeof).find_one_and_update(
+                query, {'$unset': {_attr: ""}}, projection={"_id": True},
+                session=session)
+
+        if entity is None:
+            return self.attribute_missing_response(_id, typeof, accepted)
+
+        self.changed(_id, typeof, [_attr])
+
+        return self.broker.respond(
+            204, self.helpers.confs["successMessage"][str(204)],
+            {}, False, accepted)
+
+    def rejected_response(self, error, accepted=[]):
+        """ Builds the response for a write rejected by MongoDB.
+
+        An entity id and type that already exist is 422, a value an
+        index cannot hold is 400. Other errors are raised again.
+        """
+
+        if isinstance(error, DuplicateKeyError):
+            self.logger.info("%s 422: %s", self.program,
+                self.helpers.confs["errorMessages"]["422e"]["Description"])
             return self.broker.respond(
-                409, self.helpers.confs["errorMessages"][str(409)],
+                422, self.helpers.confs["errorMessages"]["422e"],
                 {}, False, accepted)
-        elif _attr not in entity[0]:
-            self.helpers.logger.info(self.program + " 404: " +
-                self.helpers.confs["errorMessages"][str(404)]["Description"])
+
+        if error.code in self.unindexable:
+            self.logger.info("%s 400: %s", self.program, error)
             return self.broker.respond(
-                404, self.helpers.confs["errorMessages"][str(404)],
+                400, self.helpers.confs["errorMessages"]["400p"],
                 {}, False, accepted)
-        else:
-            self.mongodb.mongoConn.Entities.update({"id": _id},
-                        {'$unset': {_attr: ""}})
+
+        raise error
+
+    def ambiguous_response(self, _id, typeof, accepted=[]):
+        """ Builds the response for an ambiguous attribute write.
+
+        Without a type, an id shared by more than one entity must
+        not write to any of them. Returns None when the request is
+        not ambiguous.
+        """
+
+        if typeof is not None:
+            return None
+
+        entity = list(self.mongodb.collections["Entities"].find(
+            self.get_entity_query(_id, typeof), {"_id": True}).limit(2))
+
+        if len(entity) < 2:
+            return None
+
+        self.logger.info("%s 409: %s", self.program,
+            self.helpers.confs["errorMessages"][str(409)]["Description"])
+        return self.broker.respond(
+            409, self.helpers.confs["errorMessages"][str(409)],
+            {}, False, accepted)
+
+    def attribute_missing_response(self, _id, typeof, accepted=[]):
+        """ Builds the response for an unmatched attribute write.
+
+        Only the ids of at most two entities are fetched to tell
+        a missing entity or attribute (404) from an ambiguous
+        request (409).
+        """
+
+        entity = list(self.mongodb.collections["Entities"].find(
+            self.get_entity_query(_id, typeof), {"_id": True}).limit(2))
+
+        if len(entity) > 1:
+            self.logger.info("%s 409: %s", self.program,
+                self.helpers.confs["errorMessages"][str(409)]["Description"])
             return self.broker.respond(
-                204, self.helpers.confs["successMessage"][str(204)],
+                409, self.helpers.confs["errorMessages"][str(409)],
                 {}, False, accepted)
+
+        self.logger.info("%s 404: %s", self.program,
+            self.helpers.confs["errorMessages"][str(404)]["Description"])
+        return self.broker.respond(
+            404, self.helpers.confs["errorMessages"][str(404)],
+            {}, False, accepted)
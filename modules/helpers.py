@@ -32,22 +32,89 @@ Contributors:
 
 """
 
+import atexit
 import logging
 import logging.handlers as handlers
 import json
 import os
+import queue
 import socket
 import sys
+import threading
 import time
 
 from datetime import datetime
 
 
+class queuehandler(handlers.QueueHandler):
+	""" HIASCDI Log Queue Handler.
+
+	Queues log records without formatting them, the messages are
+	formatted by the log writer thread.
+	"""
+
+	def prepare(self, record):
+		""" Queues the record as it is. """
+
+		return record
+
+
+class ratelimit(logging.Filter):
+	""" HIASCDI Log Rate Limit.
+
+	Limits each INFO or DEBUG message to a number of records per
+	second. The next record of a limited message reports how many
+	were left out.
+	"""
+
+	def __init__(self, rate):
+		""" Initializes the class. """
+
+		super().__init__()
+
+		self.rate = rate
+		self.windows = {}
+		self.lock = threading.Lock()
+
+	def filter(self, record):
+		""" Checks if a record is logged. """
+
+		if record.levelno >= logging.WARNING:
+			return True
+
+		key = (record.name, record.msg)
+		second = int(record.created)
+
+		with self.lock:
+			window = self.windows.get(key)
+			if window is None or window[0] != second:
+				suppressed = window[2] if window is not None else 0
+				if len(self.windows) > 10000:
+					self.windows.clear()
+				self.windows[key] = [second, 1, 0]
+			else:
+				window[1] += 1
+				if window[1] > self.rate:
+					window[2] += 1
+					return False
+				suppressed = 0
+
+		if suppressed:
+			record.msg = str(record.msg) + " [" + str(suppressed) \
+				+ " similar messages suppressed]"
+
+		return True
+
+
 class helpers():
 	""" HIASCDI Global Helper Module.
 
 	The HIASCDI Global Helper Module provides global helper
 	functions to the HIASCDI application.
+
+	Log records are queued and written by a single background
+	thread. Modules log through child loggers of the HIASCDI
+	logger, with levels set in the logging configuration.
 	"""
 
 	def __init__(self, ltype, log=True):
@@ -60,7 +127,7 @@ class helpers():
 
 		# Sets system logging
 		self.logger = logging.getLogger(ltype)
-		self.logger.setLevel(logging.INFO)
+		self.logger.setLevel(self.confs["logging"]["level"])
 
 		formatter = logging.Formatter(
 			'%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -83,15 +150,60 @@ class helpers():
 		consoleHandler = logging.StreamHandler(sys.stdout)
 		consoleHandler.setFormatter(formatter)
 
-		self.logger.addHandler(allLogHandler)
-		self.logger.addHandler(errorLogHandler)
-		self.logger.addHandler(warningLogHandler)
-		self.logger.addHandler(consoleHandler)
+		# The handlers write from the listener thread
+		records = queue.SimpleQueue()
+		self.listener = handlers.QueueListener(records, allLogHandler,
+			errorLogHandler, warningLogHandler, consoleHandler,
+			respect_handler_level=True)
+
+		self.queueHandler = queuehandler(records)
+		if self.confs["logging"]["rate"]:
+			self.queueHandler.addFilter(ratelimit(self.confs["logging"]["rate"]))
+
+		self.logger.handlers = []
+		self.logger.addHandler(self.queueHandler)
+		self.logger.propagate = False
+
+		self.listener.start()
+		self.logging = True
+		atexit.register(self.stop_logging)
+		# The writer thread does not survive a fork
+		os.register_at_fork(after_in_child=self.start_logging)
 
 		if log is True:
 			self.logger.info("Configuration and credentials loaded.")
 			self.logger.info("Helpers class initialization complete.")
 
+	def get_logger(self, module):
+		""" Gets the logger of a module. """
+
+		logger = self.logger.getChild(module)
+		logger.setLevel(self.confs["logging"]["modules"].get(
+			module, self.confs["logging"]["level"]))
+
+		return logger
+
+	def start_logging(self):
+		""" Starts a new log writer thread.
+
+		The new thread has its own queue, records queued before a
+		fork are written by the parent.
+		"""
+
+		records = queue.SimpleQueue()
+		self.queueHandler.queue = records
+		self.listener = handlers.QueueListener(records,
+			*self.listener.handlers, respect_handler_level=True)
+		self.listener.start()
+		self.logging = True
+
+	def stop_logging(self):
+		""" Writes the queued log records. """
+
+		if self.logging:
+			self.logging = False
+			self.listener.stop()
+
 	def load_confs(self):
 		""" Load the configuration. """
 
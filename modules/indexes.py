@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+""" HIASCDI Indexes Module.
+
+This module builds the HIASCDI MongoDB indexes and reports the
+query shapes that are not supported by an index.
+
+MIT License
+
+Copyright (c) 2021 Asociación de Investigacion en Inteligencia Artificial
+Para la Leucemia Peter Moss
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files(the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and / or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+Contributors:
+- Adam Milton-Barker
+
+"""
+
+import threading
+
+from collections import OrderedDict
+from pymongo import IndexModel
+from pymongo.errors import PyMongoError
+
+class indexes():
+    """ HIASCDI Indexes Module.
+
+    This module builds the HIASCDI MongoDB indexes and reports the
+    query shapes that are not supported by an index.
+
+    The indexes are declared in the indexes section of the
+    configuration. The entities set is built on every collection
+    used by mongodb.collextions, the other sets on the collection
+    they are named after.
+    """
+
+    geo = ["$near", "$nearSphere", "$geoWithin", "$geoIntersects"]
+
+    ranges = ["$gt", "$gte", "$lt", "$lte", "$regex"]
+
+    def __init__(self, helpers, mongodb):
+        """ Initializes the class. """
+
+        self.helpers = helpers
+        self.logger = self.helpers.get_logger("indexes")
+        self.program = "HIASCDI Indexes Module"
+
+        self.mongodb = mongodb
+        self.confs = self.helpers.confs["indexes"]
+
+        # Index keys of each collection, loaded after the build
+        self.keys = {}
+
+        # Recorded query shapes, least recently seen first. Filters
+        # name client attributes, so the shapes are bounded
+        self.shapes = OrderedDict()
+        self.lock = threading.Lock()
+
+    def start(self):
+        """ Builds the indexes in the background. """
+
+        if self.confs["build"]:
+            threading.Thread(target=self.build, daemon=True).start()
+
+    def get_declared(self):
+        """ Gets the declared indexes of each collection. """
+
+        declared = {}
+        for collection in self.mongodb.collextions.values():
+            declared[collection.name] = self.confs["entities"]
+
+        for name, models in self.confs.items():
+            if name not in ["build", "advisor", "entities"]:
+                declared[name] = models
+
+        return declared
+
+    def build(self):
+        """ Creates the declared indexes.
+
+        Existing indexes are left as they are. A failed index, i.e.
+        a unique index over duplicated data, is logged and does not
+        stop the others from being built.
+        """
+
+        for name, models in self.get_declared().items():
+            collection = self.mongodb.mongoConn[name]
+            for model in models:
+                try:
+                    collection.create_indexes([IndexModel(
+                        [tuple(key) for key in model["keys"]],
+                        unique=model.get("unique", False))])
+                except PyMongoError as e:
+                    self.logger.error(
+                        self.program + " index " + str(model["keys"]) \
+                            + " on " + name + " failed: " + str(e))
+
+            self.load(name)
+
+        self.logger.info(self.program + " index build complete.")
+
+    def load(self, name):
+        """ Loads the index keys of a collection. """
+
+        try:
+            information = self.mongodb.mongoConn[name].index_information()
+        except PyMongoError as e:
+            self.logger.error(
+                self.program + " could not read indexes of " + name \
+                    + ": " + str(e))
+            return
+
+        self.keys[name] = [list(index["key"]) for index in information.values()]
+
+        # Shapes recorded before the build finished are checked again
+        with self.lock:
+            for shape, stats in self.shapes.items():
+                if shape[0] == name and stats["indexed"] is not None:
+                    stats["indexed"] = self.is_indexed(name, dict(shape[1]), shape[2])
+
+    def record(self, name, query, sort):
+        """ Records the shape of an executed query.
+
+        Shapes are the filtered fields, with how they are filtered,
+        and the sort keys. The first time a shape without a
+        supporting index is seen it is logged. Over maxShapes, the
+        least recently seen shape is forgotten.
+        """
+
+        if not self.confs["advisor"]:
+            return
+
+        fields = tuple(sorted(self.get_fields(query).items()))
+        shape = (name, fields, tuple(key for key, direction in sort))
+
+        with self.lock:
+            if shape in self.shapes:
+                self.shapes[shape]["count"] += 1
+                self.shapes.move_to_end(shape)
+                return
+            stats = self.shapes[shape] = {"count": 1, "indexed": None}
+            while len(self.shapes) > self.confs["maxShapes"]:
+                self.shapes.popitem(last=False)
+
+        if name not in self.keys:
+            self.load(name)
+
+        indexed = self.is_indexed(name, dict(fields), shape[2])
+        stats["indexed"] = indexed
+
+        if not indexed:
+            self.logger.warning(
+                self.program + " no index supports query on " + name \
+                    + " filter " + str(dict(fields)) + " sort " + str(list(shape[2])))
+
+    def report(self):
+        """ Gets the recorded query shapes. """
+
+        with self.lock:
+            shapes = list(self.shapes.items())
+
+        return [{
+            "collection": name,
+            "filter": dict(fields),
+            "sort": list(sort),
+            "count": stats["count"],
+            "indexed": stats["indexed"]
+        } for (name, fields, sort), stats in shapes]
+
+    def get_fields(self, query, fields=None):
+        """ Gets the filtered fields of a query and how they are
+        filtered: eq, range, geo or other. """
+
+        fields = {} if fields is None else fields
+
+        for key, value in query.items():
+            if key in ["$and", "$or", "$nor"]:
+                for condition in value:
+                    self.get_fields(condition, fields)
+            elif key.startswith("$"):
+                continue
+            elif isinstance(value, dict) and len(value) \
+                    and next(iter(value)).startswith("$"):
+                if len([op for op in value if op in self.geo]):
+                    fields[key] = "geo"
+                elif len([op for op in value if op in ["$eq", "$in"]]):
+                    fields.setdefault(key, "eq")
+                elif len([op for op in value if op in self.ranges]):
+                    fields.setdefault(key, "range")
+                else:
+                    fields.setdefault(key, "other")
+            else:
+                fields.setdefault(key, "eq")
+
+        return fields
+
+    def is_indexed(self, name, fields, sort):
+        """ Checks if a query shape has a supporting index.
+
+        A filter is supported when an index starts with one of its
+        eq or range fields, or is a 2dsphere index on its geo
+        field. A query without a usable filter is supported when an
+        index starts with its first sort key.
+        """
+
+        keys = self.keys.get(name, [])
+
+        for field, kind in fields.items():
+            for key in keys:
+                if kind == "geo":
+                    if (field, "2dsphere") in key:
+                        return True
+                elif kind in ["eq", "range"] and key[0][0] == field:
+                    return True
+
+        usable = [kind for kind in fields.values() if kind != "other"]
+        if not len(usable) and len(sort):
+            for key in keys:
+                if key[0][0] == sort[0]:
+                    return True
+
+        return not len(fields) and not len(sort)
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+""" HIASCDI Ingest Module.
+
+This module writes the telemetry published to the iotJumpWay to
+the HIASCDI entities.
+
+MIT License
+
+Copyright (c) 2021 Asociación de Investigacion en Inteligencia Artificial
+Para la Leucemia Peter Moss
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files(the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and / or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+Contributors:
+- Adam Milton-Barker
+
+"""
+
+import json
+import threading
+
+from modules.writebehind import writebehind
+
+class ingest():
+    """ HIASCDI Ingest Module.
+
+    This module writes the telemetry published to the iotJumpWay to
+    the HIASCDI entities.
+
+    iotJumpWay topics are Location/Type/Zone/Entity/Topic. The
+    entity is the one with the topic entity id, of the entity type
+    configured for the topic type. Each configured topic maps its
+    payloads to attribute values:
+
+        - attribute: the whole payload is the value of an attribute
+        - attributes: payload fields are the values of attributes
+        - key and value: a payload field names the attribute, another
+          holds its value
+
+    An attribute created by the telemetry gets the type configured
+    for the topic, or the NGSI type of its value, and no metadata.
+
+    Updates are coalesced and written in batches every flush
+    interval.
+    """
+
+    # NGSI types of the payload values
+    types = [
+        (bool, "Boolean"),
+        ((int, float), "Number"),
+        (str, "Text"),
+        (list, "StructuredValue"),
+        (dict, "StructuredValue")
+    ]
+
+    def __init__(self, helpers, mongodb, mqtt, entities=None,
+                 notifications=None):
+        """ Initializes the class. """
+
+        self.helpers = helpers
+        self.logger = self.helpers.get_logger("ingest")
+        self.program = "HIASCDI Ingest Module"
+
+        self.mongodb = mongodb
+        self.mqtt = mqtt
+        self.entities = entities
+        self.notifications = notifications
+        self.confs = self.helpers.confs["ingest"]
+
+        self.writebehind = writebehind(self.helpers, self.mongodb,
+                                       self.changed, self.confs, False)
+
+        # Messages of different topics are handled concurrently
+        self.lock = threading.Lock()
+
+        self.stats = {
+            "received": 0,
+            "updates": 0,
+            "dropped": 0
+        }
+
+        self.logger.info(
+            self.program + " initialization complete.")
+
+    def start(self):
+        """ Subscribes to the configured iotJumpWay topics. """
+
+        if not self.confs["enabled"]:
+            return
+
+        for topic in self.confs["topics"]:
+            setattr(self.mqtt, self.mqtt.callbacks[topic], self.message)
+
+        self.writebehind.start()
+        self.mqtt.subscribe()
+
+        self.logger.info(self.program + " ingesting " \
+            + ", ".join(self.confs["topics"]) + " telemetry.")
+
+    def stop(self):
+        """ Writes the buffered updates. """
+
+        self.writebehind.stop()
+
+    def message(self, topic, payload):
+        """ Buffers the attribute updates of an iotJumpWay message. """
+
+        parts = topic.split("/")
+        if len(parts) < 5 or parts[4] not in self.confs["topics"]:
+            self.count("received", "dropped")
+            return
+
+        try:
+            data = json.loads(payload)
+        except ValueError:
+            data = payload.decode("utf-8", "replace") \
+                if isinstance(payload, bytes) else payload
+
+        mapping = self.confs["topics"][parts[4]]
+        updates = self.get_updates(mapping, data)
+        if not len(updates):
+            self.count("received", "dropped")
+            self.logger.info(
+                self.program + " no attributes in " + topic + " payload.")
+            return
+
+        _id = parts[3]
+        typeof = self.confs["types"].get(parts[1])
+
+        for attr, value in updates.items():
+            defaults = {
+                "type": mapping.get("type") or self.get_type(value),
+                "metadata": {}
+            }
+            if not self.writebehind.put(_id, typeof, attr,
+                                        attr + ".value", value, defaults):
+                # The buffer is full
+                self.writebehind.flush()
+                self.writebehind.put(_id, typeof, attr,
+                                     attr + ".value", value, defaults)
+
+        self.count("received")
+        with self.lock:
+            self.stats["updates"] += len(updates)
+
+    def count(self, *names):
+        """ Increments counters. """
+
+        with self.lock:
+            for name in names:
+                self.stats[name] += 1
+
+    def get_updates(self, mapping, data):
+        """ Gets the attribute values of a payload. """
+
+        if "attribute" in mapping:
+            return {mapping["attribute"]: data}
+
+        if not isinstance(data, dict):
+            return {}
+
+        if "attributes" in mapping:
+            return {attr: data[field]
+                    for field, attr in mapping["attributes"].items()
+                    if field in data}
+
+        if mapping["key"] in data and mapping["value"] in data:
+            attr = str(data[mapping["key"]])
+            if attr.startswith("$") or "." in attr or not len(attr):
+                return {}
+            return {mapping.get("prefix", "") + attr: data[mapping["value"]]}
+
+        return {}
+
+    def get_type(self, value):
+        """ Gets the NGSI type of a payload value. """
+
+        for kinds, typeof in self.types:
+            if isinstance(value, kinds):
+                return typeof
+
+        return "Text"
+
+    def changed(self, _id, typeof, attrs):
+        """ Handles written telemetry.
+
+        Without the entities module, i.e. in the pre-fork master, the
+        master's counts are invalidated and the subscriptions are
+        notified. The caches of the workers are not invalidated.
+        """
+
+        if self.entities is not None:
+            self.entities.changed(_id, typeof, attrs)
+            return
+
+        self.mongodb.changed("Entities")
+        if self.notifications is not None:
+            self.notifications.notify(_id, typeof, attrs)
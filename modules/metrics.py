@@ -0,0 +1,399 @@
+#!/usr/bin/env python3
+""" HIASCDI Metrics Module.
+
+This module records the HIASCDI request, response size and MongoDB
+command metrics, and renders them in the Prometheus text format.
+
+MIT License
+
+Copyright (c) 2021 Asociación de Investigacion en Inteligencia Artificial
+Para la Leucemia Peter Moss
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files(the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and / or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+Contributors:
+- Adam Milton-Barker
+
+"""
+
+import bisect
+import glob
+import itertools
+import json
+import os
+import threading
+import time
+
+class metrics():
+    """ HIASCDI Metrics Module.
+
+    This module records the HIASCDI request, response size and MongoDB
+    command metrics, and renders them in the Prometheus text format.
+
+    The samples are kept in stripes, each with its own lock, and
+    threads are given the stripes in turn, so threads rarely wait
+    for each other. The stripes are summed when the metrics are
+    rendered.
+
+    Worker processes share their samples in a file of their worker
+    number, written every interval and when the metrics are
+    rendered, and the metrics of all of the files are rendered.
+    """
+
+    histograms = {
+        "hiascdi_request_duration_seconds": (
+            "latencyBuckets", "HTTP request duration by route."),
+        "hiascdi_response_size_bytes": (
+            "sizeBuckets", "HTTP response size by route."),
+        "hiascdi_mongodb_command_duration_seconds": (
+            "latencyBuckets", "MongoDB command duration by command and collection.")
+    }
+
+    counters = {
+        "hiascdi_requests_total": "HTTP requests by route and status.",
+        "hiascdi_mongodb_command_failures_total": "Failed MongoDB commands by command and collection.",
+        "hiascdi_mongodb_documents_total": "Documents returned or written by command and collection.",
+        "hiascdi_mongodb_reply_bytes_total": "MongoDB reply bytes by command and collection.",
+        "hiascdi_slow_requests_total": "Requests over the monitor thresholds by route and reason."
+    }
+
+    def __init__(self, helpers):
+        """ Initializes the class. """
+
+        self.helpers = helpers
+        self.logger = self.helpers.get_logger("metrics")
+        self.program = "HIASCDI Metrics Module"
+
+        self.confs = self.helpers.confs["metrics"]
+
+        self.buckets = {name: self.confs[buckets]
+                        for name, (buckets, text) in self.histograms.items()}
+
+        # Stripe of each thread
+        self.local = threading.local()
+        self.numbers = itertools.count()
+
+        # File of the worker samples, when they are shared
+        self.shared = None
+
+        self.reset()
+
+        # Workers start with their own samples and unheld locks
+        os.register_at_fork(after_in_child=self.reset)
+
+        self.logger.info(
+            self.program + " initialization complete.")
+
+    def reset(self):
+        """ Removes all of the samples. """
+
+        self.stripes = [(threading.Lock(), {}, {})
+                        for i in range(self.confs["stripes"])]
+
+    def get_stripe(self):
+        """ Gets the stripe of the current thread. """
+
+        stripe = getattr(self.local, "stripe", None)
+        if stripe is None:
+            stripe = self.local.stripe = next(self.numbers) % len(self.stripes)
+
+        return self.stripes[stripe]
+
+    def add(self, samples, name, labels, value, buckets):
+        """ Adds a value to a histogram. Must hold the stripe lock. """
+
+        histogram = samples.get((name, labels))
+        if histogram is None:
+            # A count per bucket, the +Inf count and the sum
+            histogram = samples[(name, labels)] = [0] * (len(buckets) + 2)
+        histogram[bisect.bisect_left(buckets, value)] += 1
+        histogram[-1] += value
+
+    def request(self, method, route, status, duration, size=None):
+        """ Records an HTTP request. """
+
+        labels = (("method", method), ("route", route))
+
+        lock, counts, samples = self.get_stripe()
+        with lock:
+            key = ("hiascdi_requests_total", labels + (("status", str(status)),))
+            counts[key] = counts.get(key, 0) + 1
+            self.add(samples, "hiascdi_request_duration_seconds", labels, duration,
+                     self.buckets["hiascdi_request_duration_seconds"])
+            if size is not None:
+                self.add(samples, "hiascdi_response_size_bytes", labels, size,
+                         self.buckets["hiascdi_response_size_bytes"])
+
+    def command(self, command, collection, duration, failed=False,
+                documents=0, size=None):
+        """ Records a MongoDB command. """
+
+        labels = (("command", command), ("collection", collection))
+
+        lock, counts, samples = self.get_stripe()
+        with lock:
+            self.add(samples, "hiascdi_mongodb_command_duration_seconds", labels,
+                     duration, self.buckets["hiascdi_mongodb_command_duration_seconds"])
+            if failed:
+                key = ("hiascdi_mongodb_command_failures_total", labels)
+                counts[key] = counts.get(key, 0) + 1
+            key = ("hiascdi_mongodb_documents_total", labels)
+            counts[key] = counts.get(key, 0) + documents
+            if size is not None:
+                key = ("hiascdi_mongodb_reply_bytes_total", labels)
+                counts[key] = counts.get(key, 0) + size
+
+    def count(self, name, labels, value=1):
+        """ Adds to a counter. """
+
+        lock, counts, samples = self.get_stripe()
+        with lock:
+            counts[(name, labels)] = counts.get((name, labels), 0) + value
+
+    def collect(self):
+        """ Sums the samples of all of the stripes. """
+
+        counts = {}
+        samples = {}
+        for lock, stripeCounts, stripeSamples in self.stripes:
+            with lock:
+                for key, value in stripeCounts.items():
+                    counts[key] = counts.get(key, 0) + value
+                for key, histogram in stripeSamples.items():
+                    if key in samples:
+                        samples[key] = [a + b for a, b in zip(samples[key], histogram)]
+                    else:
+                        samples[key] = list(histogram)
+
+        return counts, samples
+
+    def clear(self):
+        """ Removes the shared samples of previous workers. """
+
+        for name in glob.glob(os.path.join(
+                self.confs["directory"], "metrics-worker-*.json")):
+            os.remove(name)
+
+    def share(self, number, families=None):
+        """ Shares the samples of a worker process.
+
+        families gets the metrics of the other modules of the worker,
+        which are shared with its samples. A worker replacing another
+        starts from the samples and module counters of its number, so
+        the rendered counters never go back.
+        """
+
+        self.number = number
+        self.families = families
+        self.shared = os.path.join(self.confs["directory"],
+                                   "metrics-worker-%d.json" % number)
+
+        previousCounts, previousSamples, previousFamilies = self.read(self.shared)
+
+        lock, counts, samples = self.stripes[0]
+        with lock:
+            counts.update(previousCounts)
+            samples.update(previousSamples)
+
+        # Module counters restart with the worker, they are added to
+        # the counters of the worker it replaced
+        self.base = {}
+        for name, kind, text, values in previousFamilies:
+            if kind == "counter":
+                for labels, value in values:
+                    self.base[(name, self.get_key(labels))] = (text, labels, value)
+
+        threading.Thread(target=self.work, daemon=True).start()
+
+    def work(self):
+        """ Writes the shared samples every interval. """
+
+        while True:
+            time.sleep(self.confs["interval"])
+            self.write()
+
+    def write(self, families=None):
+        """ Writes the samples of the worker to its file. """
+
+        counts, samples = self.collect()
+
+        if families is None:
+            families = self.families() if self.families is not None else []
+        families = self.get_counted(families)
+
+        # Each thread writes its own file before replacing the shared one
+        name = "%s.%d" % (self.shared, threading.get_ident())
+        try:
+            with open(name, "w") as shared:
+                json.dump({
+                    "worker": self.number,
+                    "counts": [[family, labels, value]
+                               for (family, labels), value in counts.items()],
+                    "samples": [[family, labels, histogram]
+                                for (family, labels), histogram in samples.items()],
+                    "families": families
+                }, shared)
+            os.replace(name, self.shared)
+        except OSError as e:
+            self.logger.error(
+                "%s could not write %s: %s", self.program, self.shared, e)
+
+    def get_counted(self, families):
+        """ Adds the counters of the replaced worker to the module
+        counters. """
+
+        counted = []
+        seen = set()
+        for name, kind, text, values in families:
+            if kind == "counter":
+                values = [(labels, value + self.base.get(
+                    (name, self.get_key(labels)), (None, None, 0))[2])
+                    for labels, value in values]
+                seen.update((name, self.get_key(labels)) for labels, value in values)
+            counted.append([name, kind, text, [list(value) for value in values]])
+
+        # Counters the worker does not have yet keep their values
+        missing = {}
+        for (name, key), (text, labels, value) in self.base.items():
+            if (name, key) not in seen:
+                missing.setdefault((name, text), []).append([labels, value])
+        for (name, text), values in missing.items():
+            counted.append([name, "counter", text, values])
+
+        return counted
+
+    def get_key(self, labels):
+        """ Gets the key of the labels of a module metric. """
+
+        return tuple(sorted(labels.items()))
+
+    def read(self, name):
+        """ Reads the samples and module metrics of a worker file. """
+
+        try:
+            with open(name) as shared:
+                data = json.load(shared)
+        except (OSError, ValueError):
+            return {}, {}, []
+
+        def key(family, labels):
+            return (family, tuple(tuple(label) for label in labels))
+
+        families = data.get("families", [])
+        for family in families:
+            if family[1] == "gauge":
+                # Gauges are not summed, each is of its worker
+                family[3] = [[dict(labels, worker=str(data.get("worker"))), value]
+                             for labels, value in family[3]]
+
+        return ({key(family, labels): value
+                 for family, labels, value in data["counts"]},
+                {key(family, labels): histogram
+                 for family, labels, histogram in data["samples"]},
+                families)
+
+    def gather(self, families):
+        """ Sums the samples and module counters of all of the worker
+        files. """
+
+        self.write(families)
+
+        counts = {}
+        samples = {}
+        merged = {}
+        for name in glob.glob(os.path.join(
+                self.confs["directory"], "metrics-worker-*.json")):
+            workerCounts, workerSamples, workerFamilies = self.read(name)
+            for key, value in workerCounts.items():
+                counts[key] = counts.get(key, 0) + value
+            for key, histogram in workerSamples.items():
+                if key in samples:
+                    samples[key] = [a + b for a, b in zip(samples[key], histogram)]
+                else:
+                    samples[key] = list(histogram)
+            for family, kind, text, values in workerFamilies:
+                sums = merged.setdefault(family, (kind, text, {}))[2]
+                for labels, value in values:
+                    key = self.get_key(labels)
+                    if key in sums:
+                        value += sums[key][1]
+                    sums[key] = (labels, value)
+
+        return counts, samples, [
+            (family, kind, text, list(sums.values()))
+            for family, (kind, text, sums) in merged.items()]
+
+    def render(self, families=[]):
+        """ Renders the metrics in the Prometheus text format.
+
+        families are the metrics of the other modules, each a name,
+        type, help text and a list of labels and value. The module
+        counters of worker processes are summed, their gauges are
+        labeled with the worker number.
+        """
+
+        if self.shared is None:
+            counts, samples = self.collect()
+        else:
+            counts, samples, families = self.gather(families)
+
+        lines = []
+        for name, text in self.counters.items():
+            lines += self.get_family(name, "counter", text, [
+                (dict(labels), value) for (family, labels), value in counts.items()
+                if family == name])
+
+        for name, (buckets, text) in self.histograms.items():
+            lines += ["# HELP " + name + " " + text, "# TYPE " + name + " histogram"]
+            for (family, labels), histogram in sorted(samples.items()):
+                if family != name:
+                    continue
+                total = 0
+                for bound, count in zip(self.buckets[name] + ["+Inf"], histogram):
+                    total += count
+                    lines.append(name + "_bucket" + self.get_labels(
+                        dict(labels, le=bound)) + " " + str(total))
+                lines.append(name + "_sum" + self.get_labels(dict(labels)) \
+                    + " " + repr(float(histogram[-1])))
+                lines.append(name + "_count" + self.get_labels(dict(labels)) \
+                    + " " + str(total))
+
+        for name, kind, text, values in families:
+            lines += self.get_family(name, kind, text, values)
+
+        return "\n".join(lines) + "\n"
+
+    def get_family(self, name, kind, text, values):
+        """ Renders a counter or gauge. """
+
+        lines = ["# HELP " + name + " " + text, "# TYPE " + name + " " + kind]
+        for labels, value in sorted(values, key=lambda value: sorted(value[0].items())):
+            lines.append(name + self.get_labels(labels) + " " + str(value))
+
+        return lines
+
+    def get_labels(self, labels):
+        """ Renders the labels of a sample. """
+
+        if not len(labels):
+            return ""
+
+        return "{" + ",".join(key + '="' + str(value).replace(
+            "\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+            for key, value in labels.items()) + "}"
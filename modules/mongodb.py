@@ -32,55 +32,311 @@ Contributors:
 
 """
 
+import contextlib
+import importlib.util
+import re
 import sys
+import threading
 
-from pymongo import MongoClient
+from bson import json_util
+from pymongo import MongoClient, ReadPreference, WriteConcern
+from pymongo.read_concern import ReadConcern
+
+from modules.cache import cache
+from modules.indexes import indexes
 
 class mongodb():
     """ HIASCDI MongoDB Helper Module.
 
     The HIASCDI MongoDB Helper Module provides MongoDB helper
     functions to the HIASCDI application.
+
+    Writes use the writer handles of their write concern tier,
+    reads of the GET endpoints use the readers handles, which
+    follow the configured read preference. Operations run in
+    causally consistent sessions started after the latest write of
+    the process. Readers of secondaries read at majority read
+    concern, so they see the majority writes of the same process.
+    Writes of a w: 1 tier, and writes of other processes, may not
+    be seen yet.
     """
 
-    def __init__(self, helpers):
+    # Python modules required by each wire compressor
+    compressors = {"zstd": "zstandard", "snappy": "snappy", "zlib": "zlib"}
+
+    # Earth radius in meters, converts distances to radians
+    radius = 6378100
+
+    # Collections holding the HIASCDI data
+    names = ["Actuators", "ApplicationZones", "Automation", "Entities",
+             "Sensors", "Subscriptions", "Types"]
+
+    def __init__(self, helpers, listeners=None):
         """ Initializes the class. """
 
         self.program = "MongoDB Helper Module"
 
         self.helpers = helpers
+        self.logger = self.helpers.get_logger("mongodb")
         self.confs = self.helpers.confs
         self.credentials = self.helpers.credentials
 
-        self.helpers.logger.info(self.program + " initialization complete.")
+        # Command listeners registered with the client
+        self.listeners = listeners or []
+
+        # Write generation of each collection, used in the count keys
+        self.generations = {}
+
+        self.counts = None
+        if self.confs["cache"]["enabled"]:
+            self.counts = cache(self.confs["cache"]["size"],
+                                self.confs["cache"]["countTtl"])
+
+        # Latest write of the process, sessions are started after it
+        self.operationTime = None
+        self.clusterTime = None
+        self.lock = threading.Lock()
+
+        self.indexes = indexes(self.helpers, self)
+
+        self.logger.info(self.program + " initialization complete.")
 
     def start(self):
         """ Connects to HIAS MongoDB database. """
 
+        credentials = self.credentials["mongodb"]
+
         self.mongoCon = MongoClient(
-            self.credentials["mongodb"]["host"])
+            credentials["host"], **self.get_options())
+
+        self.mongoConn = self.mongoCon[credentials["db"]]
 
-        self.mongoConn = self.mongoCon[
-            self.credentials["mongodb"]["db"]]
+        self.collections = {name: self.mongoConn[name] for name in self.names}
 
-        self.mongoConn.authenticate(self.credentials["mongodb"]["un"],
-                                    self.credentials["mongodb"]["up"])
+        preference = getattr(ReadPreference, re.sub(
+            "([A-Z])", r"_\1", credentials["readPreference"]).upper())
+        # Sessions only order reads after majority writes when the
+        # secondaries read majority committed data
+        concern = None
+        if credentials["causalConsistency"] \
+                and preference != ReadPreference.PRIMARY:
+            concern = ReadConcern("majority")
+
+        self.readers = {name: collection.with_options(
+            read_preference=preference, read_concern=concern)
+            for name, collection in self.collections.items()}
+
+        self.writers = {tier: {name: collection.with_options(
+            write_concern=WriteConcern(**options))
+            for name, collection in self.collections.items()}
+            for tier, options in self.confs["writeConcern"]["tiers"].items()}
 
         self.collextions = {
-            "Actuator": self.mongoConn.Actuators,
-            "Agent": self.mongoConn.Entities,
-            "Application": self.mongoConn.Entities,
-            "ApplicationZone": self.mongoConn.ApplicationZones,
-            "Automation": self.mongoConn.Automation,
-            "HIASCDI": self.mongoConn.Entities,
-            "HIASHDI": self.mongoConn.Entities,
-            "Device": self.mongoConn.Entities,
-            "Location": self.mongoConn.Entities,
-            "Model": self.mongoConn.Entities,
-            "Robotics": self.mongoConn.Entities,
-            "Patient": self.mongoConn.Entities,
-            "Sensors": self.mongoConn.Sensors,
-            "Staff": self.mongoConn.Entities,
-            "Thing": self.mongoConn.Entities,
-            "Zone": self.mongoConn.Entities
+            "Actuator": self.collections["Actuators"],
+            "Agent": self.collections["Entities"],
+            "Application": self.collections["Entities"],
+            "ApplicationZone": self.collections["ApplicationZones"],
+            "Automation": self.collections["Automation"],
+            "HIASCDI": self.collections["Entities"],
+            "HIASHDI": self.collections["Entities"],
+            "Device": self.collections["Entities"],
+            "Location": self.collections["Entities"],
+            "Model": self.collections["Entities"],
+            "Robotics": self.collections["Entities"],
+            "Patient": self.collections["Entities"],
+            "Sensors": self.collections["Sensors"],
+            "Staff": self.collections["Entities"],
+            "Thing": self.collections["Entities"],
+            "Zone": self.collections["Entities"]
         }
+
+        self.indexes.start()
+
+    def get_options(self):
+        """ Gets the MongoClient options from the credentials.
+
+        Pool and timeout settings of 0 keep the driver default.
+        Compressors whose Python module is not installed are left
+        out.
+        """
+
+        credentials = self.credentials["mongodb"]
+
+        options = {key: value for key, value in dict(
+            credentials["pool"], **credentials["timeouts"]).items() if value}
+
+        if credentials["un"] != "":
+            options.update({
+                "username": credentials["un"],
+                "password": credentials["up"],
+                "authSource": credentials["db"]
+            })
+
+        if credentials["replicaSet"] != "":
+            options["replicaSet"] = credentials["replicaSet"]
+
+        compressors = []
+        for compressor in credentials["compressors"]:
+            if importlib.util.find_spec(self.compressors[compressor]) is None:
+                self.logger.warning(
+                    self.program + " " + compressor \
+                        + " compression requires " + self.compressors[compressor])
+                continue
+            compressors.append(compressor)
+
+        if len(compressors):
+            options["compressors"] = ",".join(compressors)
+
+        if len(self.listeners):
+            options["event_listeners"] = self.listeners
+
+        return options
+
+    def writer(self, name, operation, typeof=None, tier=None):
+        """ Gets the collection handle of a write.
+
+        The tier is the one requested, when it exists, otherwise the
+        tier configured for the operation on the entity type, or for
+        the operation.
+        """
+
+        confs = self.confs["writeConcern"]
+
+        if tier not in self.writers:
+            tier = confs["types"].get(typeof, {}).get(
+                operation, confs["operations"].get(operation, confs["default"]))
+
+        return self.writers[tier][name]
+
+    def start_session(self):
+        """ Starts a causally consistent session.
+
+        The session is advanced to the latest write of the process.
+        Returns None when causal consistency is disabled.
+        """
+
+        if not self.credentials["mongodb"]["causalConsistency"]:
+            return None
+
+        session = self.mongoCon.start_session(causal_consistency=True)
+
+        with self.lock:
+            if self.clusterTime is not None:
+                session.advance_cluster_time(self.clusterTime)
+            if self.operationTime is not None:
+                session.advance_operation_time(self.operationTime)
+
+        return session
+
+    def end_session(self, session):
+        """ Ends a session, keeping its latest write time. """
+
+        if session is None:
+            return
+
+        with self.lock:
+            if session.operation_time is not None and (
+                    self.operationTime is None
+                    or session.operation_time > self.operationTime):
+                self.operationTime = session.operation_time
+            if session.cluster_time is not None and (
+                    self.clusterTime is None
+                    or session.cluster_time["clusterTime"] \
+                        > self.clusterTime["clusterTime"]):
+                self.clusterTime = session.cluster_time
+
+        session.end_session()
+
+    @contextlib.contextmanager
+    def session(self):
+        """ Runs operations in a causally consistent session. """
+
+        session = self.start_session()
+        try:
+            yield session
+        finally:
+            self.end_session(session)
+
+    def closing(self, entries, session):
+        """ Ends a session once its entries are consumed. """
+
+        try:
+            for entry in entries:
+                yield entry
+        finally:
+            self.end_session(session)
+
+    def count(self, collection, query, session=None):
+        """ Counts the documents in a collection matching a query.
+
+        Unfiltered counts use the collection metadata instead of
+        scanning. Counts are cached for a short time, keyed by the
+        normalized query and the write generation of the collection.
+        """
+
+        if self.counts is None:
+            return self.get_count(collection, query, session)
+
+        key = (collection.name, self.generations.get(collection.name, 0),
+               json_util.dumps(query, sort_keys=True))
+
+        count = self.counts.get(key)
+        if count is None:
+            count = self.get_count(collection, query, session)
+            self.counts.set(key, count)
+
+        return count
+
+    def get_count(self, collection, query, session=None):
+        """ Counts the documents in a collection matching a query. """
+
+        if not len(query):
+            return collection.estimated_document_count()
+
+        return collection.count_documents(
+            self.get_countable(query), session=session,
+            maxTimeMS=self.confs["planner"]["maxTimeMS"])
+
+    def get_countable(self, query):
+        """ Rewrites the $near conditions of a query for counting.
+
+        count_documents runs the query in $match, which rejects
+        $near. A $near matches the same documents as a $geoWithin
+        sphere of its maximum distance, less the sphere of its
+        minimum distance, or every located document without them.
+        """
+
+        if isinstance(query, list):
+            return [self.get_countable(condition) for condition in query]
+        if not isinstance(query, dict):
+            return query
+
+        countable = {}
+        excluded = []
+        for field, condition in query.items():
+            if isinstance(condition, dict) and "$near" in condition:
+                near = condition["$near"]
+                center = near["$geometry"]["coordinates"]
+                if "$maxDistance" in near:
+                    countable[field] = {"$geoWithin": {"$centerSphere": [
+                        center, near["$maxDistance"] / self.radius]}}
+                else:
+                    countable[field] = {"$exists": True}
+                if "$minDistance" in near:
+                    excluded.append({field: {"$geoWithin": {"$centerSphere": [
+                        center, near["$minDistance"] / self.radius]}}})
+            else:
+                countable[field] = self.get_countable(condition)
+
+        if len(excluded):
+            countable["$nor"] = countable.get("$nor", []) + excluded
+
+        return countable
+
+    def changed(self, collection):
+        """ Starts a new write generation for a collection.
+
+        Counts cached in earlier generations are no longer used.
+        """
+
+        self.generations[collection] = self.generations.get(collection, 0) + 1
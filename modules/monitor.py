@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+""" HIASCDI Monitor Module.
+
+This module monitors the MongoDB commands of the HIASCDI broker and
+reports the requests that send too many, or too slow, commands.
+
+MIT License
+
+Copyright (c) 2021 Asociación de Investigacion en Inteligencia Artificial
+Para la Leucemia Peter Moss
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files(the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and / or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+Contributors:
+- Adam Milton-Barker
+
+"""
+
+import bson
+import threading
+
+from bson import json_util
+from pymongo import monitoring
+
+class monitor(monitoring.CommandListener):
+    """ HIASCDI Monitor Module.
+
+    This module monitors the MongoDB commands of the HIASCDI broker and
+    reports the requests that send too many, or too slow, commands.
+
+    pymongo calls the listener on the thread sending the command, so
+    a command is attributed to the request traced on that thread.
+    Commands sent by the notification, write-behind and ingest
+    threads are recorded in the metrics only.
+    """
+
+    # Where each command keeps its filter
+    filters = {
+        "find": "filter",
+        "count": "query",
+        "distinct": "query",
+        "findAndModify": "query"
+    }
+
+    writes = ["insert", "update", "delete"]
+
+    # Commands reading on from an earlier command, they are not repeats
+    cursors = ["getMore", "killCursors"]
+
+    def __init__(self, helpers, metrics=None):
+        """ Initializes the class. """
+
+        self.helpers = helpers
+        self.logger = self.helpers.get_logger("monitor")
+        self.program = "HIASCDI Monitor Module"
+
+        self.confs = self.helpers.confs["monitor"]
+        self.metrics = metrics
+
+        # Request traced on each thread
+        self.local = threading.local()
+
+        # Started commands, by request id
+        self.commands = {}
+
+        self.logger.info(
+            self.program + " initialization complete.")
+
+    def begin(self, method, path, route):
+        """ Starts tracing a request on the current thread. """
+
+        if not self.confs["enabled"]:
+            return None
+
+        trace = {
+            "method": method,
+            "path": path,
+            "route": route,
+            "commands": [],
+            "time": 0.0
+        }
+        self.local.trace = trace
+
+        return trace
+
+    def resume(self, trace):
+        """ Traces a request on the current thread.
+
+        Returns the request traced before, streamed responses are
+        sent by any thread of the server.
+        """
+
+        previous = getattr(self.local, "trace", None)
+        self.local.trace = trace
+
+        return previous
+
+    def end(self, trace, duration):
+        """ Finishes tracing a request and reports it when it is
+        over a threshold. """
+
+        if trace is None:
+            return
+
+        groups = {}
+        for command in trace["commands"]:
+            key = (command["command"], command["collection"], command["shape"])
+            group = groups.setdefault(key, dict(
+                command, count=0, time=0.0, documents=0))
+            group["count"] += 1
+            group["time"] += command["duration"]
+            group["documents"] += command["documents"]
+
+        reasons = []
+        if self.confs["maxCommands"] and len(trace["commands"]) > self.confs["maxCommands"]:
+            reasons.append("commands")
+        if self.confs["maxTime"] and trace["time"] > self.confs["maxTime"]:
+            reasons.append("time")
+        if self.confs["repeated"] and len([group for group in groups.values()
+                if group["command"] not in self.cursors
+                and group["count"] >= self.confs["repeated"]]):
+            reasons.append("repeated")
+
+        if not len(reasons):
+            return
+
+        if self.metrics is not None:
+            for reason in reasons:
+                self.metrics.count("hiascdi_slow_requests_total", (
+                    ("route", trace["route"]), ("reason", reason)))
+
+        groups = sorted(groups.values(), key=lambda group: group["time"], reverse=True)
+
+        self.logger.warning(
+            "%s slow request %s %s (%s): %d commands, %.1fms in MongoDB, %.1fms in total; %s",
+            self.program, trace["method"], trace["path"], ", ".join(reasons),
+            len(trace["commands"]), trace["time"] * 1000, duration * 1000,
+            "; ".join("%s %s x%d %.1fms %d documents filter %s" % (
+                group["command"], group["collection"], group["count"],
+                group["time"] * 1000, group["documents"],
+                json_util.dumps(group["filter"])[:self.confs["filterLength"]])
+                for group in groups[:self.confs["groups"]]))
+
+    def get_filter(self, event):
+        """ Gets the filter of a command. """
+
+        command = event.command
+        name = event.command_name
+
+        if name in self.filters:
+            return command.get(self.filters[name])
+        if name == "aggregate":
+            stages = [stage["$match"] for stage in command.get("pipeline", [])
+                      if "$match" in stage]
+            return stages[0] if len(stages) else None
+        if name in ["update", "delete"]:
+            statements = command.get(name + "s") or [{}]
+            return statements[0].get("q")
+
+        return None
+
+    def get_documents(self, event):
+        """ Gets the number of documents returned or written. """
+
+        reply = event.reply
+
+        if "cursor" in reply:
+            return len(reply["cursor"].get("firstBatch",
+                                           reply["cursor"].get("nextBatch", [])))
+        if event.command_name in self.writes:
+            return reply.get("n", 0)
+        if event.command_name == "findAndModify":
+            return int(reply.get("value") is not None)
+
+        return 0
+
+    def started(self, event):
+        """ Records a started command. """
+
+        collection = event.command.get(event.command_name)
+        if event.command_name == "getMore":
+            collection = event.command.get("collection")
+        if not isinstance(collection, str):
+            collection = ""
+
+        trace = getattr(self.local, "trace", None)
+
+        query = None
+        if trace is not None:
+            query = self.get_filter(event)
+
+        self.commands[event.request_id] = (collection, trace, query)
+
+    def succeeded(self, event):
+        """ Records a completed command. """
+
+        self.record(event, self.get_documents(event))
+
+    def failed(self, event):
+        """ Records a failed command. """
+
+        self.record(event, 0, True)
+
+    def record(self, event, documents, failed=False):
+        """ Records a command in the metrics and its request trace. """
+
+        collection, trace, query = self.commands.pop(
+            event.request_id, ("", None, None))
+        duration = event.duration_micros / 1000000
+
+        size = None
+        if self.confs["sizes"] and not failed:
+            size = len(bson.encode(event.reply))
+
+        if self.metrics is not None:
+            self.metrics.command(event.command_name, collection, duration,
+                                 failed, documents, size)
+
+        if trace is None:
+            return
+
+        trace["time"] += duration
+        trace["commands"].append({
+            "command": event.command_name,
+            "collection": collection,
+            "duration": duration,
+            "documents": documents,
+            "size": size,
+            # Commands filtering on the same fields are repeats
+            "shape": tuple(sorted(query)) if isinstance(query, dict) else (),
+            "filter": query
+        })
@@ -33,6 +33,10 @@ Contributors:
 """
 
 import json
+import queue
+import threading
+import time
+import zlib
 
 import paho.mqtt.client as pmqtt
 
@@ -41,8 +45,27 @@ class mqtt():
 
 	This module connects devices, applications, robots and software to
 	the HIAS iotJumpWay MQTT Broker.
+
+	Received messages are queued and handled by a pool of workers,
+	so callbacks never block the network thread. Messages of a topic
+	are always handled by the same worker, in the order received.
+	When a queue is full the oldest message is dropped, or the
+	network thread waits, depending on the overflow policy.
 	"""
 
+	# Callback attribute of each topic
+	callbacks = {
+		"Actuators": "actuatorCallback",
+		"BCI": "bciCallback",
+		"Commands": "commandsCallback",
+		"Integrity": "integrityCallback",
+		"Life": "lifeCallback",
+		"Sensors": "sensorsCallback",
+		"State": "stateCallback",
+		"Status": "statusCallback",
+		"Zone": "zoneCallback"
+	}
+
 	def __init__(self,
 				 helpers,
 				 client_type,
@@ -52,13 +75,31 @@ class mqtt():
 		self.configs = configs
 		self.client_type = client_type
 		self.isConnected = False
+		self.subscriptions = []
 
 		self.helpers = helpers
+		self.logger = self.helpers.get_logger("mqtt")
 		self.program = "HIAS iotJumpWay MQTT Module"
 
 		self.mqtt_config = {}
 		self.module_topics = {}
 
+		self.confs = self.helpers.confs["mqtt"]
+		self.queues = [queue.Queue(self.confs["queueSize"])
+			for i in range(self.confs["workers"])]
+		self.lock = threading.Lock()
+
+		self.stats = {
+			"received": 0,
+			"handled": 0,
+			"dropped": 0,
+			"unhandled": 0,
+			"errors": 0,
+			"latency": 0.0,
+			"maxLatency": 0.0,
+			"totalLatency": 0.0
+		}
+
 		self.hiascdi = [
 			'host',
 			'port',
@@ -70,7 +111,7 @@ class mqtt():
 			'up'
 		]
 
-		self.helpers.logger.info(self.program + " initialization complete.")
+		self.logger.info(self.program + " initialization complete.")
 
 	def configure(self):
 		""" Connection configuration.
@@ -105,7 +146,7 @@ class mqtt():
 		self.statusCallback = None
 		self.zoneCallback = None
 
-		self.helpers.logger.info(
+		self.logger.info(
 				"iotJumpWay " + self.client_type + " connection configured.")
 
 	def start(self):
@@ -114,6 +155,10 @@ class mqtt():
 		Starts the HIAS iotJumpWay MQTT connection.
 		"""
 
+		for messages in self.queues:
+			threading.Thread(target=self.work, args=(messages,),
+				daemon=True).start()
+
 		self.mClient = pmqtt.Client(client_id=self.client_id, clean_session=True)
 		self.mClient.will_set(self.module_topics["statusTopic"], "OFFLINE", 0, False)
 		self.mClient.tls_set(self.mqtt_config["tls"], certfile=None, keyfile=None)
@@ -125,7 +170,7 @@ class mqtt():
 		self.mClient.connect(self.mqtt_config["host"], self.mqtt_config["port"], 120)
 		self.mClient.loop_start()
 
-		self.helpers.logger.info(
+		self.logger.info(
 					"iotJumpWay " + self.client_type + " connection started.")
 
 	def on_connect(self, client, obj, flags, rc):
@@ -137,11 +182,15 @@ class mqtt():
 		if self.isConnected != True:
 			self.isConnected = True
 
-			self.helpers.logger.info("iotJumpWay " + self.client_type + " connection successful.")
-			self.helpers.logger.info("rc: " + str(rc))
+			self.logger.info("iotJumpWay " + self.client_type + " connection successful.")
+			self.logger.info("rc: " + str(rc))
 
 			self.status_publish("ONLINE")
 
+		# Subscriptions do not survive a reconnection
+		for channel, qos in self.subscriptions:
+			self.mClient.subscribe(channel, qos=qos)
+
 	def status_publish(self, data):
 		""" Status publish
 
@@ -149,7 +198,7 @@ class mqtt():
 		"""
 
 		self.mClient.publish(self.module_topics["statusTopic"], data)
-		self.helpers.logger.info("Published to " + self.client_type + " status.")
+		self.logger.info("Published to " + self.client_type + " status.")
 
 	def on_subscribe(self, client, obj, mid, granted_qos):
 		""" On subscribe
@@ -157,76 +206,89 @@ class mqtt():
 		On subscription callback.
 		"""
 
-		self.helpers.logger.info("iotJumpWay " + self.client_type + " subscription")
+		self.logger.info("iotJumpWay " + self.client_type + " subscription")
 
 	def on_message(self, client, obj, msg):
 		""" On message
 
-		On message callback.
+		On message callback, queues the message for its worker.
+		"""
+
+		self.stats["received"] += 1
+
+		messages = self.queues[
+			zlib.crc32(msg.topic.encode("utf-8")) % len(self.queues)]
+
+		if self.confs["overflow"] == "block":
+			messages.put((msg.topic, msg.payload))
+			return
+
+		while True:
+			try:
+				messages.put_nowait((msg.topic, msg.payload))
+				return
+			except queue.Full:
+				try:
+					messages.get_nowait()
+					messages.task_done()
+					self.stats["dropped"] += 1
+				except queue.Empty:
+					pass
+
+	def work(self, messages):
+		""" Worker
+
+		Handles the messages of a queue.
+		"""
+
+		while True:
+			topic, payload = messages.get()
+			try:
+				self.dispatch(topic, payload)
+			finally:
+				messages.task_done()
+
+	def dispatch(self, topic, payload):
+		""" Dispatch
+
+		Calls the callback of a message topic.
+		"""
+
+		splitTopic = topic.split("/")
+		callback = None
+		if len(splitTopic) > 4 and splitTopic[4] in self.callbacks:
+			callback = getattr(self, self.callbacks[splitTopic[4]], None)
+
+		self.logger.debug("iotJumpWay %s communication received.", topic)
+
+		if callback is None:
+			with self.lock:
+				self.stats["unhandled"] += 1
+			return
+
+		start = time.time()
+		try:
+			callback(topic, payload)
+		except Exception as e:
+			with self.lock:
+				self.stats["errors"] += 1
+			self.logger.error(
+				"iotJumpWay " + topic + " callback failed: " + str(e))
+
+		latency = time.time() - start
+		with self.lock:
+			self.stats["handled"] += 1
+			self.stats["latency"] = latency
+			self.stats["totalLatency"] += latency
+			self.stats["maxLatency"] = max(self.stats["maxLatency"], latency)
+
+	def get_depth(self):
+		""" Queue depth
+
+		Gets the number of queued messages.
 		"""
 
-		splitTopic = msg.topic.split("/")
-		connType = splitTopic[1]
-
-		topic = splitTopic[4]
-
-		self.helpers.logger.info(msg.payload)
-		self.helpers.logger.info("iotJumpWay " + connType + " " + msg.topic  + " communication received.")
-
-		if topic == 'Actuators':
-			if self.actuatorCallback == None:
-				self.helpers.logger.info(
-						connType + " actuator callback required (actuatorCallback) !")
-			else:
-				self.actuatorCallback(msg.topic, msg.payload)
-		elif topic == 'BCI':
-			if self.bciCallback == None:
-				self.helpers.logger.info(
-						connType + " BCI callback required (bciCallback) !")
-			else:
-				self.bciCallback(msg.topic, msg.payload)
-		elif topic == 'Commands':
-			if self.commandsCallback == None:
-				self.helpers.logger.info(
-						connType + " comands callback required (commandsCallback) !")
-			else:
-				self.commandsCallback(msg.topic, msg.payload)
-		elif topic == 'Integrity':
-			if self.integrityCallback == None:
-				self.helpers.logger.info(
-						connType + " Integrity callback required (integrityCallback) !")
-			else:
-				self.integrityCallback(msg.topic, msg.payload)
-		elif topic == 'Life':
-			if self.lifeCallback == None:
-				self.helpers.logger.info(
-						connType + " life callback required (lifeCallback) !")
-			else:
-				self.lifeCallback(msg.topic, msg.payload)
-		elif topic == 'Sensors':
-			if self.sensorsCallback == None:
-				self.helpers.logger.info(
-						connType + " status callback required (sensorsCallback) !")
-			else:
-				self.sensorsCallback(msg.topic, msg.payload)
-		elif topic == 'State':
-			if self.stateCallback == None:
-				self.helpers.logger.info(
-						connType + " life callback required (stateCallback) !")
-			else:
-				self.stateCallback(msg.topic, msg.payload)
-		elif topic == 'Status':
-			if self.statusCallback == None:
-				self.helpers.logger.info(
-						connType + " status callback required (statusCallback) !")
-			else:
-				self.statusCallback(msg.topic, msg.payload)
-		elif topic == 'Zone':
-			if self.zoneCallback == None:
-				self.helpers.logger.info(
-						connType + " status callback required (zoneCallback) !")
-			else:
-				self.zoneCallback(msg.topic, msg.payload)
+		return sum([messages.qsize() for messages in self.queues])
 
 	def publish(self, channel, data, channelPath = ""):
 		""" Publish
@@ -241,7 +303,7 @@ class mqtt():
 				self.configs['location'], self.configs['zone'], self.configs['entity'], channel)
 
 		self.mClient.publish(channel, json.dumps(data))
-		self.helpers.logger.info("Published to " + channel)
+		self.logger.debug("Published to %s", channel)
 		return True
 
 	def subscribe(self, application = None, channelID = None, qos=0):
@@ -251,8 +313,10 @@ class mqtt():
 		"""
 
 		channel = '%s/#' % (self.configs['location'])
-		self.mClient.subscribe(channel, qos=qos)
-		self.helpers.logger.info("-- Agent subscribed to all channels")
+		self.subscriptions.append((channel, qos))
+		if self.isConnected:
+			self.mClient.subscribe(channel, qos=qos)
+		self.logger.info("-- Agent subscribed to all channels")
 		return True
 
 	def on_publish(self, client, obj, mid):
@@ -261,7 +325,7 @@ class mqtt():
 		On publish callback.
 		"""
 
-		self.helpers.logger.info("Published: "+str(mid))
+		self.logger.debug("Published: %s", mid)
 
 	def on_log(self, client, obj, level, string):
 		""" On log
@@ -269,7 +333,7 @@ class mqtt():
 		On log callback.
 		"""
 
-		print(string)
+		self.logger.debug(string)
 
 	def disconnect(self):
 		""" Disconnect
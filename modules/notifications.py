@@ -0,0 +1,388 @@
+#!/usr/bin/env python3
+""" HIASCDI Notifications Module.
+
+This module matches changes to HIASCDI entities against the stored
+subscriptions and delivers the resulting notifications.
+
+MIT License
+
+Copyright (c) 2021 Asociación de Investigacion en Inteligencia Artificial
+Para la Leucemia Peter Moss
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files(the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and / or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+Contributors:
+- Adam Milton-Barker
+
+"""
+
+import queue
+import re
+import requests
+import threading
+import time
+
+from datetime import datetime, timezone
+from requests.adapters import HTTPAdapter
+
+class notifications():
+    """ HIASCDI Notifications Module.
+
+    This module matches changes to HIASCDI entities against the stored
+    subscriptions and delivers the resulting notifications.
+    """
+
+    def __init__(self, helpers, mongodb, broker):
+        """ Initializes the class. """
+
+        self.helpers = helpers
+        self.logger = self.helpers.get_logger("notifications")
+        self.program = "HIASCDI Notifications Module"
+
+        self.mongodb = mongodb
+        self.broker = broker
+        self.confs = self.helpers.confs["notifications"]
+
+        self.index = {
+            "ids": {},
+            "types": {},
+            "patterns": []
+        }
+
+        self.queue = queue.Queue(maxsize=self.confs["queueSize"])
+
+        self.throttled = {}
+        self.throttledLock = threading.Lock()
+
+        # The statistics are updated by the request and worker threads
+        self.statsLock = threading.Lock()
+        self.stats = {
+            "queued": 0,
+            "dropped": 0,
+            "throttled": 0,
+            "sent": 0,
+            "failed": 0
+        }
+
+        # Keep-alive connections shared by all of the workers
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.confs["poolSize"],
+                              pool_maxsize=self.confs["poolSize"])
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self.logger.info(
+            self.program + " initialization complete.")
+
+    def start(self):
+        """ Loads the subscriptions and starts the workers. """
+
+        self.load()
+
+        for i in range(self.confs["workers"]):
+            threading.Thread(target=self.work, daemon=True).start()
+
+        threading.Thread(target=self.reload, daemon=True).start()
+
+        self.logger.info(
+            self.program + " started " + str(self.confs["workers"]) + " workers.")
+
+    def reload(self):
+        """ Periodically reloads the subscriptions. """
+
+        while True:
+            time.sleep(self.confs["reload"])
+            try:
+                self.load()
+            except Exception as e:
+                self.logger.error(
+                    "%s subscription reload failed: %s", self.program, e)
+
+    def load(self):
+        """ Compiles the stored subscriptions into the match index.
+
+        Selectors with an exact id are indexed by id, pattern
+        selectors are indexed by type when they have one. The new
+        index replaces the previous one in a single assignment.
+        """
+
+        index = {
+            "ids": {},
+            "types": {},
+            "patterns": []
+        }
+
+        for subscription in self.mongodb.collections["Subscriptions"].find(
+                {}, {"_id": False}):
+            if not self.is_active(subscription):
+                continue
+
+            condition = subscription.get("subject", {}).get("condition", {})
+            attrs = set(condition.get("attrs", []))
+
+            try:
+                predicates = [self.broker.query.compile(expression)[1]
+                              for param, expression in condition.get(
+                                  "expression", {}).items()
+                              if param in ["q", "mq"]]
+            except ValueError:
+                self.logger.warning(
+                    "%s invalid expression in subscription %s", self.program,
+                    subscription.get("id"))
+                continue
+
+            for selector in subscription.get("subject", {}).get("entities", []):
+                try:
+                    matcher = {
+                        "subscription": subscription,
+                        "attrs": attrs,
+                        "predicates": predicates,
+                        "type": selector.get("type"),
+                        "typePattern": re.compile(selector["typePattern"]) \
+                            if "typePattern" in selector else None,
+                        "idPattern": re.compile(selector["idPattern"]) \
+                            if "idPattern" in selector else None
+                    }
+                except re.error:
+                    self.logger.warning(
+                        "%s invalid pattern in subscription %s", self.program,
+                        subscription.get("id"))
+                    continue
+
+                if "id" in selector:
+                    index["ids"].setdefault(selector["id"], []).append(matcher)
+                elif matcher["type"] is not None:
+                    index["types"].setdefault(matcher["type"], []).append(matcher)
+                else:
+                    index["patterns"].append(matcher)
+
+        self.index = index
+
+    def is_active(self, subscription):
+        """ Checks if a subscription is active and not expired. """
+
+        if subscription.get("status", "active") != "active":
+            return False
+
+        if "expires" in subscription:
+            try:
+                expires = datetime.fromisoformat(
+                    str(subscription["expires"]).replace("Z", "+00:00"))
+                if expires.tzinfo is None:
+                    expires = expires.replace(tzinfo=timezone.utc)
+                if expires < datetime.now(timezone.utc):
+                    return False
+            except ValueError:
+                return False
+
+        return True
+
+    def match(self, _id, typeof, attrs):
+        """ Gets the subscription matchers for an entity change.
+
+        When the type of the changed entity is unknown, matchers
+        that depend on the type are kept and checked by the worker
+        once the entity has been fetched.
+        """
+
+        index = self.index
+
+        candidates = list(index["ids"].get(_id, []))
+        if typeof is not None:
+            candidates += index["types"].get(typeof, [])
+        else:
+            for matchers in index["types"].values():
+                candidates += matchers
+        candidates += index["patterns"]
+
+        matched = []
+        for matcher in candidates:
+            if matcher["idPattern"] is not None \
+                    and not matcher["idPattern"].search(_id):
+                continue
+            if len(matcher["attrs"]) and not matcher["attrs"] & set(attrs):
+                continue
+            if typeof is not None and not self.match_type(matcher, typeof):
+                continue
+            matched.append(matcher)
+
+        return matched
+
+    def match_type(self, matcher, typeof):
+        """ Checks an entity type against a matcher. """
+
+        if matcher["type"] is not None and matcher["type"] != typeof:
+            return False
+        if matcher["typePattern"] is not None \
+                and not matcher["typePattern"].search(typeof):
+            return False
+        return True
+
+    def notify(self, _id, typeof, attrs):
+        """ Queues the notifications for an entity change.
+
+        Runs on the request path, so it only matches against the
+        in memory index and never blocks. Changes are dropped when
+        the queue is full.
+        """
+
+        if attrs is None:
+            return
+
+        matched = self.match(_id, typeof, attrs)
+        if not len(matched):
+            return
+
+        try:
+            self.queue.put_nowait((_id, typeof, matched))
+            self.count("queued")
+        except queue.Full:
+            self.count("dropped")
+            self.logger.warning(
+                "%s queue full, notification for %s dropped.", self.program, _id)
+
+    def count(self, name):
+        """ Increments a statistics counter. """
+
+        with self.statsLock:
+            self.stats[name] += 1
+
+    def work(self):
+        """ Delivers queued notifications. """
+
+        while True:
+            _id, typeof, matched = self.queue.get()
+            try:
+                self.deliver(_id, typeof, matched)
+            except Exception as e:
+                self.logger.error(
+                    "%s delivery failed: %s", self.program, e)
+            finally:
+                self.queue.task_done()
+
+    def deliver(self, _id, typeof, matched):
+        """ Sends the notifications for an entity change. """
+
+        query = {"id": _id}
+        if typeof is not None:
+            query.update({"type": typeof})
+
+        entity = self.mongodb.collections["Entities"].find_one(
+            query, {"_id": False})
+        if entity is None:
+            return
+
+        sent = []
+        for matcher in matched:
+            subscription = matcher["subscription"]
+            if subscription["id"] in sent:
+                continue
+            if not self.match_type(matcher, entity.get("type", "")):
+                continue
+            if not all(predicate(entity) for predicate in matcher["predicates"]):
+                continue
+            if self.is_throttled(subscription):
+                self.count("throttled")
+                continue
+
+            sent.append(subscription["id"])
+            self.send(subscription, entity)
+
+    def is_throttled(self, subscription):
+        """ Checks and records the subscription throttling. """
+
+        throttling = subscription.get("throttling")
+        now = time.monotonic()
+
+        with self.throttledLock:
+            last = self.throttled.get(subscription["id"])
+            if throttling and last is not None and now - last < throttling:
+                return True
+            self.throttled[subscription["id"]] = now
+
+        return False
+
+    def send(self, subscription, entity):
+        """ Sends a notification, retrying with backoff. """
+
+        notification = subscription.get("notification", {})
+
+        if "httpCustom" in notification:
+            http = notification["httpCustom"]
+        else:
+            http = notification.get("http", {})
+
+        if "url" not in http:
+            return False
+
+        payload = {
+            "subscriptionId": subscription["id"],
+            "data": [self.format(notification, entity)]
+        }
+
+        for attempt in range(self.confs["retries"] + 1):
+            try:
+                response = self.session.request(
+                    http.get("method", "POST"), http["url"], json=payload,
+                    headers=http.get("headers"), params=http.get("qs"),
+                    timeout=self.confs["timeout"])
+                if response.status_code < 400:
+                    self.count("sent")
+                    return True
+            except requests.exceptions.RequestException as e:
+                self.logger.info(
+                    "%s notification to %s failed: %s", self.program,
+                    http["url"], e)
+
+            if attempt < self.confs["retries"]:
+                time.sleep(self.confs["backoff"] * (2 ** attempt))
+
+        self.count("failed")
+        self.logger.warning(
+            "%s notification for subscription %s failed.", self.program,
+            subscription["id"])
+
+        return False
+
+    def format(self, notification, entity):
+        """ Builds the notified representation of an entity. """
+
+        attrs = notification.get("attrs", [])
+        exceptAttrs = notification.get("exceptAttrs", [])
+
+        data = {}
+        for attr in entity:
+            if attr not in ["id", "type"]:
+                if len(attrs) and attr not in attrs:
+                    continue
+                if attr in exceptAttrs:
+                    continue
+            data[attr] = entity[attr]
+
+        attrsFormat = notification.get("attrsFormat", "normalized")
+
+        if attrsFormat == "keyValues":
+            return {attr: value["value"] if isinstance(value, dict) \
+                and "value" in value else value for attr, value in data.items()}
+        elif attrsFormat == "values":
+            return [value["value"] if isinstance(value, dict) \
+                and "value" in value else value for attr, value in data.items() \
+                    if attr not in ["id", "type"]]
+
+        return data
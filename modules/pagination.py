@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+""" HIASCDI Pagination Module.
+
+This module provides page size limits and keyset (continuation
+token) pagination for the HIASCDI list endpoints.
+
+MIT License
+
+Copyright (c) 2021 Asociación de Investigacion en Inteligencia Artificial
+Para la Leucemia Peter Moss
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files(the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and / or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+Contributors:
+- Adam Milton-Barker
+
+"""
+
+import base64
+import binascii
+import urllib.parse
+
+from bson import json_util
+
+class pagination():
+    """ HIASCDI Pagination Module.
+
+    This module provides page size limits and keyset (continuation
+    token) pagination for the HIASCDI list endpoints.
+
+    A continuation token encodes the sort key values and the
+    MongoDB ID of the last entry of a page. The next page is
+    fetched with a range query on those values, so deep pages
+    cost the same as the first one.
+    """
+
+    def __init__(self, helpers):
+        """ Initializes the class. """
+
+        self.helpers = helpers
+        self.confs = self.helpers.confs["pagination"]
+
+    def find(self, collection, query, fields, sort, arguments, pipeline=None,
+             session=None, **options):
+        """ Builds the cursor for a page of a list endpoint.
+
+        Requests with an offset use offset paging, all others use
+        keyset paging. Queries with $near use offset paging, as a
+        sort key would replace their ordering by distance. Returns
+        None as the cursor when the continuation token is invalid.
+
+        When a pipeline is given, the page is fetched with an
+        aggregation ending with the pipeline stages, run with the
+        given options. The page is read in the given session.
+        """
+
+        page = {
+            "limit": self.get_limit(arguments),
+            "offset": False,
+            "keyset": False,
+            "query": query,
+            "sort": list(sort),
+            "strip": []
+        }
+
+        if arguments.get('offset') is not None:
+            page["offset"] = int(arguments.get('offset'))
+
+        token = self.get_token(arguments)
+        if token is False:
+            return None, page
+
+        near = self.get_near(query) is not None
+        if near and token is not None:
+            # No token is issued for pages of $near queries
+            return None, page
+
+        if page["offset"] is False and page["limit"] and not near:
+            page["keyset"] = True
+            page["sort"] = self.get_sort(sort)
+            if pipeline is None:
+                fields, page["strip"] = self.get_fields(fields, page["sort"])
+            else:
+                fields, page["strip"] = self.get_key_fields(fields)
+            if token is not None:
+                query = self.get_query(query, page["sort"], token)
+                if query is False:
+                    return None, page
+                page["query"] = query
+
+        batch = self.helpers.credentials["mongodb"]["batchSize"]
+
+        if pipeline is not None:
+            if batch:
+                options["batchSize"] = batch
+            return self.aggregate(collection, fields, page, pipeline,
+                                  session, options), page
+
+        cursor = collection.find(query, fields, session=session)
+        if batch:
+            cursor = cursor.batch_size(batch)
+        if len(page["sort"]):
+            cursor = cursor.sort(page["sort"])
+        if page["offset"]:
+            cursor = cursor.skip(page["offset"])
+
+        return cursor.limit(page["limit"]), page
+
+    def aggregate(self, collection, fields, page, pipeline, session, options):
+        """ Builds the aggregation cursor of a page.
+
+        For keyset paging the sort key values of each entry are
+        kept in _keys before the pipeline changes the entries.
+        """
+
+        near = self.get_near(page["query"])
+        if near is None:
+            stages = [{"$match": page["query"]}]
+        else:
+            # $near is not allowed in $match, $geoNear must be first
+            field, operand, query = near
+            stage = {
+                "near": operand["$geometry"],
+                "key": field,
+                "distanceField": "_distance",
+                "spherical": True,
+                "query": query
+            }
+            for option in ["maxDistance", "minDistance"]:
+                if "$" + option in operand:
+                    stage[option] = operand["$" + option]
+            stages = [{"$geoNear": stage}, {"$unset": "_distance"}]
+            # $geoNear uses the geospatial index
+            options.pop("hint", None)
+        if len(page["sort"]):
+            stages.append({"$sort": dict(page["sort"])})
+        if page["offset"]:
+            stages.append({"$skip": page["offset"]})
+        if page["limit"]:
+            stages.append({"$limit": page["limit"]})
+        if page["keyset"]:
+            stages.append({"$addFields": {"_keys": [
+                "$" + key for key, direction in page["sort"]]}})
+        stages.append({"$project": fields})
+
+        return collection.aggregate(stages + pipeline, session=session,
+                                    **options)
+
+    def get_near(self, query):
+        """ Splits the $near condition off a query.
+
+        Returns the field, the $near operand and the rest of the
+        query, or None when the query has no $near.
+        """
+
+        for field, condition in query.items():
+            if isinstance(condition, dict) and "$near" in condition:
+                rest = {key: value for key, value in query.items()
+                        if key != field}
+                others = {key: value for key, value in condition.items()
+                          if key != "$near"}
+                if len(others):
+                    rest[field] = others
+                return field, condition["$near"], rest
+
+        conditions = query.get("$and", [])
+        for i, condition in enumerate(conditions):
+            near = self.get_near(condition)
+            if near is None:
+                continue
+            field, operand, rest = near
+            conditions = conditions[:i] + ([rest] if len(rest) else []) \
+                + conditions[i + 1:]
+            rest = {key: value for key, value in query.items() if key != "$and"}
+            if len(conditions):
+                rest["$and"] = conditions
+            return field, operand, rest
+
+        return None
+
+    def finish(self, page, entries, headers, arguments):
+        """ Sets the next page headers for a fetched page.
+
+        A token is only issued when the page is full.
+        """
+
+        if page["keyset"] and len(entries) == page["limit"]:
+            self.set_headers(headers, arguments,
+                             self.get_next(entries[-1], page["sort"]))
+
+        return list(self.strip(entries, page["strip"]))
+
+    def finish_stream(self, collection, page, entries, headers, arguments,
+                      session=None):
+        """ Sets the next page headers for a streamed page. """
+
+        if page["keyset"]:
+            token = self.get_boundary(collection, page["query"],
+                                      page["sort"], page["limit"], session)
+            if token is not None:
+                self.set_headers(headers, arguments, token)
+
+        return self.strip(entries, page["strip"])
+
+    def get_limit(self, arguments):
+        """ Gets the page size, applying the default and maximum. """
+
+        if arguments.get('limit') is None:
+            limit = self.confs["defaultLimit"]
+        else:
+            limit = int(arguments.get('limit'))
+
+        if self.confs["maxLimit"] and (
+                limit == 0 or limit > self.confs["maxLimit"]):
+            limit = self.confs["maxLimit"]
+
+        return limit
+
+    def get_token(self, arguments):
+        """ Decodes the continuation token of a request.
+
+        Returns None when there is no token and False when the
+        token is invalid.
+        """
+
+        token = arguments.get('next')
+        if token is None:
+            return None
+
+        try:
+            values = json_util.loads(base64.urlsafe_b64decode(
+                token.encode("ascii") + b"=" * (-len(token) % 4)))
+        except (binascii.Error, UnicodeError, ValueError):
+            return False
+
+        if not isinstance(values, list):
+            return False
+
+        return values
+
+    def get_sort(self, sort):
+        """ Adds the MongoDB ID as the final sort key. """
+
+        if "_id" in [key for key, direction in sort]:
+            return list(sort)
+
+        return list(sort) + [("_id", 1)]
+
+    def get_fields(self, fields, sort):
+        """ Adds the sort keys to a projection.
+
+        Returns the projection and the top level fields that must
+        be removed from the results as they were not requested.
+        """
+
+        fields = dict(fields)
+        strip = []
+
+        inclusive = True in [v for k, v in fields.items() if k != "_id"]
+
+        for key, direction in sort:
+            top = key.split(".")[0]
+            if key == "_id":
+                if fields.get("_id", True) is False:
+                    del fields["_id"]
+                    strip.append("_id")
+            elif inclusive and key not in fields and top not in fields:
+                fields[key] = True
+                strip.append(top)
+            elif not inclusive and fields.get(top) is False:
+                del fields[top]
+                strip.append(top)
+
+        return fields, strip
+
+    def get_key_fields(self, fields):
+        """ Adds the _keys field to a projection. """
+
+        fields = dict(fields)
+
+        if True in [v for k, v in fields.items() if k != "_id"]:
+            fields["_keys"] = True
+
+        return fields, ["_keys"]
+
+    def get_query(self, query, sort, values):
+        """ Restricts a query to the entries after a token. """
+
+        if len(values) != len(sort):
+            return False
+
+        conditions = []
+        for i, (key, direction) in enumerate(sort):
+            condition = {}
+            for j in range(i):
+                condition[sort[j][0]] = values[j]
+            condition[key] = {"$gt" if direction == 1 else "$lt": values[i]}
+            conditions.append(condition)
+
+        if not len(query):
+            return {"$or": conditions}
+
+        return {"$and": [query, {"$or": conditions}]}
+
+    def get_next(self, entry, sort):
+        """ Encodes the continuation token for an entry. """
+
+        if "_keys" in entry:
+            return base64.urlsafe_b64encode(json_util.dumps(
+                entry["_keys"]).encode("utf-8")).decode("ascii").rstrip("=")
+
+        values = []
+        for key, direction in sort:
+            value = entry
+            for part in key.split("."):
+                value = value.get(part) if isinstance(value, dict) else None
+            values.append(value)
+
+        return base64.urlsafe_b64encode(json_util.dumps(
+            values).encode("utf-8")).decode("ascii").rstrip("=")
+
+    def get_boundary(self, collection, query, sort, limit, session=None):
+        """ Gets the continuation token of a page without reading it.
+
+        Only the sort keys of the last entry of the page are
+        fetched. Used when the page itself is streamed.
+        """
+
+        fields = {key: True for key, direction in sort}
+
+        entries = list(collection.find(query, fields, session=session).sort(
+            sort).skip(limit - 1).limit(1))
+
+        if not len(entries):
+            return None
+
+        return self.get_next(entries[0], sort)
+
+    def strip(self, entries, fields):
+        """ Removes unrequested fields from entries as they are consumed. """
+
+        for entry in entries:
+            for field in fields:
+                entry.pop(field, None)
+            yield entry
+
+    def set_headers(self, headers, arguments, token):
+        """ Sets the next page headers. """
+
+        args = [(key, value) for key, value in arguments.items(multi=True)
+                if key not in ["next", "offset"]]
+        args.append(("next", token))
+
+        headers["Fiware-Next"] = token
+        headers["Link"] = '<?' + urllib.parse.urlencode(args) + '>; rel="next"'
+
+        return headers
@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+""" HIASCDI Query Planner Module.
+
+This module rewrites HIASCDI MongoDB filters into index friendly
+shapes before they are executed.
+
+MIT License
+
+Copyright (c) 2021 Asociación de Investigacion en Inteligencia Artificial
+Para la Leucemia Peter Moss
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files(the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and / or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+Contributors:
+- Adam Milton-Barker
+
+"""
+
+import re
+
+class planner():
+    """ HIASCDI Query Planner Module.
+
+    This module rewrites HIASCDI MongoDB filters into index friendly
+    shapes before they are executed.
+
+    Nested $and filters are flattened, $or filters on a single field
+    become one $in, and patterns anchored on a literal prefix get
+    explicit range bounds. Patterns that can backtrack exponentially
+    are rejected and all planned queries are time boxed.
+    """
+
+    # A quantified group that itself contains a quantifier, i.e. (a+)+
+    nested = re.compile(r"\((?:[^()\\]|\\.)*[+*}](?:[^()\\]|\\.)*\)[+*{]")
+
+    # A back reference
+    backref = re.compile(r"\\[1-9]|\(\?P=")
+
+    # Characters that end the literal prefix of a pattern
+    special = set(".^$*+?{}[]\\|()")
+
+    def __init__(self, helpers):
+        """ Initializes the class. """
+
+        self.helpers = helpers
+        self.confs = self.helpers.confs["planner"]
+
+    def plan(self, query):
+        """ Rewrites a filter into its planned form.
+
+        Raises ValueError for patterns that are not allowed.
+        """
+
+        return self.rewrite(query)
+
+    def prepare(self, cursor, query):
+        """ Applies the time limit and index hint to a cursor. """
+
+        cursor = cursor.max_time_ms(self.confs["maxTimeMS"])
+
+        hint = self.get_hint(query)
+        if hint is not None:
+            cursor = cursor.hint(hint)
+
+        return cursor
+
+    def get_options(self, query):
+        """ Gets the time limit and index hint as aggregate options. """
+
+        options = {"maxTimeMS": self.confs["maxTimeMS"]}
+
+        hint = self.get_hint(query)
+        if hint is not None:
+            options["hint"] = hint
+
+        return options
+
+    def get_hint(self, query):
+        """ Gets the configured index hint for a filter.
+
+        Hints are configured by field, the first field of the
+        filter with a hint is used.
+        """
+
+        for field in query:
+            if field in self.confs["hints"]:
+                return self.confs["hints"][field]
+
+        return None
+
+    def rewrite(self, query):
+        """ Rewrites a filter document. """
+
+        planned = {}
+        ands = []
+
+        for key, value in query.items():
+            if key == "$and":
+                for condition in value:
+                    condition = self.rewrite(condition)
+                    if "$and" in condition:
+                        ands += condition["$and"]
+                    elif condition:
+                        ands.append(condition)
+            elif key == "$or":
+                conditions = [self.rewrite(condition) for condition in value]
+                collapsed = self.collapse(conditions)
+                if collapsed is None:
+                    ands.append({"$or": conditions})
+                else:
+                    ands.append(collapsed)
+            elif key.startswith("$"):
+                planned[key] = value
+            else:
+                planned[key] = self.rewrite_condition(value)
+
+        # Conditions on fields not yet in the filter move to the top
+        remaining = []
+        for condition in ands:
+            if len(condition) == 1:
+                key = next(iter(condition))
+                if not key.startswith("$") and key not in planned:
+                    planned[key] = condition[key]
+                    continue
+            remaining.append(condition)
+
+        if len(remaining):
+            planned["$and"] = remaining
+
+        return planned
+
+    def rewrite_condition(self, value):
+        """ Rewrites the condition on a single field. """
+
+        if not isinstance(value, dict):
+            return value
+
+        if "$in" in value and len(value) == 1 and len(value["$in"]) == 1:
+            return {"$eq": value["$in"][0]}
+
+        if "$regex" in value and isinstance(value["$regex"], str):
+            pattern = value["$regex"]
+            self.check_pattern(pattern)
+
+            if value.get("$options") or len(
+                    [key for key in value if key != "$regex"]):
+                return value
+
+            prefix, literal = self.get_prefix(pattern)
+            if literal:
+                return {"$eq": prefix}
+            if len(prefix):
+                return {"$gte": prefix, "$lt": self.get_successor(prefix),
+                        "$regex": pattern}
+
+        return value
+
+    def collapse(self, conditions):
+        """ Collapses an $or of values of one field into an $in.
+
+        Returns None when the conditions cannot be collapsed.
+        """
+
+        field = None
+        values = []
+
+        for condition in conditions:
+            if len(condition) != 1:
+                return None
+            key, value = next(iter(condition.items()))
+            if key.startswith("$") or (field is not None and key != field):
+                return None
+            field = key
+
+            if isinstance(value, dict):
+                if list(value) == ["$eq"]:
+                    value = value["$eq"]
+                elif list(value) == ["$in"]:
+                    values += value["$in"]
+                    continue
+                else:
+                    return None
+            if isinstance(value, (dict, list)):
+                return None
+            values.append(value)
+
+        if field is None:
+            return None
+
+        return {field: {"$in": values}}
+
+    def check_pattern(self, pattern):
+        """ Rejects patterns that are too long or can backtrack
+        exponentially. """
+
+        if len(pattern) > self.confs["maxPatternLength"]:
+            raise ValueError("Pattern longer than " \
+                + str(self.confs["maxPatternLength"]) + " characters")
+
+        if self.nested.search(pattern) or self.backref.search(pattern):
+            raise ValueError("Pattern " + repr(pattern) + " is not allowed")
+
+    def get_prefix(self, pattern):
+        """ Gets the literal prefix of an anchored pattern.
+
+        Returns the prefix and whether the pattern is entirely
+        literal, i.e. ^abc$.
+        """
+
+        if not pattern.startswith("^") or "|" in pattern:
+            return "", False
+
+        prefix = ""
+        pos = 1
+        while pos < len(pattern):
+            char = pattern[pos]
+            if char == "\\" and pos + 1 < len(pattern) \
+                    and not pattern[pos + 1].isalnum():
+                prefix += pattern[pos + 1]
+                pos += 2
+                continue
+            if char in self.special:
+                break
+            prefix += char
+            pos += 1
+
+        if pos < len(pattern) and pattern[pos] in "*?{":
+            # The last character is optional, so it is not part
+            # of the prefix
+            return prefix[:-1], False
+
+        if pattern[pos:] == "$":
+            return prefix, True
+
+        return prefix, False
+
+    def get_successor(self, prefix):
+        """ Gets the smallest string greater than all strings with a
+        prefix. """
+
+        return prefix[:-1] + chr(ord(prefix[-1]) + 1)
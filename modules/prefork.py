@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+""" HIASCDI Pre-fork Module.
+
+This module serves the HIASCDI API from several worker processes
+forked from one preloaded master process.
+
+MIT License
+
+Copyright (c) 2021 Asociación de Investigacion en Inteligencia Artificial
+Para la Leucemia Peter Moss
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files(the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and / or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+Contributors:
+- Adam Milton-Barker
+
+"""
+
+import gc
+import os
+import random
+import signal
+import socket
+import sys
+import threading
+
+from werkzeug.serving import make_server
+
+class prefork():
+    """ HIASCDI Pre-fork Module.
+
+    This module serves the HIASCDI API from several worker processes
+    forked from one preloaded master process.
+
+    The master binds the listening socket, freezes the preloaded
+    objects out of the garbage collector so they stay shared with
+    the workers, and forks the workers. Each worker opens its own
+    MongoDB connection after the fork and serves the shared socket.
+    The master never serves requests, it owns the iotJumpWay
+    connection and replaces workers that exit.
+
+    SIGTERM and SIGINT stop the workers gracefully, SIGHUP recycles
+    them one at a time.
+    """
+
+    def __init__(self, helpers, count):
+        """ Initializes the class. """
+
+        self.helpers = helpers
+        self.logger = self.helpers.get_logger("prefork")
+        self.program = "HIASCDI Pre-fork Module"
+
+        self.confs = self.helpers.confs["prefork"]
+        self.count = count
+
+        self.socket = None
+        self.pids = {}
+        self.recycling = []
+        self.stopping = False
+
+        self.logger.info(
+            self.program + " initialization complete.")
+
+    def bind(self, host, port):
+        """ Binds the listening socket shared by the workers. """
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((host, port))
+        sock.listen(self.confs["backlog"])
+        sock.set_inheritable(True)
+
+        return sock
+
+    def run(self, host, port, worker, master, stop=None):
+        """ Runs the master process.
+
+        worker is called in each worker with the listening socket
+        and the worker number, and returns when the worker stops.
+        master is called once in the master after the first workers
+        are forked, and stop once all workers have stopped.
+        """
+
+        self.socket = self.bind(host, port)
+
+        # Objects created so far are never collected, so the
+        # collector does not write to the pages the workers share,
+        # and no collection runs until they are frozen
+        gc.disable()
+        gc.collect()
+        gc.freeze()
+
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGHUP, self.recycle)
+
+        self.logger.info(
+            self.program + " serving on " + str(host) + ":" + str(port) \
+                + " with " + str(self.count) + " workers.")
+
+        for number in range(self.count):
+            self.spawn(number, worker)
+
+        # The frozen objects stay frozen, later objects are collected
+        gc.enable()
+
+        master()
+
+        self.supervise(worker)
+
+        if stop is not None:
+            stop()
+
+        self.logger.info(self.program + " stopped.")
+        sys.exit(0)
+
+    def spawn(self, number, worker):
+        """ Forks a worker. """
+
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+                signal.signal(signal.SIGHUP, signal.SIG_IGN)
+                gc.enable()
+                worker(self.socket, number)
+            except Exception as e:
+                self.logger.error(
+                    self.program + " worker " + str(number) + " failed: " + str(e))
+                code = 1
+            finally:
+                self.helpers.stop_logging()
+                os._exit(code)
+
+        self.pids[pid] = number
+        self.logger.info(
+            self.program + " worker " + str(number) + " started with pid " \
+                + str(pid) + ".")
+
+    def supervise(self, worker):
+        """ Waits for workers to exit and replaces them. """
+
+        while len(self.pids):
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+
+            number = self.pids.pop(pid, None)
+            if number is None:
+                continue
+
+            self.logger.info(
+                self.program + " worker " + str(number) + " with pid " \
+                    + str(pid) + " exited with status " + str(status) + ".")
+
+            if not self.stopping:
+                self.spawn(number, worker)
+                self.recycle_next()
+
+    def stop(self, signum, frame):
+        """ Stops the workers gracefully.
+
+        Workers still running after the configured timeout are
+        killed.
+        """
+
+        if self.stopping:
+            return
+
+        self.stopping = True
+        self.logger.info(self.program + " stopping workers.")
+
+        for pid in list(self.pids):
+            self.signal(pid, signal.SIGTERM)
+
+        timer = threading.Timer(self.confs["timeout"], self.kill)
+        timer.daemon = True
+        timer.start()
+
+    def kill(self):
+        """ Kills the workers that did not stop in time. """
+
+        for pid in list(self.pids):
+            self.logger.warning(
+                self.program + " killing worker with pid " + str(pid) + ".")
+            self.signal(pid, signal.SIGKILL)
+
+    def recycle(self, signum, frame):
+        """ Recycles the workers one at a time. """
+
+        if self.stopping:
+            return
+
+        self.logger.info(self.program + " recycling workers.")
+        self.recycling = list(self.pids)
+        self.recycle_next()
+
+    def recycle_next(self):
+        """ Stops the next worker waiting to be recycled. """
+
+        while len(self.recycling):
+            pid = self.recycling.pop(0)
+            if pid in self.pids:
+                self.signal(pid, signal.SIGTERM)
+                return
+
+    def signal(self, pid, signum):
+        """ Sends a signal to a worker that may already have exited. """
+
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+
+    def get_limit(self):
+        """ Gets the number of requests a worker serves before it is
+        recycled, 0 for no limit.
+
+        The jitter keeps the workers from being recycled together.
+        """
+
+        if not self.confs["maxRequests"]:
+            return 0
+
+        return self.confs["maxRequests"] + random.randint(
+            0, self.confs["maxRequestsJitter"])
+
+    def serve(self, app, sock):
+        """ Serves a WSGI application on the shared socket in a worker.
+
+        The worker stops accepting connections on SIGTERM or SIGINT,
+        or once it has served its request limit, and exits when the
+        requests in progress are complete.
+        """
+
+        host, port = sock.getsockname()[:2]
+        server = make_server(host, port, app, threaded=True,
+                             fd=sock.fileno())
+        # Requests in progress are waited for when the server closes
+        server.daemon_threads = False
+
+        limit = self.get_limit()
+        served = [0]
+        lock = threading.Lock()
+
+        def shutdown(signum=None, frame=None):
+            threading.Thread(target=server.shutdown, daemon=True).start()
+
+        def counted(environ, start_response):
+            with lock:
+                served[0] += 1
+                if served[0] == limit:
+                    shutdown()
+            return app(environ, start_response)
+
+        signal.signal(signal.SIGTERM, shutdown)
+        signal.signal(signal.SIGINT, shutdown)
+
+        if limit:
+            server.app = counted
+
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+""" HIASCDI Profiler Module.
+
+This module profiles the HIASCDI requests that ask for it, returning
+the time spent in each phase of the request in a Server-Timing
+header and writing the full profile to the logs directory.
+
+MIT License
+
+Copyright (c) 2021 Asociación de Investigacion en Inteligencia Artificial
+Para la Leucemia Peter Moss
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files(the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and / or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+Contributors:
+- Adam Milton-Barker
+
+"""
+
+import cProfile
+import glob
+import hmac
+import io
+import itertools
+import os
+import pstats
+import threading
+import time
+
+class profiler():
+    """ HIASCDI Profiler Module.
+
+    This module profiles the HIASCDI requests that ask for it, returning
+    the time spent in each phase of the request in a Server-Timing
+    header and writing the full profile to the logs directory.
+
+    A request is profiled when its profiling header holds the
+    profiling token of the credentials. The phases are the functions
+    configured for them, so nothing is added to the request path,
+    and a phase includes the phases it calls, i.e. serialization
+    includes the transform of the entities it serializes. One
+    request is profiled at a time in each process.
+    """
+
+    def __init__(self, helpers):
+        """ Initializes the class. """
+
+        self.helpers = helpers
+        self.logger = self.helpers.get_logger("profiler")
+        self.program = "HIASCDI Profiler Module"
+
+        self.confs = self.helpers.confs["profiling"]
+        self.token = self.helpers.credentials["profiling"]["token"].encode("utf-8")
+
+        # The phase of each profiled function
+        self.phases = {}
+        for phase, functions in self.confs["phases"].items():
+            for function in functions:
+                self.phases[tuple(function.split(":"))] = phase
+
+        self.lock = threading.Lock()
+        self.numbers = itertools.count(1)
+
+        self.logger.info(
+            self.program + " initialization complete.")
+
+    def authorized(self, headers):
+        """ Checks if a request asks for profiling with the token. """
+
+        token = headers.get(self.confs["header"])
+        if token is None:
+            return False
+
+        return hmac.compare_digest(token.encode("utf-8"), self.token)
+
+    def start(self):
+        """ Starts profiling a request.
+
+        Returns None when another request is being profiled.
+        """
+
+        if not self.lock.acquire(blocking=False):
+            self.logger.info(
+                "%s another request is being profiled.", self.program)
+            return None
+
+        profile = cProfile.Profile()
+        profile.enable()
+
+        return profile
+
+    def finish(self, profile, method, path, duration, mongodb=None):
+        """ Stops profiling a request and writes its profile.
+
+        mongodb is the time the request spent in MongoDB commands,
+        when they were monitored. Returns the Server-Timing header.
+        """
+
+        self.stop(profile)
+
+        timings = self.get_timings(profile)
+        if mongodb is not None:
+            timings["mongodb"] = mongodb
+        timings["total"] = duration
+
+        name = os.path.join(self.confs["directory"], "profile-%s-%d-%d" % (
+            time.strftime("%Y%m%d%H%M%S"), os.getpid(), next(self.numbers)))
+
+        try:
+            profile.dump_stats(name + ".prof")
+            with open(name + ".txt", "w") as summary:
+                summary.write(self.get_summary(profile, method, path, timings))
+            self.prune()
+        except OSError as e:
+            self.logger.error(
+                "%s could not write %s: %s", self.program, name, e)
+
+        self.logger.info(
+            "%s %s %s profiled to %s: %s", self.program, method, path, name,
+            ", ".join("%s %.1fms" % (phase, timing * 1000)
+                      for phase, timing in timings.items()))
+
+        return ", ".join("%s;dur=%.3f" % (phase, timing * 1000)
+                         for phase, timing in timings.items())
+
+    def stop(self, profile):
+        """ Stops profiling a request, letting another be profiled. """
+
+        profile.disable()
+        self.lock.release()
+
+    def get_timings(self, profile):
+        """ Gets the time spent in each phase. """
+
+        timings = {phase: 0.0 for phase in self.confs["phases"]}
+
+        for (filename, line, function), (calls, primitive, total, cumulative, callers) \
+                in pstats.Stats(profile).stats.items():
+            phase = self.phases.get((os.path.basename(filename), function))
+            if phase is not None:
+                timings[phase] += cumulative
+
+        return timings
+
+    def get_summary(self, profile, method, path, timings):
+        """ Gets the readable profile of a request. """
+
+        summary = io.StringIO()
+        summary.write(method + " " + path + "\n\n")
+        for phase, timing in timings.items():
+            summary.write("%-12s %10.3fms\n" % (phase, timing * 1000))
+        summary.write("\n")
+
+        stats = pstats.Stats(profile, stream=summary)
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(self.confs["lines"])
+
+        return summary.getvalue()
+
+    def prune(self):
+        """ Removes the oldest profiles over the kept number. """
+
+        profiles = sorted(glob.glob(os.path.join(
+            self.confs["directory"], "profile-*.prof")), key=os.path.getmtime)
+
+        for name in profiles[:-self.confs["keep"]]:
+            for path in [name, name[:-len(".prof")] + ".txt"]:
+                if os.path.exists(path):
+                    os.remove(path)
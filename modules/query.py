@@ -0,0 +1,411 @@
+#!/usr/bin/env python3
+""" HIASCDI Query Language Module.
+
+This module compiles NGSI v2 Simple Query Language expressions, as
+used by the q and mq parameters, into MongoDB filters and Python
+predicates.
+
+MIT License
+
+Copyright (c) 2021 Asociación de Investigacion en Inteligencia Artificial
+Para la Leucemia Peter Moss
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files(the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and / or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+Contributors:
+- Adam Milton-Barker
+
+"""
+
+import re
+
+from modules.cache import cache
+
+class query():
+    """ HIASCDI Query Language Module.
+
+    This module compiles NGSI v2 Simple Query Language expressions, as
+    used by the q and mq parameters, into MongoDB filters and Python
+    predicates.
+
+    Statements separated by ; must all match, statements separated
+    by || match if any of them does. || binds tighter than ; and
+    parentheses can be used for grouping. Paths are dotted document
+    paths, i.e. temperature.value.
+
+    References:
+        FIWARE-NGSI v2 Specification
+        https://fiware.github.io/specifications/ngsiv2/stable/
+
+        Reference
+            - Simple Query Language
+    """
+
+    # Longest operators first so >= is not read as >
+    operators = ["==", "!=", ">=", "<=", "~=", ">", "<", ":"]
+
+    path = re.compile(r"[A-Za-z0-9_@#\-]+(\.[A-Za-z0-9_@#\-]+)*")
+
+    def __init__(self, helpers):
+        """ Initializes the class. """
+
+        self.helpers = helpers
+        self.confs = self.helpers.confs["query"]
+
+        self.compiled = cache(self.confs["cacheSize"], self.confs["cacheTtl"])
+
+    def compile(self, text):
+        """ Compiles a query expression.
+
+        Returns a (filter, predicate) tuple, where filter is the
+        MongoDB filter and predicate a function that checks an
+        entity dictionary. Compiled expressions are cached by their
+        text. Raises ValueError for invalid expressions.
+        """
+
+        compiled = self.compiled.get(text)
+        if compiled is None:
+            tree = self.parse(text)
+            compiled = (self.to_mongo(tree), self.to_predicate(tree))
+            self.compiled.set(text, compiled)
+
+        return compiled
+
+    def parse(self, text):
+        """ Parses a query expression into its syntax tree.
+
+        Nodes are tuples, the first item being the node kind:
+        ("and", nodes), ("or", nodes), ("exists", path),
+        ("absent", path), ("compare", path, op, value),
+        ("in", path, values), ("nin", path, values),
+        ("range", path, low, high), ("outside", path, low, high)
+        and ("match", path, pattern).
+        """
+
+        node, pos = self.parse_and(text, 0)
+        if pos != len(text):
+            raise ValueError("Unexpected " + repr(text[pos]) \
+                + " at position " + str(pos))
+
+        return node
+
+    def parse_and(self, text, pos):
+        """ Parses statements separated by ; """
+
+        nodes = []
+        while True:
+            node, pos = self.parse_or(text, pos)
+            nodes.append(node)
+            if not text.startswith(";", pos):
+                break
+            pos += 1
+
+        return (nodes[0] if len(nodes) == 1 else ("and", nodes)), pos
+
+    def parse_or(self, text, pos):
+        """ Parses statements separated by || """
+
+        nodes = []
+        while True:
+            node, pos = self.parse_statement(text, pos)
+            nodes.append(node)
+            if not text.startswith("||", pos):
+                break
+            pos += 2
+
+        return (nodes[0] if len(nodes) == 1 else ("or", nodes)), pos
+
+    def parse_statement(self, text, pos):
+        """ Parses a single statement or a parenthesised group. """
+
+        if text.startswith("(", pos):
+            node, pos = self.parse_and(text, pos + 1)
+            if not text.startswith(")", pos):
+                raise ValueError("Missing ) at position " + str(pos))
+            return node, pos + 1
+
+        negated = text.startswith("!", pos) \
+            and not text.startswith("!=", pos)
+        if negated:
+            pos += 1
+
+        path, pos = self.parse_path(text, pos)
+
+        op = None
+        for operator in self.operators:
+            if text.startswith(operator, pos):
+                op = operator
+                break
+
+        if op is None:
+            return ("absent" if negated else "exists", path), pos
+        if negated:
+            raise ValueError("Unexpected ! before " + path)
+
+        raw, pos = self.parse_value(text, pos + len(op))
+
+        return self.get_node(path, op, raw), pos
+
+    def parse_path(self, text, pos):
+        """ Parses a dotted attribute path. """
+
+        match = self.path.match(text, pos)
+        if match is None:
+            raise ValueError("Expected an attribute at position " + str(pos))
+
+        return match.group(0), match.end()
+
+    def parse_value(self, text, pos):
+        """ Reads the raw text of a value.
+
+        The value ends at the next ;, || or unbalanced ) outside
+        of quotes, so values may contain :, <, > and = characters.
+        """
+
+        start = pos
+        quoted = False
+        depth = 0
+        while pos < len(text):
+            char = text[pos]
+            if char == "'":
+                quoted = not quoted
+            elif not quoted:
+                if char == ";" or text.startswith("||", pos):
+                    break
+                if char == "(":
+                    depth += 1
+                elif char == ")":
+                    if depth == 0:
+                        break
+                    depth -= 1
+            pos += 1
+
+        if quoted:
+            raise ValueError("Unterminated string at position " + str(start))
+        if pos == start:
+            raise ValueError("Expected a value at position " + str(pos))
+
+        return text[start:pos], pos
+
+    def get_node(self, path, op, raw):
+        """ Builds the node of a comparison statement. """
+
+        if op == "~=":
+            pattern = raw[1:-1] if len(raw) >= 2 and raw[0] == raw[-1] == "'" \
+                else raw
+            try:
+                re.compile(pattern)
+            except re.error as e:
+                raise ValueError("Invalid pattern " + repr(pattern) + ": " + str(e))
+            return ("match", path, pattern)
+
+        if op in ["==", "!=", ":"]:
+            bounds = self.split(raw, "..")
+            if len(bounds) == 2:
+                low, high = [self.get_literal(bound) for bound in bounds]
+                return ("outside" if op == "!=" else "range", path, low, high)
+
+            values = [self.get_literal(value) for value in self.split(raw, ",")]
+            if len(values) > 1:
+                return ("nin" if op == "!=" else "in", path, values)
+
+            return ("compare", path, "!=" if op == "!=" else "==", values[0])
+
+        return ("compare", path, op, self.get_literal(raw))
+
+    def split(self, raw, separator):
+        """ Splits a raw value on a separator outside of quotes. """
+
+        parts = []
+        start = 0
+        quoted = False
+        pos = 0
+        while pos < len(raw):
+            if raw[pos] == "'":
+                quoted = not quoted
+            elif not quoted and raw.startswith(separator, pos):
+                parts.append(raw[start:pos])
+                pos += len(separator)
+                start = pos
+                continue
+            pos += 1
+        parts.append(raw[start:])
+
+        return parts
+
+    def get_literal(self, raw):
+        """ Converts the raw text of a single value.
+
+        Quoted values are always strings, unquoted values are
+        converted to booleans, integers and floats when possible.
+        """
+
+        if len(raw) >= 2 and raw[0] == "'" and raw[-1] == "'":
+            return raw[1:-1]
+        if "'" in raw:
+            raise ValueError("Invalid value " + raw)
+
+        if raw in ["true", "True"]:
+            return True
+        if raw in ["false", "False"]:
+            return False
+
+        try:
+            return int(raw)
+        except ValueError:
+            pass
+
+        try:
+            return float(raw)
+        except ValueError:
+            return raw
+
+    def to_mongo(self, node):
+        """ Converts a syntax tree to a MongoDB filter. """
+
+        kind = node[0]
+
+        if kind == "and":
+            return {"$and": [self.to_mongo(child) for child in node[1]]}
+        if kind == "or":
+            return {"$or": [self.to_mongo(child) for child in node[1]]}
+        if kind == "exists":
+            return {node[1]: {"$exists": True}}
+        if kind == "absent":
+            return {node[1]: {"$exists": False}}
+        if kind == "in":
+            return {node[1]: {"$in": node[2]}}
+        if kind == "nin":
+            return {node[1]: {"$nin": node[2]}}
+        if kind == "range":
+            return {node[1]: {"$gte": node[2], "$lte": node[3]}}
+        if kind == "outside":
+            return {"$or": [{node[1]: {"$lt": node[2]}},
+                            {node[1]: {"$gt": node[3]}}]}
+        if kind == "match":
+            return {node[1]: {"$regex": node[2]}}
+
+        path, op, value = node[1:]
+        operators = {"==": "$eq", "!=": "$ne", ">": "$gt", ">=": "$gte",
+                     "<": "$lt", "<=": "$lte"}
+
+        return {path: {operators[op]: value}}
+
+    def to_predicate(self, node):
+        """ Converts a syntax tree to a Python predicate.
+
+        The predicate follows the MongoDB filter semantics: a
+        condition on a list matches if any item matches, and
+        values of different kinds never compare.
+        """
+
+        kind = node[0]
+
+        if kind in ["and", "or"]:
+            children = [self.to_predicate(child) for child in node[1]]
+            if kind == "and":
+                return lambda entity: all(child(entity) for child in children)
+            return lambda entity: any(child(entity) for child in children)
+
+        path = node[1].split(".")
+        values = self.get_values
+
+        if kind == "exists":
+            return lambda entity: len(values(entity, path)) > 0
+        if kind == "absent":
+            return lambda entity: len(values(entity, path)) == 0
+        if kind == "in":
+            return lambda entity: any(self.equals(value, item) \
+                for value in values(entity, path) for item in node[2])
+        if kind == "nin":
+            return lambda entity: not any(self.equals(value, item) \
+                for value in values(entity, path) for item in node[2])
+        if kind == "range":
+            return lambda entity: any(self.compare(value, ">=", node[2]) \
+                and self.compare(value, "<=", node[3]) \
+                    for value in values(entity, path))
+        if kind == "outside":
+            return lambda entity: any(self.compare(value, "<", node[2]) \
+                or self.compare(value, ">", node[3]) \
+                    for value in values(entity, path))
+        if kind == "match":
+            pattern = re.compile(node[2])
+            return lambda entity: any(isinstance(value, str) \
+                and pattern.search(value) is not None \
+                    for value in values(entity, path))
+
+        op, operand = node[2:]
+        if op == "==":
+            return lambda entity: any(self.equals(value, operand) \
+                for value in values(entity, path))
+        if op == "!=":
+            return lambda entity: not any(self.equals(value, operand) \
+                for value in values(entity, path))
+
+        return lambda entity: any(self.compare(value, op, operand) \
+            for value in values(entity, path))
+
+    def get_values(self, entity, path):
+        """ Gets the values at a path, expanding lists. """
+
+        values = [entity]
+        for key in path:
+            found = []
+            for value in values:
+                if isinstance(value, dict) and key in value:
+                    found.append(value[key])
+                elif isinstance(value, list):
+                    found += [item[key] for item in value \
+                        if isinstance(item, dict) and key in item]
+            values = found
+
+        expanded = []
+        for value in values:
+            if isinstance(value, list):
+                expanded += value
+            expanded.append(value)
+
+        return expanded
+
+    def equals(self, value, operand):
+        """ Checks equality without mixing booleans and numbers. """
+
+        if isinstance(value, bool) != isinstance(operand, bool):
+            return False
+
+        return value == operand
+
+    def compare(self, value, op, operand):
+        """ Orders two values of the same kind. """
+
+        if isinstance(value, bool) or isinstance(operand, bool):
+            return False
+        numbers = (int, float)
+        if not (isinstance(value, numbers) and isinstance(operand, numbers)) \
+                and not (isinstance(value, str) and isinstance(operand, str)):
+            return False
+
+        if op == ">":
+            return value > operand
+        if op == ">=":
+            return value >= operand
+        if op == "<":
+            return value < operand
+
+        return value <= operand
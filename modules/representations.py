@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+""" HIASCDI Representations Module.
+
+This module provides the keyValues, values and unique entity
+representations as MongoDB aggregation stages.
+
+MIT License
+
+Copyright (c) 2021 Asociación de Investigacion en Inteligencia Artificial
+Para la Leucemia Peter Moss
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files(the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and / or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+Contributors:
+- Adam Milton-Barker
+
+"""
+
+class representations():
+    """ HIASCDI Representations Module.
+
+    This module provides the keyValues, values and unique entity
+    representations as MongoDB aggregation stages.
+
+    The attribute values are extracted by MongoDB, so attribute
+    metadata is never sent to HIASCDI for these representations.
+    String and list attributes are kept as they are, the value of
+    object attributes is used and attributes of other types are
+    left out.
+
+    References:
+        FIWARE-NGSI v2 Specification
+        https://fiware.github.io/specifications/ngsiv2/stable/
+
+        Specification
+            - Simplified Entity Representation
+    """
+
+    def __init__(self, helpers, broker):
+        """ Initializes the class. """
+
+        self.helpers = helpers
+        self.broker = broker
+
+    def get_options(self, options):
+        """ Gets the representation requested in an options parameter.
+
+        Returns a (keyValues, values, unique) tuple.
+        """
+
+        options = options.split(",") if options is not None else []
+
+        return "keyValues" in options, "values" in options, "unique" in options
+
+    def get_pipeline(self, keyValues=False, values=False, unique=False,
+                     exclude=[]):
+        """ Gets the aggregation stages of a representation.
+
+        Returns an empty list for the normalized representation.
+        The excluded attributes are left out of the result. The
+        _keys field used by the pagination is passed through.
+        """
+
+        if keyValues:
+            return [{"$replaceRoot": {"newRoot": {"$arrayToObject":
+                self.get_attributes(exclude)}}}]
+        elif values or unique:
+            return [{"$project": {
+                "_id": False,
+                "_keys": True,
+                "values": {"$map": {
+                    "input": self.get_attributes(exclude + ["_keys"]),
+                    "as": "attr",
+                    "in": "$$attr.v"
+                }}
+            }}]
+
+        return []
+
+    def get_attributes(self, exclude):
+        """ Gets the expression of the attribute name/value pairs. """
+
+        return {"$map": {
+            "input": {"$filter": {
+                "input": {"$objectToArray": "$$ROOT"},
+                "as": "attr",
+                "cond": {"$cond": [
+                    {"$in": ["$$attr.k", exclude]},
+                    False,
+                    {"$in": [{"$type": "$$attr.v"},
+                             ["string", "object", "array"]]}
+                ]}
+            }},
+            "as": "attr",
+            "in": {
+                "k": "$$attr.k",
+                "v": {"$cond": [
+                    {"$eq": [{"$type": "$$attr.v"}, "object"]},
+                    {"$ifNull": ["$$attr.v.value", None]},
+                    "$$attr.v"
+                ]}
+            }
+        }}
+
+    def convert(self, entities, keyValues=False, values=False, unique=False):
+        """ Converts aggregation results to the representation.
+
+        Entities are converted one at a time as they are consumed.
+        """
+
+        if values:
+            return (entity["values"] for entity in entities)
+        elif unique:
+            return self.get_unique(entity["values"] for entity in entities)
+
+        return entities
+
+    def get_unique(self, entities):
+        """ Gets the unique values of entities, in order.
+
+        Unhashable values are compared by their JSON encoding.
+        """
+
+        seen = set()
+        for values in entities:
+            for value in values:
+                if isinstance(value, (list, dict)):
+                    key = (type(value), self.broker.encode(value))
+                elif isinstance(value, bool):
+                    key = (bool, value)
+                else:
+                    key = value
+                if key not in seen:
+                    seen.add(key)
+                    yield value
@@ -40,6 +40,8 @@ import sys
 from bson import json_util, ObjectId
 from flask import Response
 
+from modules.pagination import pagination
+
 
 class subscriptions():
     """ HIASCDI Subscriptions Module.
@@ -48,16 +50,20 @@ class subscriptions():
     and deletec HIASCDI subscriptions.
     """
 
-    def __init__(self, helpers, mongodb, broker):
+    def __init__(self, helpers, mongodb, broker, notifications=None):
         """ Initializes the class. """
 
         self.helpers = helpers
+        self.logger = self.helpers.get_logger("subscriptions")
         self.program = "HIASCDI Subscriptions Module"
 
         self.mongodb = mongodb
         self.broker = broker
 
-        self.helpers.logger.info(self.program + " initialization complete.")
+        self.pagination = pagination(self.helpers)
+        self.notifications = notifications
+
+        self.logger.info(self.program + " initialization complete.")
 
     def get_subscriptions(self, arguments, accepted=[]):
         """ Gets subscription data from the MongoDB.
@@ -96,28 +102,23 @@ class subscriptions():
             for option in options:
                 count_opt = True if option == "count" else count_opt
 
-        # Prepares the offset
-        if arguments.get('offset') is None:
-            offset = False
-        else:
-            offset = int(arguments.get('offset'))
+        with self.mongodb.session() as session:
+            subscriptions, page = self.pagination.find(
+                self.mongodb.readers["Subscriptions"], query, fields, [],
+                arguments, session=session)
 
-        # Prepares the query limit
-        if arguments.get('limit') is None:
-            limit = 0
-        else:
-            limit = int(arguments.get('limit'))
+            if subscriptions is None:
+                return self.broker.respond(
+                    400, self.helpers.confs["errorMessages"]["400p"],
+                    {}, False, accepted)
 
-        if offset:
-            subscriptions = self.mongodb.mongoConn.Subscriptions.find(
-                query, fields).skip(offset).limit(limit)
-        else:
-            subscriptions = self.mongodb.mongoConn.Subscriptions.find(
-                query, fields).limit(limit)
+            if count_opt:
+                # Sets count header
+                headers["Count"] = self.mongodb.count(
+                    self.mongodb.readers["Subscriptions"], query, session)
 
-        if count_opt:
-            # Sets count header
-            headers["Count"] = subscriptions.count()
+            subscriptions = self.pagination.finish(
+                page, list(subscriptions), headers, arguments)
 
         return self.broker.respond(200, subscriptions, headers, False, accepted)
 
@@ -140,15 +141,18 @@ class subscriptions():
         data = newData
 
         try:
-            _id = self.mongodb.mongoConn.Subscriptions.insert(data)
+            with self.mongodb.session() as session:
+                self.mongodb.writer("Subscriptions", "create").insert_one(
+                    data, session=session)
+            self.changed()
             return self.broker.respond(
                 201, {}, {"Location": "v1/subscription/" + data["id"]},
                 False, accepted)
         except:
             e = sys.exc_info()
-            self.helpers.logger.info(
+            self.logger.info(
                 "Mongo data inserted FAILED!")
-            self.helpers.logger.info(str(e))
+            self.logger.info(str(e))
             return self.broker.respond(
                 400, self.helpers.confs["errorMessages"]["400b"], {},
                 False, accepted)
@@ -175,10 +179,11 @@ class subscriptions():
             '_id': False
         }
 
-        sub = self.mongodb.mongoConn.Subscriptions.find(
-                query, fields)
+        with self.mongodb.session() as session:
+            sub = self.mongodb.readers["Subscriptions"].find(
+                    query, fields, session=session)
 
-        sub = sub[0]
+            sub = sub[0]
 
         return self.broker.respond(200, sub, headers, False, accepted)
 
@@ -198,13 +203,16 @@ class subscriptions():
 
         updated = False
 
-        for update in data:
-            self.mongodb.mongoConn.Subscriptions.update_one(
-                {"id" : subscription},
-                {"$set": {update: data[update]}}, upsert=True)
-            updated = True
+        with self.mongodb.session() as session:
+            for update in data:
+                self.mongodb.writer("Subscriptions", "update").update_one(
+                    {"id" : subscription},
+                    {"$set": {update: data[update]}}, upsert=True,
+                    session=session)
+                updated = True
 
         if updated:
+            self.changed()
             return self.broker.respond(
                 204, self.helpers.confs["successMessage"][str(204)],
                 {}, False, accepted)
@@ -228,17 +236,27 @@ class subscriptions():
         """
 
         deleted = False
-        result = self.mongodb.mongoConn.Subscriptions.delete_one(
-            {"id": subscription})
+        with self.mongodb.session() as session:
+            result = self.mongodb.writer("Subscriptions", "delete").delete_one(
+                {"id": subscription}, session=session)
 
-        if result.deleted_count is True:
-            self.helpers.logger.info(
+        if result.deleted_count == 1:
+            self.changed()
+            self.logger.info(
                 "Mongo data delete OK")
             return self.broker.respond(
                 204, {}, {}, False, accepted)
         else:
-            self.helpers.logger.info(
+            self.logger.info(
                 "Mongo data delete FAILED")
             return self.broker.respond(
                 400, self.helpers.confs["errorMessages"]["400b"],
-                {}, False, accepted)
\ No newline at end of file
+                {}, False, accepted)
+
+    def changed(self):
+        """ Handles a change to the stored subscriptions. """
+
+        self.mongodb.changed("Subscriptions")
+
+        if self.notifications is not None:
+            self.notifications.load()
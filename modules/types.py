@@ -39,6 +39,8 @@ from bson import json_util, ObjectId
 
 from flask import Response
 
+from modules.pagination import pagination
+
 class types():
     """ HIASCDI Types Module.
 
@@ -50,12 +52,15 @@ class types():
         """ Initializes the class. """
 
         self.helpers = helpers
+        self.logger = self.helpers.get_logger("types")
         self.program = "HIASCDI Types Module"
 
         self.mongodb = mongodb
         self.broker = broker
 
-        self.helpers.logger.info(self.program + " initialization complete.")
+        self.pagination = pagination(self.helpers)
+
+        self.logger.info(self.program + " initialization complete.")
 
     def get_types(self, arguments, accepted=[]):
         """ Gets entity types data from the MongoDB.
@@ -96,28 +101,22 @@ class types():
                 values_opt = True if option == "values" else values_opt
                 count_opt = True if option == "count" else count_opt
 
-        # Prepares the offset
-        if arguments.get('offset') is None:
-            offset = False
-        else:
-            offset = int(arguments.get('offset'))
+        with self.mongodb.session() as session:
+            types, page = self.pagination.find(
+                self.mongodb.readers["Types"], query, fields, [], arguments,
+                session=session)
 
-        # Prepares the query limit
-        if arguments.get('limit') is None:
-            limit = 0
-        else:
-            limit = int(arguments.get('limit'))
+            if types is None:
+                return self.broker.respond(
+                    400, self.helpers.confs["errorMessages"]["400p"],
+                    {}, False, accepted)
 
-        if offset:
-            types = self.mongodb.mongoConn.Types.find(
-                query, fields).skip(offset).limit(limit)
-        else:
-            types = self.mongodb.mongoConn.Types.find(
-                query, fields).limit(limit)
+            if count_opt:
+                # Sets count header
+                headers["Count"] = self.mongodb.count(
+                    self.mongodb.readers["Types"], query, session)
 
-        if count_opt:
-            # Sets count header
-            headers["Count"] = types.count()
+            types = self.pagination.finish(page, list(types), headers, arguments)
 
         if values_opt:
             # Converts data to values
@@ -143,15 +142,18 @@ class types():
         """
 
         try:
-            _id = self.mongodb.mongoConn.Types.insert(data)
+            with self.mongodb.session() as session:
+                self.mongodb.writer("Types", "create").insert_one(
+                    data, session=session)
+            self.mongodb.changed("Types")
             return self.broker.respond(
                 201, {}, {"Location": "v1/types/" + data["type"]},
                 False, accepted)
         except:
             e = sys.exc_info()
-            self.helpers.logger.info(
+            self.logger.info(
                 "Mongo data inserted FAILED!")
-            self.helpers.logger.info(str(e))
+            self.logger.info(str(e))
             return self.broker.respond(
                 400, self.helpers.confs["errorMessages"]["400b"], {},
                 False, accepted)
@@ -172,11 +174,15 @@ class types():
         updated = False
         error = False
 
-        for update in data:
-            self.mongodb.mongoConn.Types.update_one(
-                {"type": data['type']},
-                {"$set": {update: data[update]}})
-            updated = True
+        with self.mongodb.session() as session:
+            for update in data:
+                self.mongodb.writer("Types", "update").update_one(
+                    {"type": data['type']},
+                    {"$set": {update: data[update]}}, session=session)
+                updated = True
+
+        if updated:
+            self.mongodb.changed("Types")
 
         if updated and error is False:
             return self.broker.respond(
@@ -215,8 +221,9 @@ class types():
             'type': False
         }
 
-        _type = self.mongodb.mongoConn.Types.find(
-                query, fields)
+        with self.mongodb.session() as session:
+            _type = list(self.mongodb.readers["Types"].find(
+                    query, fields, session=session))
 
         return self.broker.respond(
             200, _type, headers,
@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+""" HIASCDI Write-behind Module.
+
+This module buffers attribute value updates and writes them to
+MongoDB in batches.
+
+MIT License
+
+Copyright (c) 2021 Asociación de Investigacion en Inteligencia Artificial
+Para la Leucemia Peter Moss
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files(the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and / or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+Contributors:
+- Adam Milton-Barker
+
+"""
+
+import threading
+import time
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
+
+class writebehind():
+    """ HIASCDI Write-behind Module.
+
+    This module buffers attribute value updates and writes them to
+    MongoDB in batches.
+
+    Updates of the same entity attribute within the flush window
+    are coalesced, only the last value is written. Only attributes
+    known to exist are buffered, the first update of an attribute
+    is written directly so missing and ambiguous entities are still
+    reported. When the buffer is full updates are written directly.
+
+    The changed callback is called for each written entity, with
+    the entity id, type and the written attributes.
+
+    Unchecked buffers, used for telemetry ingestion, buffer all
+    updates and create the attributes that do not exist.
+    """
+
+    def __init__(self, helpers, mongodb, changed, confs=None, checked=True):
+        """ Initializes the class. """
+
+        self.helpers = helpers
+        self.logger = self.helpers.get_logger("writebehind")
+        self.program = "HIASCDI Write-behind Module"
+
+        self.mongodb = mongodb
+        self.changed = changed
+        self.confs = confs if confs is not None \
+            else self.helpers.confs["writeBehind"]
+        self.checked = checked
+
+        # Pending updates and the entity type by (id, attribute),
+        # and their keys by entity id
+        self.buffer = {}
+        self.pending = {}
+
+        # Time the oldest buffered update of each key was received
+        self.received = {}
+
+        # Attributes known to exist, oldest first
+        self.keys = {}
+
+        self.lock = threading.Lock()
+        # Flushes are written one at a time, in order
+        self.flushing = threading.Lock()
+        self.stopped = threading.Event()
+
+        self.stats = {
+            "buffered": 0,
+            "coalesced": 0,
+            "direct": 0,
+            "flushes": 0,
+            "written": 0,
+            "unmatched": 0,
+            "errors": 0,
+            "lag": 0.0,
+            "maxLag": 0.0
+        }
+
+    def start(self):
+        """ Starts the flush thread. """
+
+        if self.confs["enabled"]:
+            threading.Thread(target=self.work, daemon=True).start()
+
+    def stop(self):
+        """ Stops the flush thread and writes the buffered updates. """
+
+        if not self.confs["enabled"]:
+            return
+
+        self.stopped.set()
+        self.flush()
+
+        self.logger.info(self.program + " stopped.")
+
+    def work(self):
+        """ Writes the buffered updates every flush window. """
+
+        while not self.stopped.wait(self.confs["window"]):
+            self.flush()
+
+    def known(self, _id, typeof, attr):
+        """ Records that an entity attribute exists. """
+
+        if not self.confs["enabled"]:
+            return
+
+        with self.lock:
+            self.keys.pop((_id, typeof, attr), None)
+            self.keys[(_id, typeof, attr)] = True
+            if len(self.keys) > self.confs["maxKeys"]:
+                del self.keys[next(iter(self.keys))]
+
+    def forget(self, _id):
+        """ Forgets the known attributes of an entity. """
+
+        if not self.confs["enabled"]:
+            return
+
+        with self.lock:
+            for key in [key for key in self.keys if key[0] == _id]:
+                del self.keys[key]
+
+    def put(self, _id, typeof, attr, path, value, defaults=None):
+        """ Buffers an attribute update.
+
+        path is the attribute or the path of its value. defaults are
+        the fields given to an attribute that does not have them,
+        i.e. the type and metadata of an attribute created by an
+        unchecked buffer. Returns False when the update must be
+        written directly.
+        """
+
+        if not self.confs["enabled"] or self.stopped.is_set():
+            return False
+
+        # Updates with and without the type are of the same
+        # attribute, so the type is not part of the key
+        key = (_id, attr)
+
+        with self.lock:
+            if (self.checked and (_id, typeof, attr) not in self.keys) or (
+                    key not in self.buffer
+                    and len(self.buffer) >= self.confs["maxEntries"]):
+                self.stats["direct"] += 1
+                return False
+
+            if key in self.buffer:
+                buffered = self.buffer[key]
+                if typeof is not None and buffered[0] is not None \
+                        and typeof != buffered[0]:
+                    # Another entity with the same id
+                    self.stats["direct"] += 1
+                    return False
+                self.stats["coalesced"] += 1
+                if typeof is not None:
+                    buffered[0] = typeof
+                buffered[2] = defaults
+                sets = buffered[1]
+            else:
+                sets = {}
+                self.buffer[key] = [typeof, sets, defaults]
+                self.pending.setdefault(_id, set()).add(key)
+                self.received[key] = time.time()
+
+            if path == attr:
+                sets.clear()
+                sets[attr] = value
+            elif isinstance(sets.get(attr), dict):
+                # The buffered attribute gets the new value
+                sets[attr] = dict(sets[attr], value=value)
+            else:
+                sets[path] = value
+
+            self.stats["buffered"] += 1
+
+        return True
+
+    def flush(self, _id=None):
+        """ Writes the buffered updates, or those of an entity. """
+
+        if not self.confs["enabled"]:
+            return
+
+        with self.flushing:
+            self.write(_id)
+
+    def write(self, _id):
+        """ Writes the buffered updates, or those of an entity. """
+
+        with self.lock:
+            if _id is None:
+                updates = self.buffer
+                self.buffer = {}
+                self.pending = {}
+            elif _id in self.pending:
+                updates = {key: self.buffer.pop(key)
+                           for key in self.pending.pop(_id)}
+            else:
+                return
+            received = {key: self.received.pop(key) for key in updates}
+
+        if not len(updates):
+            return
+
+        operations = {}
+        for (_id, attr), (typeof, sets, defaults) in updates.items():
+            query = {"id": _id}
+            if self.checked:
+                query[attr] = {"$exists": True}
+            if typeof is not None:
+                query["type"] = typeof
+            operation = "attribute" if attr in sets else "value"
+            collection = self.mongodb.writer("Entities", operation, typeof)
+            # Handles of different tiers compare equal, so they are
+            # grouped by identity
+            operations.setdefault(id(collection), (collection, []))[1].append(
+                UpdateOne(query, self.get_update(sets, defaults)))
+
+        try:
+            with self.mongodb.session() as session:
+                for collection, requests in operations.values():
+                    result = collection.bulk_write(
+                        requests, ordered=False, session=session)
+                    self.stats["unmatched"] += \
+                        len(requests) - result.matched_count
+                    if len(requests) != result.matched_count:
+                        # The attribute was removed since it was known
+                        self.logger.warning(
+                            "%s %d buffered updates matched no entity attribute.",
+                            self.program, len(requests) - result.matched_count)
+        except BulkWriteError as e:
+            self.stats["errors"] += len(e.details.get("writeErrors", []))
+            self.logger.error(
+                self.program + " bulk write error: " + str(e.details))
+        except PyMongoError as e:
+            self.stats["errors"] += 1
+            self.logger.error(
+                self.program + " flush failed: " + str(e))
+            self.restore(updates, received)
+            return
+
+        # The lag is the time the oldest update waited to be written
+        lag = time.time() - min(received.values())
+
+        self.stats["flushes"] += 1
+        self.stats["written"] += len(updates)
+        self.stats["lag"] = lag
+        self.stats["maxLag"] = max(self.stats["maxLag"], lag)
+
+        written = {}
+        for (_id, attr), (typeof, sets, defaults) in updates.items():
+            written.setdefault((_id, typeof), []).append(attr)
+        for (_id, typeof), attrs in written.items():
+            self.changed(_id, typeof, attrs)
+
+    def get_update(self, sets, defaults):
+        """ Gets the update of buffered sets.
+
+        With defaults, the update is a pipeline merging the defaults,
+        the stored attribute and the new value, so the defaults only
+        fill in the fields the attribute does not have.
+        """
+
+        if defaults is None:
+            return {"$set": sets}
+
+        stage = {}
+        for path, value in sets.items():
+            if path.endswith(".value"):
+                attr = path[:-len(".value")]
+                stage[attr] = {"$mergeObjects": [
+                    {"$literal": defaults}, "$" + attr,
+                    {"value": {"$literal": value}}]}
+            else:
+                stage[path] = {"$literal": value}
+
+        return [{"$set": stage}]
+
+    def restore(self, updates, received):
+        """ Buffers the updates of a failed flush again.
+
+        Updates replaced by newer ones while flushing are dropped.
+        """
+
+        with self.lock:
+            for key, sets in updates.items():
+                if key in self.buffer \
+                        or len(self.buffer) >= self.confs["maxEntries"]:
+                    continue
+                self.buffer[key] = sets
+                self.pending.setdefault(key[0], set()).add(key)
+                self.received[key] = received[key]
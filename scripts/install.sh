@@ -16,6 +16,11 @@ if [ "$proceed" = "Y" -o "$proceed" = "y" ]; then
 	conda install requests
 	conda install urllib3
 	pip install mgoquery
+	pip install uvicorn
+	pip install a2wsgi
+	pip install uvloop
+	pip install zstandard
+	pip install python-snappy
 	printf -- '\033[32m SUCCESS: HIAS Contextual Data Interface component installed successfully! \033[0m\n';
 	exit 0
 else